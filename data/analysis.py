@@ -3,10 +3,12 @@ Fancy analysis algorithms.
 '''
 
 import hashlib
+import io
 import logging
+import math
 
-import imageio # TODO port to pillow
 import numpy as np
+import PIL.Image
 
 
 _ALLOWED_TYPES = set([
@@ -46,41 +48,82 @@ def sonogram_quality(recording_id, sonogram):
     Determines sound quality on the basis of a small sonogram image. Higher is better.
     '''
     try:
-        full_img = imageio.imread(sonogram, pilmode='L')
+        pixels = decode_sonogram(sonogram)
     except Exception as ex: # pylint: disable=broad-except
         logging.error(f'Error decoding sonogram of {len(sonogram)} bytes '
                       f'of recording {recording_id}: {ex}')
         return -999999
-    img = _crop_white(full_img)
-    inverted_img = 255 - img
-    # For each row (frequency band), find the 30%ile level. So we assume that
-    # the bird produces sound at this frequency no more than 70% of the time.
-    # This gives an indication of the level of background noise on that
-    # frequency band.
-    row_level = np.percentile(inverted_img, 30, axis=1)
-    # Find the maximum noise level across all frequency bands.
-    noise_level = np.amax(row_level)
-    noise_score = (255 - noise_level)**2
-    # We want some signal too, not just absence of noise. Ideally we have some
-    # loud and some quiet periods, so we take the average over columns, then
-    # the standard deviation of those averages.
-    signal_strength = np.amax(inverted_img, axis=0)
-    signal_score = np.std(signal_strength)
-    # Both scores need to be as high as possible, but they are not within the
-    # same range, so we cannot use the maximum. Take the product instead.
-    return signal_score * noise_score
-
-def _crop_white(img):
+    return sonogram_pixels_quality(pixels)
+
+
+def decode_sonogram(sonogram):
+    '''
+    Decodes a sonogram image file into a 2D array of grayscale pixels.
+    '''
+    with PIL.Image.open(io.BytesIO(sonogram)) as image:
+        return np.asarray(image.convert('L'))
+
+
+def sonogram_pixels_quality(pixels):
+    '''
+    Determines the quality of a decoded sonogram, given as a 2D array of
+    grayscale pixels. Also accepts a batch of same-sized sonograms stacked into
+    a 3D array, and then returns an array of qualities.
+    '''
+    batch = pixels if pixels.ndim == 3 else pixels[np.newaxis]
+    inverted_batch = 255 - batch
+    widths = _non_white_widths(batch)
+    qualities = np.empty(len(batch))
+    # Cropped sonograms in a group of the same width can be processed together.
+    for width in np.unique(widths).tolist():
+        group = np.flatnonzero(widths == width)
+        inverted_imgs = inverted_batch[group, :, :width]
+        # For each row (frequency band), find the 30%ile level. So we assume
+        # that the bird produces sound at this frequency no more than 70% of
+        # the time. This gives an indication of the level of background noise
+        # on that frequency band. Sorting 8-bit integers is fast because they
+        # are radix sorted, and then the percentile can be read off directly.
+        row_levels = _sorted_percentile(np.sort(inverted_imgs, axis=2, kind='stable'), 30)
+        # Find the maximum noise level across all frequency bands.
+        noise_levels = np.amax(row_levels, axis=1)
+        noise_scores = (255 - noise_levels)**2
+        # We want some signal too, not just absence of noise. Ideally we have
+        # some loud and some quiet periods, so we take the average over
+        # columns, then the standard deviation of those averages.
+        signal_strengths = np.amax(inverted_imgs, axis=1)
+        signal_scores = np.std(signal_strengths, axis=1)
+        # Both scores need to be as high as possible, but they are not within
+        # the same range, so we cannot use the maximum. Take the product
+        # instead.
+        qualities[group] = signal_scores * noise_scores
+    return qualities if pixels.ndim == 3 else qualities[0]
+
+
+def _non_white_widths(batch):
+    '''
+    Sonograms shorter than 10 seconds are full white on the right side. Returns
+    the width of each sonogram in the batch up to and including its last
+    non-white column, but at least 1.
+    '''
+    non_white_columns = np.any(batch != 255, axis=1)
+    last_non_white_columns = batch.shape[2] - 1 - np.argmax(non_white_columns[:, ::-1], axis=1)
+    return np.where(np.any(non_white_columns, axis=1), last_non_white_columns, 0) + 1
+
+
+def _sorted_percentile(sorted_rows, percentile):
     '''
-    Sonograms shorter than 10 seconds are full white on the right side.
+    Returns the given percentile along the last axis of an array that is
+    sorted along that axis. The result is exactly the same as that of
+    np.percentile with its default linear interpolation, as implemented since
+    NumPy 1.22.
     '''
-    last_nonwhite_col = 0
-    for col in range(img.shape[1]):
-        # Iterate backwards because usually non-white pixels are encountered at the bottom.
-        col_is_white = all(
-            img[row, col] == 255
-            for row in range(img.shape[0] - 1, -1, -1)
-        )
-        if not col_is_white:
-            last_nonwhite_col = col
-    return img[:, :last_nonwhite_col + 1]
+    virtual_index = (sorted_rows.shape[-1] - 1) * (percentile / 100)
+    below = math.floor(virtual_index)
+    above = min(below + 1, sorted_rows.shape[-1] - 1)
+    fraction = virtual_index - below
+    low = sorted_rows[..., below].astype(np.float64)
+    high = sorted_rows[..., above].astype(np.float64)
+    # Like np.percentile, interpolate from the nearest of the two values.
+    if fraction >= 0.5:
+        return high - (high - low) * (1 - fraction)
+    return low + (high - low) * fraction
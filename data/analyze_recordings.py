@@ -7,12 +7,21 @@ import multiprocessing.pool
 import signal
 
 import analysis
+import fetch_service
+import fetch_stats
 import fetcher
 import progress
+import species_counts
 from recordings import Recording, SonogramAnalysis
 from species import Species, SelectedSpecies
 
 
+# Number of analyses to store per commit. Each commit also recounts the
+# species of the analyzed recordings, which takes time proportional to their
+# total number of recordings.
+_COMMIT_INTERVAL = 500
+
+
 _sonogram_fetcher = None
 def _analyze(recording):
     # We pass a tuple because SQLAlchemy objects are not fully process-safe.
@@ -24,7 +33,7 @@ def _analyze(recording):
         # Create one fetcher per process.
         global _sonogram_fetcher # pylint: disable=global-statement
         if not _sonogram_fetcher:
-            _sonogram_fetcher = fetcher.Fetcher(cache_group='xc_sonograms_small', pool_size=1)
+            _sonogram_fetcher = fetch_service.worker_fetcher('xc_sonograms_small')
 
         sonogram = None
         try:
@@ -56,6 +65,7 @@ def main(args, session):
     if args.reanalyze_recordings:
         logging.info('Deleting all sonogram analyses')
         session.query(SonogramAnalysis).delete()
+        species_counts.refresh(session)
 
     logging.info('Fetching all recordings for selected species')
     recordings = session.query(Recording)\
@@ -66,16 +76,35 @@ def main(args, session):
                 ~Recording.sonogram_analysis.has())\
         .all()
 
+    logging.info('Prefetching sonograms')
+    num_errors = 0
+    for _url, error in progress.percent(
+            fetcher.prefetch('xc_sonograms_small', (r.sonogram_url_small for r in recordings)),
+            len(recordings)):
+        if error:
+            num_errors += 1
+    if num_errors:
+        logging.warning(f'{num_errors} sonograms could not be prefetched')
+
     logging.info('Analyzing recordings')
     # https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python#35134329
     original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
     with multiprocessing.pool.Pool(args.analysis_jobs) as pool:
         signal.signal(signal.SIGINT, original_sigint_handler)
 
-        for recording_id, sonogram_quality in progress.percent(
-                pool.imap(_analyze, [(r.recording_id, r.sonogram_url_small) for r in recordings]),
-                len(recordings)):
+        scientific_names = {r.recording_id: r.scientific_name for r in recordings}
+        # Scientific names of the analyses added since the last commit, whose
+        # counts need to be refreshed in the same transaction.
+        uncommitted_scientific_names = []
+        for i, (recording_id, sonogram_quality) in enumerate(progress.percent(
+                fetch_stats.pool_imap(pool, _analyze, [(r.recording_id, r.sonogram_url_small) for r in recordings]),
+                len(recordings))):
             session.add(SonogramAnalysis(
                 recording_id=recording_id,
                 sonogram_quality=sonogram_quality))
-            session.commit()
+            uncommitted_scientific_names.append(scientific_names[recording_id])
+            if (i + 1) % _COMMIT_INTERVAL == 0 or i + 1 == len(recordings):
+                session.flush()
+                species_counts.refresh(session, uncommitted_scientific_names)
+                session.commit()
+                uncommitted_scientific_names = []
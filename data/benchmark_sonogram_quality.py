@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+'''
+Compares the sonogram quality analysis against the original per-pixel
+implementation, on sonograms from the `xc_sonograms_small` cache or, if there
+are none, on synthetic ones. Checks that all scores are identical, and reports
+the time per image for decoding and for scoring, both one image at a time and
+in batches of same-sized images.
+'''
+
+import argparse
+import io
+import logging
+import sys
+import time
+
+import numpy as np
+import PIL.Image
+
+import analysis
+import fetcher
+
+
+def _reference_crop_white(img):
+    '''
+    The original implementation of cropping, which looks at every pixel in
+    Python.
+    '''
+    last_nonwhite_col = 0
+    for col in range(img.shape[1]):
+        col_is_white = all(
+            img[row, col] == 255
+            for row in range(img.shape[0] - 1, -1, -1)
+        )
+        if not col_is_white:
+            last_nonwhite_col = col
+    return img[:, :last_nonwhite_col + 1]
+
+
+def _reference_quality(full_img):
+    '''
+    The original implementation of scoring a single decoded sonogram.
+    '''
+    inverted_img = 255 - _reference_crop_white(full_img)
+    noise_score = (255 - np.amax(np.percentile(inverted_img, 30, axis=1)))**2
+    signal_score = np.std(np.amax(inverted_img, axis=0))
+    return signal_score * noise_score
+
+
+def _cached_sonograms(max_count):
+    cache = fetcher.open_cache('xc_sonograms_small')
+    sonograms = []
+    for key_hash in cache.key_hashes():
+        if len(sonograms) >= max_count:
+            break
+        sonogram = cache.get_by_hash(key_hash)
+        try:
+            analysis.decode_sonogram(sonogram)
+        except Exception: # pylint: disable=broad-except
+            # Remembered failures, or otherwise not an image.
+            continue
+        sonograms.append(sonogram)
+    return sonograms
+
+
+def _synthetic_sonograms(count, seed):
+    '''
+    Returns PNG images of the size of small xeno-canto sonograms: light
+    background noise with some darker calls, and for some of them a white right
+    side, as for recordings shorter than 10 seconds.
+    '''
+    rng = np.random.default_rng(seed)
+    width, height = 240, 160
+    sonograms = []
+    for _ in range(count):
+        pixels = rng.integers(215, 256, size=(height, width), dtype=np.uint8)
+        for _ in range(rng.integers(3, 12)):
+            x = rng.integers(width)
+            y = rng.integers(height // 2)
+            pixels[y:y + rng.integers(2, height // 4), x:x + rng.integers(2, width // 20 + 3)] = rng.integers(120)
+        if rng.random() < 0.3:
+            pixels[:, rng.integers(1, width):] = 255
+        output = io.BytesIO()
+        PIL.Image.fromarray(pixels, 'L').save(output, 'PNG')
+        sonograms.append(output.getvalue())
+    return sonograms
+
+
+def _time_per_image_us(function, count):
+    start = time.perf_counter()
+    result = function()
+    return result, (time.perf_counter() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--count', type=int, default=1000,
+        help='Maximum number of sonograms to analyze')
+    parser.add_argument(
+        '--synthetic', action='store_true',
+        help='Use synthetic sonograms even if there are cached ones')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed for the synthetic sonograms')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    sonograms = [] if args.synthetic else _cached_sonograms(args.count)
+    if not sonograms:
+        logging.info('Using synthetic sonograms')
+        sonograms = _synthetic_sonograms(args.count, args.seed)
+    count = len(sonograms)
+
+    images, decode_us = _time_per_image_us(
+        lambda: [analysis.decode_sonogram(sonogram) for sonogram in sonograms], count)
+    reference, reference_us = _time_per_image_us(
+        lambda: np.array([_reference_quality(image) for image in images]), count)
+    single, single_us = _time_per_image_us(
+        lambda: np.array([analysis.sonogram_pixels_quality(image) for image in images]), count)
+
+    def score_batches():
+        qualities = np.empty(count)
+        indices_by_shape = {}
+        for i, image in enumerate(images):
+            indices_by_shape.setdefault(image.shape, []).append(i)
+        for indices in indices_by_shape.values():
+            qualities[indices] = analysis.sonogram_pixels_quality(np.stack([images[i] for i in indices]))
+        return qualities
+    batch, batch_us = _time_per_image_us(score_batches, count)
+
+    logging.info(f'{count} sonograms, per image: decoding {decode_us:.0f} µs, '
+                 f'original scoring {reference_us:.0f} µs, single scoring {single_us:.0f} µs, '
+                 f'batch scoring {batch_us:.0f} µs')
+    mismatches = np.count_nonzero((single != reference) | (batch != reference))
+    if mismatches:
+        logging.error(f'{mismatches} of {count} scores differ from the original implementation')
+        return 1
+    logging.info('All scores are identical to the original implementation')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+'''
+Builds the region tree: a quadtree over the 1×1 degree regions, in which
+densely observed areas are covered by single regions, and sparsely observed
+areas (oceans, steppes, deserts) by larger cells whose species weights are the
+sums of the weights of the regions they cover. The leaves of the tree are what
+store_database puts in the app.
+
+The tree is built bottom-up, aggregating 2×2 cells into one at each level, and
+then split top-down. A cell is sufficiently observed if it has at least
+`--region_tree_min_observations` observations of at least
+`--region_tree_min_species` species, and it is split into its children if any
+of them is. So sparse cells are merged upward until they are sufficiently
+observed, except next to cells that are sufficiently observed on their own,
+where the app's merging of nearby regions takes care of them.
+'''
+
+import logging
+
+import numpy as np
+
+from regions import Region, RegionTreeNode, RegionTreeNodeSpeciesWeight, WeightMatrix
+
+
+def add_args(parser):
+    parser.add_argument(
+        '--region_tree_levels', type=int, default=6,
+        help='Number of levels in the region tree; cells at the top level cover 2^(levels-1) regions '
+        'in each direction')
+    parser.add_argument(
+        '--region_tree_min_observations', type=int, default=1000,
+        help='Minimum total number of observations in a region tree cell for it not to be merged with its '
+        'neighbours')
+    parser.add_argument(
+        '--region_tree_min_species', type=int, default=50,
+        help='Minimum number of species in a region tree cell for it not to be merged with its neighbours')
+
+
+class _Level:
+    '''
+    The cells of one level of the tree that contain observations. `cells`
+    holds their `(lat_index, lon_index)` grid coordinates in sorted order, and
+    `entries` their species weights as `(cell, species, weight)` rows sorted by
+    cell and species, where `cell` indexes into `cells` and `species` into the
+    species of the weight matrix.
+    '''
+
+    def __init__(self, cells, entries, num_regions, weighted_centroids):
+        self.cells = cells
+        self.entries = entries
+        self.num_regions = num_regions
+        # Sums of region centroids times their total weight, from which the
+        # centroid of the observations in each cell is computed.
+        self.weighted_centroids = weighted_centroids
+        self.total_weight = np.bincount(entries[:, 0], weights=entries[:, 2], minlength=len(cells)) \
+            .astype(np.int64)
+        self.num_species = np.bincount(entries[:, 0], minlength=len(cells))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def aggregate(self, num_species):
+        '''
+        Returns the level above this one, and for each cell in this level the
+        index of its parent cell.
+        '''
+        cells, parents = np.unique(self.cells // 2, axis=0, return_inverse=True)
+        parents = parents.reshape(-1)
+        keys, key_indices = np.unique(
+            parents[self.entries[:, 0]] * num_species + self.entries[:, 1], return_inverse=True)
+        entries = np.stack([
+            keys // num_species,
+            keys % num_species,
+            np.bincount(key_indices, weights=self.entries[:, 2]).astype(np.int64),
+        ], axis=1)
+        weighted_centroids = np.stack([
+            np.bincount(parents, weights=self.weighted_centroids[:, i], minlength=len(cells))
+            for i in range(2)
+        ], axis=1)
+        num_regions = np.bincount(parents, weights=self.num_regions, minlength=len(cells)).astype(np.int64)
+        return _Level(cells, entries, num_regions, weighted_centroids), parents
+
+
+def _base_level(session, weight_matrix):
+    '''
+    Returns the level of the regions that have any observations, and the
+    size of the regions in degrees of latitude and longitude.
+    '''
+    regions = {
+        r.region_id: r
+        for r in session.query(Region)
+    }
+    sizes = {(r.lat_end - r.lat_start, r.lon_end - r.lon_start) for r in regions.values()}
+    if len(sizes) != 1:
+        raise ValueError(f'Regions are not all of the same size: {sorted(sizes)}')
+    (size_lat, size_lon), = sizes
+
+    observed = np.flatnonzero(weight_matrix.num_species_by_region())
+    observed_regions = [regions[region_id] for region_id in weight_matrix.region_ids[observed].tolist()]
+    cells = np.array(
+        [(round(r.lat_start / size_lat), round(r.lon_start / size_lon)) for r in observed_regions],
+        dtype=np.int64).reshape(-1, 2)
+    centroids = np.array([(r.centroid_lat, r.centroid_lon) for r in observed_regions]).reshape(-1, 2)
+
+    # Regions are not necessarily in grid order, but levels need to be.
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+    observed = observed[order]
+    start, end = weight_matrix.indptr[observed], weight_matrix.indptr[observed + 1]
+    entry_cells = np.repeat(np.arange(len(observed)), end - start)
+    # The indices into the weight matrix of the entries of the observed
+    # regions, in the new order.
+    entry_indices = np.arange(len(entry_cells)) - np.repeat(np.cumsum(end - start) - end, end - start)
+    entries = np.stack([
+        entry_cells,
+        weight_matrix.indices[entry_indices],
+        weight_matrix.weights[entry_indices],
+    ], axis=1)
+    total_weight = weight_matrix.total_weight_by_region()[observed]
+    return (
+        _Level(cells[order], entries, np.ones(len(observed), dtype=np.int64),
+               centroids[order] * total_weight[:, np.newaxis]),
+        size_lat, size_lon)
+
+
+def _split(levels, parents_by_level, min_observations, min_species):
+    '''
+    Decides top-down which cells of each level are in the tree, and which of
+    those are leaves. Returns two lists of boolean masks, one per level.
+    '''
+    included_by_level = [None] * len(levels)
+    leaf_by_level = [None] * len(levels)
+    included_by_level[-1] = np.ones(len(levels[-1]), dtype=bool)
+    for l in range(len(levels) - 1, 0, -1):
+        children = levels[l - 1]
+        sufficient = (children.total_weight >= min_observations) & (children.num_species >= min_species)
+        parents = parents_by_level[l - 1]
+        split = included_by_level[l] & (np.bincount(parents, weights=sufficient, minlength=len(levels[l])) > 0)
+        leaf_by_level[l] = included_by_level[l] & ~split
+        included_by_level[l - 1] = split[parents]
+    leaf_by_level[0] = included_by_level[0]
+    return included_by_level, leaf_by_level
+
+
+def _node_rows(level, l, size_lat, size_lon, node_ids, parent_ids, leaf):
+    '''
+    Returns the rows for the region_tree_nodes table for the given cells of a
+    level, given as their node ids (zero for cells not in the tree).
+    '''
+    cell_size_lat = size_lat * 2**l
+    cell_size_lon = size_lon * 2**l
+    centroids = level.weighted_centroids / level.total_weight[:, np.newaxis]
+    return [
+        {
+            'node_id': int(node_ids[i]),
+            'parent_id': int(parent_ids[i]) if parent_ids is not None else None,
+            'level': l,
+            'is_leaf': bool(leaf[i]),
+            'lat_start': max(-90.0, lat_index * cell_size_lat),
+            'lat_end': min(90.0, (lat_index + 1) * cell_size_lat),
+            'lon_start': max(-180.0, lon_index * cell_size_lon),
+            'lon_end': min(180.0, (lon_index + 1) * cell_size_lon),
+            'centroid_lat': float(centroids[i, 0]),
+            'centroid_lon': float(centroids[i, 1]),
+            'num_regions': int(level.num_regions[i]),
+            'num_species': int(level.num_species[i]),
+            'total_weight': int(level.total_weight[i]),
+        }
+        for i in np.flatnonzero(node_ids).tolist()
+        for lat_index, lon_index in [level.cells[i].tolist()]
+    ]
+
+
+def main(args, session):
+    logging.info('Loading region species weights')
+    weight_matrix = WeightMatrix.load(session)
+    base_level, size_lat, size_lon = _base_level(session, weight_matrix)
+
+    logging.info('Aggregating regions')
+    levels = [base_level]
+    parents_by_level = []
+    for _ in range(1, args.region_tree_levels):
+        level, parents = levels[-1].aggregate(len(weight_matrix.species_ids))
+        levels.append(level)
+        parents_by_level.append(parents)
+
+    logging.info('Splitting cells')
+    included_by_level, leaf_by_level = _split(
+        levels, parents_by_level, args.region_tree_min_observations, args.region_tree_min_species)
+
+    logging.info('Deleting existing region tree')
+    session.query(RegionTreeNodeSpeciesWeight).delete()
+    session.query(RegionTreeNode).delete()
+
+    logging.info('Inserting region tree')
+    # Nodes are numbered from the top level down, so parents come before
+    # their children.
+    num_nodes = 0
+    parent_node_ids = None
+    for l in range(len(levels) - 1, -1, -1):
+        level = levels[l]
+        included = included_by_level[l]
+        node_ids = np.zeros(len(level), dtype=np.int64)
+        node_ids[included] = np.arange(num_nodes + 1, num_nodes + 1 + included.sum())
+        num_nodes += included.sum()
+        parent_ids = parent_node_ids[parents_by_level[l]] if parent_node_ids is not None else None
+
+        node_rows = _node_rows(level, l, size_lat, size_lon, node_ids, parent_ids, leaf_by_level[l])
+        if node_rows:
+            session.execute(RegionTreeNode.__table__.insert(), node_rows)
+        entries = level.entries[included[level.entries[:, 0]]]
+        weight_rows = [
+            {'node_id': node_id, 'species_id': species_id, 'weight': weight}
+            for node_id, species_id, weight in zip(
+                node_ids[entries[:, 0]].tolist(),
+                weight_matrix.species_ids[entries[:, 1]].tolist(),
+                entries[:, 2].tolist())
+        ]
+        if weight_rows:
+            session.execute(RegionTreeNodeSpeciesWeight.__table__.insert(), weight_rows)
+
+        logging.info(f'Level {l}: {included.sum()} of {len(level)} cells in the tree, '
+                     f'of which {leaf_by_level[l].sum()} leaves')
+        parent_node_ids = node_ids
+
+    logging.info(f'Built region tree of {num_nodes} nodes, of which {sum(leaf.sum() for leaf in leaf_by_level)} '
+                 f'leaves, over {len(base_level)} regions with observations')
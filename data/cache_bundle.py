@@ -0,0 +1,107 @@
+'''
+Bundle files for copying the contents of cache groups between machines.
+'''
+
+import os
+import sqlite3
+import threading
+
+
+class CacheBundle:
+    '''
+    A single SQLite file holding the entries of any number of cache groups.
+    Values are stored once per distinct content, keyed by their SHA-256
+    digest, and an index maps each (cache group, key hash) to a value. Other
+    files that belong to a cache group, like compression dictionaries, are
+    stored alongside.
+
+    Values are stored exactly as they are in the cache group's storage, so
+    compressed groups stay compressed.
+    '''
+
+    def __init__(self, file_name, create=True):
+        if not create and not os.path.isfile(file_name):
+            raise FileNotFoundError(f'Bundle {file_name} does not exist')
+        self._file_name = file_name
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('''
+                create table if not exists blobs (
+                    sha256 blob primary key not null,
+                    data blob not null
+                ) without rowid
+            ''')
+            conn.execute('''
+                create table if not exists entries (
+                    cache_group text not null,
+                    key_hash blob not null,
+                    sha256 blob not null,
+                    primary key (cache_group, key_hash)
+                ) without rowid
+            ''')
+            conn.execute('''
+                create table if not exists files (
+                    cache_group text not null,
+                    path text not null,
+                    data blob not null,
+                    primary key (cache_group, path)
+                ) without rowid
+            ''')
+
+    def cache_groups(self):
+        return [
+            cache_group for (cache_group,) in
+            self._connection().execute('select distinct cache_group from entries order by cache_group')
+        ]
+
+    def entries(self, cache_group):
+        '''
+        Returns a list of `(key_hash, sha256)` tuples for the given cache group.
+        '''
+        return self._connection().execute(
+            'select key_hash, sha256 from entries where cache_group = ?', (cache_group,)).fetchall()
+
+    def get_blob(self, sha256):
+        row = self._connection().execute('select data from blobs where sha256 = ?', (sha256,)).fetchone()
+        if row is None:
+            raise KeyError(sha256)
+        return row[0]
+
+    def add_entries(self, cache_group, items):
+        '''
+        Adds an iterable of `(key_hash, sha256, data)` tuples to the given cache
+        group, storing each distinct value only once. Returns the number of
+        bytes of new values added.
+        '''
+        num_bytes = 0
+        with self._connection() as conn:
+            for key_hash, sha256, data in items:
+                if conn.execute('insert or ignore into blobs values (?, ?)', (sha256, data)).rowcount:
+                    num_bytes += len(data)
+                conn.execute('insert or replace into entries values (?, ?, ?)', (cache_group, key_hash, sha256))
+        return num_bytes
+
+    def files(self, cache_group):
+        '''
+        Returns a list of `(path, data)` tuples for the extra files of the
+        given cache group, where `path` is relative to the cache group.
+        '''
+        return self._connection().execute(
+            'select path, data from files where cache_group = ? order by path', (cache_group,)).fetchall()
+
+    def add_file(self, cache_group, path, data):
+        with self._connection() as conn:
+            conn.execute('insert or replace into files values (?, ?, ?)', (cache_group, path, data))
+
+    def _connection(self):
+        '''
+        Returns an SQLite connection for use by the current thread.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._file_name, timeout=60.0)
+            # Most values are much larger than the default page size.
+            conn.execute('pragma page_size = 65536')
+            conn.execute('pragma journal_mode = wal')
+            self._local.conn = conn
+        return conn
@@ -2,6 +2,9 @@
 ORM classes for storing cities.
 '''
 
+import io
+import zipfile
+
 from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, Date, Enum, JSON, ForeignKey
 from sqlalchemy.orm import relationship
 
@@ -19,3 +22,22 @@ class City(Base):
     lat = Column(Float, nullable=False)
     lon = Column(Float, nullable=False)
     population = Column(Integer)
+
+
+def read_cities_file(file_name):
+    '''
+    Yields a City for each populated place in the given zipped GeoNames file,
+    such as `cities500.zip`.
+    '''
+    with zipfile.ZipFile(file_name, 'r') as zip_file:
+        with zip_file.open(zip_file.namelist()[0], 'r') as tsv_file:
+            for line in io.TextIOWrapper(tsv_file):
+                row = line.rstrip('\n').split('\t')
+                city = City(
+                    city_id=int(row[0]),
+                    name=row[1],
+                    lat=float(row[4]),
+                    lon=float(row[5]),
+                    population=int(row[14]))
+                if city.population > 0:
+                    yield city
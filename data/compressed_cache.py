@@ -0,0 +1,169 @@
+'''
+Transparent compression of cache values.
+'''
+
+import logging
+import os
+import os.path
+import random
+import threading
+
+import zstandard
+
+import progress
+
+
+# Every zstd frame starts with this; raw JSON and XML never do.
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class CompressedCache:
+    '''
+    Wraps a Cache or PackedCache and compresses its values with zstd. If a
+    dictionary has been trained on the cache's contents, it is used for
+    compression, which helps a lot for small JSON values.
+
+    Values that were stored uncompressed (by an older version, or directly in
+    the underlying cache) are returned as they are, so compression can be
+    turned on for an existing cache group.
+
+    Setting up a compressor or decompressor, especially with a dictionary,
+    can cost more than compressing a small value, so they are reused. They are
+    not thread-safe, so each thread has its own.
+    '''
+
+    DICTIONARIES_DIR_NAME = 'zstd_dictionaries'
+
+    _LEVEL = 12
+
+    def __init__(self, cache, path):
+        self._cache = cache
+        self._dictionaries_path = os.path.join(path, CompressedCache.DICTIONARIES_DIR_NAME)
+        self._dictionaries_by_id = {}
+        self._latest_dictionary = None
+        self._local = threading.local()
+        self._load_dictionaries()
+
+    def clear(self):
+        self._cache.clear()
+
+    def __getitem__(self, key):
+        return self._decompress(self._cache[key])
+
+    def __setitem__(self, key, value):
+        self._cache[key] = self._compress(value)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def write_stream(self, key, chunks):
+        # Compressed groups hold small values, so there is no point in
+        # streaming them.
+        self[key] = b''.join(chunks)
+
+    def get_buffer(self, key):
+        return memoryview(self[key])
+
+    def train_dictionary(self, num_samples, dictionary_size):
+        '''
+        Trains a new dictionary on a random sample of the cache's values, and
+        uses it for compressing from now on. Existing values remain readable,
+        but are not recompressed; use recompress() for that.
+        '''
+        key_hashes = list(self._cache.key_hashes())
+        if len(key_hashes) > num_samples:
+            key_hashes = random.sample(key_hashes, num_samples)
+        logging.info(f'Training dictionary of {dictionary_size} bytes on {len(key_hashes)} samples')
+        samples = [self._decompress(self._cache.get_by_hash(key_hash)) for key_hash in key_hashes]
+        dictionary = zstandard.train_dictionary(dictionary_size, samples, level=CompressedCache._LEVEL)
+
+        os.makedirs(self._dictionaries_path, exist_ok=True)
+        generation = len([f for f in os.listdir(self._dictionaries_path) if f.endswith('.dict')])
+        file_name = os.path.join(self._dictionaries_path, f'{generation:04d}.dict')
+        with open(file_name + '.tmp', 'wb') as f:
+            f.write(dictionary.as_bytes())
+        os.rename(file_name + '.tmp', file_name)
+        logging.info(f'Stored dictionary {dictionary.dict_id()} in {file_name}')
+        self._load_dictionaries()
+
+    def recompress(self):
+        '''
+        Compresses all values in the cache again, using the latest dictionary,
+        without counting this as a use of the entries. Returns the total number
+        of bytes before and after.
+        '''
+        old_size = 0
+        new_size = 0
+        batch = []
+        for key_hash in progress.percent(list(self._cache.key_hashes())):
+            old_value = self._cache.get_by_hash(key_hash)
+            new_value = self._compress(self._decompress(old_value))
+            old_size += len(old_value)
+            new_size += len(new_value)
+            batch.append((key_hash, new_value))
+            if len(batch) >= 1000:
+                self._cache.set_hashes(batch, keep_last_used=True)
+                batch = []
+        self._cache.set_hashes(batch, keep_last_used=True)
+        return old_size, new_size
+
+    def _compress(self, data):
+        return self._compressor(self._latest_dictionary).compress(data)
+
+    def _decompress(self, data):
+        if bytes(data[:len(_ZSTD_MAGIC)]) != _ZSTD_MAGIC:
+            return bytes(data)
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        dictionary = None
+        if dict_id:
+            dictionary = self._dictionaries_by_id.get(dict_id)
+            if not dictionary:
+                # Maybe another process trained a new one in the meantime.
+                self._load_dictionaries()
+                dictionary = self._dictionaries_by_id[dict_id]
+        # Frames written by ZstdCompressor.compress() always contain the
+        # content size, so no max_output_size is needed.
+        return self._decompressor(dictionary).decompress(data)
+
+    def _compressor(self, dictionary):
+        '''
+        Returns this thread's compressor for the given dictionary, or for no
+        dictionary if None.
+        '''
+        compressors = self._local.__dict__.setdefault('compressors', {})
+        dict_id = dictionary.dict_id() if dictionary else 0
+        compressor = compressors.get(dict_id)
+        if compressor is None:
+            if dictionary:
+                compressor = zstandard.ZstdCompressor(level=CompressedCache._LEVEL, dict_data=dictionary)
+            else:
+                compressor = zstandard.ZstdCompressor(level=CompressedCache._LEVEL)
+            compressors[dict_id] = compressor
+        return compressor
+
+    def _decompressor(self, dictionary):
+        '''
+        Returns this thread's decompressor for the given dictionary, or for no
+        dictionary if None.
+        '''
+        decompressors = self._local.__dict__.setdefault('decompressors', {})
+        dict_id = dictionary.dict_id() if dictionary else 0
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dictionary:
+                decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def _load_dictionaries(self):
+        try:
+            file_names = sorted(f for f in os.listdir(self._dictionaries_path) if f.endswith('.dict'))
+        except FileNotFoundError:
+            return
+        for file_name in file_names:
+            with open(os.path.join(self._dictionaries_path, file_name), 'rb') as f:
+                dictionary = zstandard.ZstdCompressionDict(f.read())
+            self._dictionaries_by_id[dictionary.dict_id()] = dictionary
+            self._latest_dictionary = dictionary
@@ -8,9 +8,7 @@ import os
 
 import sqlalchemy
 
-from sqlalchemy.ext.compiler import compiles, deregister
 from sqlalchemy.orm.session import Session
-from sqlalchemy.sql.expression import Insert
 
 from base import Base
 
@@ -23,22 +21,14 @@ class ExtraSession(Session):
     Simply an SQLAlchemy Session class, with some extra goodies thrown in.
     '''
 
-    def bulk_save_objects_with_replace(self, objects):
+    def insert_or_replace(self, table, rows):
         '''
-        Like Session.bulk_save_objects, but replaces any whose primary key is
-        already present. Only works on SQLite.
+        Inserts the given rows (dicts keyed by column name) into the table in a
+        single executemany, bypassing the ORM, and replaces any whose primary
+        key is already present. Only works on SQLite.
         '''
-        # https://stackoverflow.com/questions/2218304/sqlalchemy-insert-ignore
-        # This is a bit hacky, because the deregister call will remove *all*
-        # visitors, not the one we just registered. But I don't see a better
-        # way right now.
-        def _prefix_insert_with_replace(insert, compiler, **kw):
-            return compiler.visit_insert(insert.prefix_with('OR REPLACE'), **kw)
-        compiles(Insert)(_prefix_insert_with_replace)
-        try:
-            self.bulk_save_objects(objects)
-        finally:
-            deregister(Insert)
+        if rows:
+            self.execute(table.insert().prefix_with('OR REPLACE'), rows)
 
 
 def _create_engine(file_name):
@@ -66,4 +56,14 @@ def create_session(file_name):
 
 
 def create_master_schema(session): # pylint: disable=redefined-outer-name
-    Base.metadata.create_all(session.connection().engine)
+    engine = session.connection().engine
+    Base.metadata.create_all(engine)
+    # create_all() only creates indexes along with their tables, so any that
+    # were added to a table later are created here.
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_index_names = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_index_names:
+                logging.info(f'Creating index {index.name}')
+                index.create(engine)
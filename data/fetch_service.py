@@ -0,0 +1,164 @@
+'''
+Optional fetch service, which lets the worker processes of a stage share a
+single set of fetchers in the parent process, rather than each creating their
+own. This means connections and TLS sessions are reused across the whole
+stage, and CPU-bound workers do not keep idle sockets open.
+
+Workers should get their fetcher from worker_fetcher(), which returns a
+RemoteFetcher if the service is running, and a plain Fetcher otherwise.
+'''
+
+import contextlib
+import logging
+import multiprocessing.connection
+import os
+import os.path
+import tempfile
+import threading
+
+import fetcher
+
+
+# Number of connections per host that the shared fetchers keep open.
+_POOL_SIZE = 32
+
+# Methods that workers may call on the shared fetchers. Rather than sending
+# data back, the service makes sure it is in the cache (or returns the name of
+# the cache file), and the worker reads it from there.
+_METHODS = frozenset(['ensure_cached', 'fetch_cached_file', 'fetch_cached_prefix_file'])
+
+_address = None
+_authkey = None
+
+
+@contextlib.contextmanager
+def serve():
+    '''
+    Context manager that runs the fetch service on background threads while
+    it is active. Worker processes must be forked from inside it.
+    '''
+    global _address, _authkey # pylint: disable=global-statement
+    with tempfile.TemporaryDirectory(prefix='fetch_service.') as socket_dir:
+        authkey = os.urandom(32)
+        listener = multiprocessing.connection.Listener(
+            os.path.join(socket_dir, 'socket'), family='AF_UNIX', authkey=authkey)
+        service = _Service()
+        threading.Thread(target=service.accept, args=(listener,), name='fetch_service', daemon=True).start()
+        _address, _authkey = listener.address, authkey
+        try:
+            yield
+        finally:
+            _address, _authkey = None, None
+            listener.close()
+
+
+def worker_fetcher(cache_group, revalidate=False):
+    '''
+    Returns a fetcher for use in a worker process: a RemoteFetcher if the
+    fetch service is running, or else a Fetcher of its own.
+    '''
+    if _address:
+        return RemoteFetcher(cache_group, revalidate)
+    return fetcher.Fetcher(cache_group, pool_size=1, revalidate=revalidate)
+
+
+class _Service:
+    '''
+    Answers requests from RemoteFetchers, one thread per connection, using a
+    shared Fetcher per cache group.
+    '''
+
+    def __init__(self):
+        self._fetchers = {}
+        self._fetchers_lock = threading.Lock()
+
+    def accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, multiprocessing.AuthenticationError):
+                # The listener was closed.
+                return
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    cache_group, revalidate, method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if method not in _METHODS:
+                        raise ValueError(f'Unknown fetch method {method}')
+                    shared_fetcher = self._fetcher(cache_group, revalidate)
+                    if method == 'ensure_cached':
+                        # This streams misses into the cache without holding
+                        # them in memory.
+                        shared_fetcher.fetch_cached_buffer(*args)
+                        reply = ('ok', None)
+                    else:
+                        reply = ('ok', getattr(shared_fetcher, method)(*args))
+                except fetcher.FetchError as ex:
+                    reply = ('fetch_error', (ex.url, ex.status))
+                except Exception as ex: # pylint: disable=broad-except
+                    logging.error(f'Error in fetch service handling {method}{args}', exc_info=True)
+                    reply = ('error', f'{type(ex).__name__}: {ex}')
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return
+
+    def _fetcher(self, cache_group, revalidate):
+        with self._fetchers_lock:
+            key = (cache_group, revalidate)
+            if key not in self._fetchers:
+                self._fetchers[key] = fetcher.Fetcher(cache_group, pool_size=_POOL_SIZE, revalidate=revalidate)
+            return self._fetchers[key]
+
+
+class RemoteFetcher:
+    '''
+    Stand-in for a Fetcher that asks the fetch service to do the fetching,
+    and reads the results from the cache. Fetch and cache statistics are
+    counted by the service.
+    '''
+
+    def __init__(self, cache_group, revalidate=False):
+        self._cache_group = cache_group
+        self._revalidate = revalidate
+        self._cache = fetcher.open_cache(cache_group)
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+
+    def fetch_cached(self, url):
+        self._call('ensure_cached', url)
+        return self._cache[url]
+
+    def fetch_cached_buffer(self, url):
+        self._call('ensure_cached', url)
+        return self._cache.get_buffer(url)
+
+    def fetch_cached_file(self, url):
+        return self._call('fetch_cached_file', url)
+
+    def fetch_cached_prefix_file(self, url, num_bytes):
+        return self._call('fetch_cached_prefix_file', url, num_bytes)
+
+    def cache_file_name(self, url):
+        return self._cache.file_for_key(url)
+
+    def _call(self, method, *args):
+        with self._lock:
+            # A connection must not be shared with forked children.
+            if self._connection_pid != os.getpid():
+                self._connection = multiprocessing.connection.Client(_address, family='AF_UNIX', authkey=_authkey)
+                self._connection_pid = os.getpid()
+            self._connection.send((self._cache_group, self._revalidate, method, args))
+            status, result = self._connection.recv()
+        if status == 'fetch_error':
+            raise fetcher.FetchError(*result)
+        if status == 'error':
+            raise RuntimeError(f'Fetch service failed: {result}')
+        return result
@@ -0,0 +1,201 @@
+'''
+Statistics about fetches and cache accesses, kept per cache group.
+
+Each process has its own statistics. Worker pools can merge theirs back into
+the parent process by using pool_imap() instead of Pool.imap().
+'''
+
+import bisect
+import collections
+import contextlib
+import json
+import os
+import os.path
+import threading
+import time
+
+import packed_cache
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+_LATENCY_BUCKETS_MS = [
+    0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000, float('inf'),
+]
+
+_LATENCY_KINDS = ['cache_read', 'http']
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _new_group_stats():
+    return {
+        # hits, misses, coalesced, bytes_read, bytes_downloaded, retries, errors,
+        # negative_hits, rate_limit_wait_ms
+        'counters': collections.Counter(),
+        'status_codes': collections.Counter(),
+        **{
+            f'{kind}_latency_ms': collections.Counter()
+            for kind in _LATENCY_KINDS
+        },
+    }
+
+
+def _group_stats(cache_group):
+    group_stats = _stats.get(cache_group)
+    if group_stats is None:
+        group_stats = _new_group_stats()
+        _stats[cache_group] = group_stats
+    return group_stats
+
+
+def count(cache_group, counter, amount=1):
+    '''
+    Increments the given counter, for example 'hits' or 'bytes_downloaded'.
+    '''
+    with _lock:
+        _group_stats(cache_group)['counters'][counter] += amount
+
+
+def count_status(cache_group, status):
+    '''
+    Counts an HTTP response status code.
+    '''
+    with _lock:
+        _group_stats(cache_group)['status_codes'][str(status)] += 1
+
+
+def record_latency(cache_group, kind, seconds):
+    '''
+    Adds a latency measurement of the given kind ('cache_read' or 'http') to
+    its histogram.
+    '''
+    assert kind in _LATENCY_KINDS
+    milliseconds = 1000 * seconds
+    bucket = _LATENCY_BUCKETS_MS[bisect.bisect_left(_LATENCY_BUCKETS_MS, milliseconds)]
+    with _lock:
+        group_stats = _group_stats(cache_group)
+        group_stats[f'{kind}_latency_ms'][f'<={bucket}'] += 1
+        group_stats['counters'][f'{kind}_total_ms'] += milliseconds
+
+
+@contextlib.contextmanager
+def timed(cache_group, kind):
+    '''
+    Context manager that records the latency of its body.
+    '''
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        record_latency(cache_group, kind, time.monotonic() - start_time)
+
+
+def reset():
+    '''
+    Clears all statistics in this process.
+    '''
+    with _lock:
+        _stats.clear()
+
+
+def snapshot():
+    '''
+    Returns a copy of all statistics in this process, as plain dicts that can
+    be pickled and encoded to JSON.
+    '''
+    with _lock:
+        return _copy()
+
+
+def drain():
+    '''
+    Returns a snapshot and resets the statistics.
+    '''
+    with _lock:
+        result = _copy()
+        _stats.clear()
+    return result
+
+
+def _copy():
+    return {
+        cache_group: {name: dict(counter) for name, counter in group_stats.items()}
+        for cache_group, group_stats in _stats.items()
+    }
+
+
+def merge(other_snapshot):
+    '''
+    Adds a snapshot, typically from another process, into this process's
+    statistics.
+    '''
+    with _lock:
+        for cache_group, other_group_stats in other_snapshot.items():
+            group_stats = _group_stats(cache_group)
+            for name, values in other_group_stats.items():
+                group_stats[name].update(values)
+
+
+class _WithStats:
+    '''
+    Picklable wrapper around a worker function that returns the worker
+    process's statistics along with each result. It also writes the uses of
+    packed cache entries that the worker recorded, because the pool may
+    terminate the worker at any time after it returns the last result.
+    '''
+
+    def __init__(self, func):
+        self._func = func
+
+    def __call__(self, arg):
+        result = self._func(arg)
+        packed_cache.flush_last_used()
+        return result, drain()
+
+
+def pool_imap(pool, func, iterable, chunksize=1):
+    '''
+    Like `pool.imap(func, iterable)`, but merges the statistics collected in
+    the worker processes into those of the current process, and makes sure
+    that their uses of packed cache entries are recorded.
+    '''
+    for result, worker_stats in pool.imap(_WithStats(func), iterable, chunksize):
+        merge(worker_stats)
+        yield result
+
+
+def summary():
+    '''
+    Returns a human-readable summary of the statistics, one line per cache
+    group.
+    '''
+    lines = []
+    for cache_group, group_stats in sorted(snapshot().items()):
+        counters = collections.Counter(group_stats['counters'])
+        num_cache_reads = sum(group_stats['cache_read_latency_ms'].values())
+        num_requests = sum(group_stats['http_latency_ms'].values())
+        line = (f'{cache_group}: {counters["hits"]} hits ({counters["bytes_read"]} bytes), '
+                f'{counters["misses"]} misses ({counters["bytes_downloaded"]} bytes downloaded), '
+                f'{counters["coalesced"]} coalesced, {counters["retries"]} retries, '
+                f'{counters["errors"]} errors, {counters["negative_hits"]} known failures')
+        if counters['rate_limit_wait_ms']:
+            line += f'; waited {counters["rate_limit_wait_ms"] / 1000:.1f} s for rate limiter'
+        if num_cache_reads:
+            line += f'; cache read {counters["cache_read_total_ms"] / num_cache_reads:.2f} ms avg'
+        if num_requests:
+            line += f'; HTTP {counters["http_total_ms"] / num_requests:.1f} ms avg'
+        if group_stats['status_codes']:
+            line += '; status ' + ', '.join(
+                f'{status}: {n}' for status, n in sorted(group_stats['status_codes'].items()))
+        lines.append(line)
+    return lines
+
+
+def write_json(file_name):
+    '''
+    Writes all statistics to a JSON file.
+    '''
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'wt') as f:
+        json.dump(snapshot(), f, indent=2, sort_keys=True)
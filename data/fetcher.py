@@ -2,22 +2,126 @@
 Network fetch helpers.
 '''
 
+import asyncio
+import contextlib
+import fcntl
 import hashlib
+import json
 import logging
+import mmap
+import re
 import os
 import os.path
+import queue
+import threading
+import time
+import urllib.parse
 
+import aiohttp
 import urllib3
 
+import fetch_stats
+import rate_limiter
+from compressed_cache import CompressedCache
+from negative_cache import NegativeCache
+from packed_cache import PackedCache
+
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+
+# Retry 400 errors (Bad Request). These spuriously happen in the xeno-canto
+# API, perhaps due to a bug.
+_RETRY_STATUSES = frozenset([400, 429] + list(range(500, 600)))
+_NUM_RETRIES = 7
+_BACKOFF_FACTOR = 0.1
+
+# Fetcher retries by itself, so that every attempt goes through the rate
+# limiter; urllib3 should only follow redirects.
+_NO_RETRIES = urllib3.Retry(total=10, connect=0, read=0)
+
+# Statuses that mean the URL is gone. These are not retried, and the response
+# is not cached as if it were successful.
+_FAILURE_STATUSES = frozenset([404, 410])
+
+# How long to remember that a URL could not be fetched, in seconds. During
+# this time, fetching it from the cache fails right away, rather than trying
+# (and retrying) it again. Set by set_negative_cache_ttl().
+_negative_cache_ttl = 30 * 24 * 60 * 60
+
+# If set, cache misses are errors. Set by set_offline().
+_offline = False
+
+# If set, all requests are sent to this server instead. Set by
+# set_standin_server().
+_standin_server_url = None
+
+# Size of chunks when streaming responses to disk.
+_STREAM_CHUNK_SIZE = 256 * 1024
+
+# Number of bytes that prefetch() fetches first when fetching a prefix, to
+# determine how many bytes are needed.
+PREFIX_HEAD_SIZE = 64 * 1024
+
+# Cache groups with many small entries, which are created as a PackedCache
+# rather than a Cache if they do not exist yet. Existing groups can be
+# converted using `manage_cache.py migrate`.
+_PACKED_CACHE_GROUPS = frozenset(['xc_api', 'xc_sonograms_small'])
+
+# Cache groups containing JSON or XML, whose values are stored compressed.
+# Compression can be improved by training a dictionary using
+# `manage_cache.py train_dictionary`.
+_COMPRESSED_CACHE_GROUPS = frozenset(['xc_api', 'wp_pages'])
+
+# Ask servers to compress responses, but only using encodings that urllib3 can
+# decode.
+_ACCEPT_ENCODING = ['gzip', 'deflate'] + (['br'] if urllib3.response.brotli else [])
+
 
 class FetchError(RuntimeError):
     '''
-    Raised when a file could not be fetched from the internet.
+    Raised when a file could not be fetched from the internet. If the server
+    responded, `status` is the HTTP status code of the last response.
     '''
 
-    def __init__(self, url):
-        super().__init__(f'Error fetching "{url}"')
+    def __init__(self, url, status=None):
+        if status:
+            super().__init__(f'Error fetching "{url}": HTTP status {status}')
+        else:
+            super().__init__(f'Error fetching "{url}"')
         self.url = url
+        self.status = status
+
+
+def set_negative_cache_ttl(seconds):
+    '''
+    Sets how long failures to fetch a URL into the cache are remembered. Zero
+    means that failed URLs are always tried again. Affects this process and
+    any worker processes forked after this call.
+    '''
+    global _negative_cache_ttl # pylint: disable=global-statement
+    _negative_cache_ttl = seconds
+
+
+def set_offline(offline=True):
+    '''
+    Turns offline mode on or off. In offline mode, nothing is fetched from
+    the network, and anything that would need to be fetched raises
+    FetchError instead. Affects this process and any worker processes forked
+    after this call.
+    '''
+    global _offline # pylint: disable=global-statement
+    _offline = offline
+
+
+def set_standin_server(url):
+    '''
+    Sends all requests to the given server instead, with the original URL
+    (without its scheme) appended to its path; see standin_server.py. Cache
+    keys remain the original URLs. Affects this process and any worker
+    processes forked after this call.
+    '''
+    global _standin_server_url # pylint: disable=global-statement
+    _standin_server_url = url
 
 
 class Cache:
@@ -41,13 +145,75 @@ class Cache:
             raise KeyError(key)
 
     def __setitem__(self, key, value):
-        file_name = self.file_for_key(key)
+        self._write(self.file_for_key(key), [value])
+
+    def __contains__(self, key):
+        return os.path.isfile(self.file_for_key(key))
+
+    def get_by_hash(self, key_hash):
+        '''
+        Returns the value for the key with the given SHA-1 digest.
+        '''
+        try:
+            with open(self.file_for_hash(key_hash), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key_hash)
+
+    def set_hashes(self, items, keep_last_used=False):
+        '''
+        Stores an iterable of (key hash, value) pairs, where the key hash is
+        the SHA-1 digest of the key as bytes. If `keep_last_used` is set,
+        existing files keep their access time, as when rewriting entries for
+        maintenance.
+        '''
+        for key_hash, value in items:
+            file_name = self.file_for_hash(key_hash)
+            last_used = None
+            if keep_last_used:
+                try:
+                    last_used = os.stat(file_name).st_atime
+                except FileNotFoundError:
+                    pass
+            self._write(file_name, [value])
+            if last_used is not None:
+                os.utime(file_name, (last_used, os.stat(file_name).st_mtime))
+
+    def write_stream(self, key, chunks):
+        '''
+        Stores the value given as an iterable of bytes-like chunks, without
+        holding it in memory in full.
+        '''
+        self._write(self.file_for_key(key), chunks)
+
+    def get_buffer(self, key):
+        '''
+        Returns a read-only buffer of the value, backed by a memory map of the
+        file rather than a copy in memory.
+        '''
+        try:
+            with open(self.file_for_key(key), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b'')
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def key_hashes(self):
+        '''
+        Yields the SHA-1 digests of all keys in the cache.
+        '''
+        for key_hash, _file_name in self.entries():
+            yield key_hash
+
+    def _write(self, file_name, chunks):
         os.makedirs(os.path.dirname(file_name), exist_ok=True)
         # Include PID in the file name to make concurrent writes process-safe.
         temp_file_name = f'{file_name}.{os.getpid()}.tmp'
         try:
             with open(temp_file_name, 'wb') as f:
-                f.write(value)
+                for chunk in chunks:
+                    f.write(chunk)
             os.rename(temp_file_name, file_name)
         except: # pylint: disable=bare-except
             # Try to clean up, but propagate the original exception.
@@ -57,16 +223,19 @@ class Cache:
                 pass
             raise
 
-    def __contains__(self, key):
-        return os.path.isfile(self.file_for_key(key))
-
     def file_for_key(self, key):
         hasher = hashlib.sha1()
         if isinstance(key, str):
             key = key.encode('utf-8')
         assert isinstance(key, bytes)
         hasher.update(key)
-        basename = hasher.hexdigest()
+        return self.file_for_hash(hasher.digest())
+
+    def file_for_hash(self, key_hash):
+        '''
+        Returns the file name for the given SHA-1 digest of a key.
+        '''
+        basename = key_hash.hex()
         parts = []
         for _ in range(self._levels):
             parts.append(basename[:2])
@@ -74,21 +243,345 @@ class Cache:
         parts.append(basename)
         return os.path.join(self._path, *parts)
 
+    def shards(self):
+        '''
+        Returns the paths of the top-level subdirectories, which can be passed
+        to entries() to process the cache in parallel.
+        '''
+        try:
+            return [
+                os.path.join(self._path, name) for name in sorted(os.listdir(self._path))
+                if len(name) == 2 and os.path.isdir(os.path.join(self._path, name))
+            ]
+        except FileNotFoundError:
+            return []
+
+    def entries(self, shard=None):
+        '''
+        Yields a `(key_hash, file_name)` tuple for each entry in the cache (or
+        only in the given shard), where `key_hash` is the SHA-1 digest of the
+        key.
+        '''
+        for dir_path, _dir_names, file_names in os.walk(shard or self._path):
+            relative_path = os.path.relpath(dir_path, self._path)
+            parts = [] if relative_path == os.curdir else relative_path.split(os.sep)
+            if len(parts) != self._levels:
+                continue
+            for file_name in file_names:
+                try:
+                    key_hash = bytes.fromhex(''.join(parts) + file_name)
+                except ValueError:
+                    # Temporary file, or not ours.
+                    continue
+                if len(key_hash) == hashlib.sha1().digest_size:
+                    yield key_hash, os.path.join(dir_path, file_name)
+
+
+def open_cache(cache_group):
+    '''
+    Returns the Cache or PackedCache for the given cache group, depending on
+    what is already on disk, wrapped in a CompressedCache if needed.
+    '''
+    cache = open_storage(cache_group)
+    if cache_group in _COMPRESSED_CACHE_GROUPS:
+        cache = CompressedCache(cache, os.path.join(CACHE_DIR, cache_group))
+    return cache
+
+
+def open_storage(cache_group):
+    '''
+    Returns the Cache or PackedCache for the given cache group, depending on
+    what is already on disk, without any compression wrapper. This is meant
+    for maintenance operations that work on the stored bytes.
+    '''
+    path = os.path.join(CACHE_DIR, cache_group)
+    if PackedCache.exists(path) or (cache_group in _PACKED_CACHE_GROUPS and not os.path.exists(path)):
+        return PackedCache(path)
+    return Cache(path)
+
+
+class _KeyLocks:
+    '''
+    Lock files that let threads and processes make sure that only one of them
+    fetches a given URL at a time. Each URL has its own lock file, named after
+    the hash of the URL, which only exists while the lock is held, so unrelated
+    URLs never wait for each other. Locks are released automatically if the
+    process dies.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    @contextlib.contextmanager
+    def lock(self, url):
+        '''
+        Context manager that holds the lock for the given URL.
+        '''
+        file_name, fd = self._acquire(url)
+        try:
+            yield
+        finally:
+            self._release(file_name, fd)
+
+    @contextlib.asynccontextmanager
+    async def lock_async(self, url):
+        '''
+        Like lock(), but tries to take the lock on a thread of the default
+        executor, polling rather than blocking either that thread or the event
+        loop.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            attempt = loop.run_in_executor(None, self._acquire, url, False)
+            try:
+                acquired = await asyncio.shield(attempt)
+            except asyncio.CancelledError:
+                # The attempt carries on without us; let go of the lock if it
+                # succeeds.
+                attempt.add_done_callback(self._release_acquired)
+                raise
+            if acquired:
+                break
+            await asyncio.sleep(0.05)
+        try:
+            yield
+        finally:
+            # Releasing does not wait for anything, and must not depend on the
+            # executor having a thread available.
+            self._release(*acquired)
+
+    def _acquire(self, url, blocking=True):
+        '''
+        Takes the lock and returns a `(file_name, fd)` tuple to pass to
+        _release(). If not `blocking`, returns None instead of waiting if the
+        lock is held by someone else.
+        '''
+        file_name = os.path.join(self._path, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.lock')
+        while True:
+            fd = os.open(file_name, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # The previous holder may have removed the file while we were
+            # waiting for it, in which case someone else may hold the lock on
+            # a new file by the same name.
+            try:
+                if os.fstat(fd).st_ino == os.stat(file_name).st_ino:
+                    return file_name, fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _release_acquired(self, attempt):
+        if not attempt.cancelled() and not attempt.exception() and attempt.result():
+            self._release(*attempt.result())
+
+    @staticmethod
+    def _release(file_name, fd):
+        # Remove the file while still holding the lock, so that it does not
+        # linger; closing the file releases the lock.
+        try:
+            os.remove(file_name)
+        finally:
+            os.close(fd)
+
+
+def validators_key(url):
+    '''
+    Returns the cache key under which the validators (ETag and Last-Modified
+    headers) of the response for the given URL are stored.
+    '''
+    return 'validators:' + url
+
+
+def prefix_key(url):
+    '''
+    Returns the cache key under which a prefix of the response body for the
+    given URL is stored, if it was fetched using a Range request.
+    '''
+    return 'prefix:' + url
+
+
+def _prefix_length_key(url):
+    return 'prefix_length:' + url
+
+
+def cache_keys(url):
+    '''
+    Returns all cache keys that may hold data for the given URL.
+    '''
+    return [url, validators_key(url), prefix_key(url), _prefix_length_key(url)]
+
+
+def _prefix_length(cache, url):
+    try:
+        return int(cache[_prefix_length_key(url)])
+    except KeyError:
+        return 0
+
+
+def _range_headers(start, num_bytes):
+    # Ranges refer to the encoded body, so do not ask for compression.
+    return {'Range': f'bytes={start}-{num_bytes - 1}', 'Accept-Encoding': 'identity'}
+
+
+def _store_prefix(cache, url, start, status, headers, data):
+    '''
+    Stores the response to a Range request made with _range_headers(start,
+    ...), where `start` is the length of the cached prefix. A complete body is
+    stored under the URL itself, like any other response.
+    '''
+    if status == 200:
+        # The server ignored the range and sent everything.
+        _store_response(cache, url, data, headers)
+        return
+    chunks = [cache.get_buffer(prefix_key(url))[:start]] if start else []
+    if status == 416:
+        # The prefix already covers the entire body.
+        complete = True
+    else:
+        m = re.match(r'^bytes (\d+)-(\d+)/(\d+|\*)$', headers.get('Content-Range', ''))
+        if status != 206 or not m or int(m.group(1)) != start:
+            raise FetchError(url, status)
+        chunks.append(data)
+        length = int(m.group(2)) + 1
+        complete = m.group(3) != '*' and length >= int(m.group(3))
+    if complete:
+        cache.write_stream(url, chunks)
+        _store_validators(cache, url, headers)
+        # The prefix is never looked at again once the full body is cached.
+        cache[prefix_key(url)] = b''
+        cache[_prefix_length_key(url)] = b'0'
+    else:
+        cache.write_stream(prefix_key(url), chunks)
+        cache[_prefix_length_key(url)] = str(length).encode('utf-8')
+
+
+def _store_response(cache, url, data, headers):
+    '''
+    Stores the response body in the cache, along with its validators if it
+    has any.
+    '''
+    cache[url] = data
+    _store_validators(cache, url, headers)
+
+
+def _store_validators(cache, url, headers):
+    validators = {
+        header: headers[header]
+        for header in ('ETag', 'Last-Modified')
+        if headers.get(header)
+    }
+    if validators:
+        cache[validators_key(url)] = json.dumps(validators).encode('utf-8')
+
+
+def _conditional_headers(cache, url):
+    '''
+    Returns the request headers for a conditional GET of the given URL, based
+    on the validators in the cache. Returns None if there are no validators.
+    '''
+    try:
+        validators = json.loads(cache[validators_key(url)])
+    except KeyError:
+        return None
+    headers = {}
+    if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    return headers
+
+
+@contextlib.contextmanager
+def _remembering_failures(failures, cache_group, url):
+    '''
+    Context manager around fetching a URL into the cache. Raises FetchError
+    right away if fetching it failed recently because it is gone, and records
+    a failure if its body raises FetchError with such a status. Other errors,
+    such as rate limiting or server outages, are temporary, so they are not
+    remembered.
+    '''
+    failure = failures.get(url)
+    if failure:
+        status, failed_at = failure
+        if status in _FAILURE_STATUSES and time.time() - failed_at < _negative_cache_ttl:
+            logging.debug(f'{url} failed recently with status {status}; not trying again')
+            fetch_stats.count(cache_group, 'negative_hits')
+            raise FetchError(url, status)
+    try:
+        yield
+    except FetchError as ex:
+        if ex.status in _FAILURE_STATUSES:
+            failures.add(url, ex.status)
+        raise
+    if failure:
+        failures.remove(url)
+
+
+def _read_cache(cache_group, read, url):
+    '''
+    Reads the cache entry for the URL using the given function, and counts it
+    as a hit.
+    '''
+    with fetch_stats.timed(cache_group, 'cache_read'):
+        data = read(url)
+    fetch_stats.count(cache_group, 'hits')
+    fetch_stats.count(cache_group, 'bytes_read', len(data))
+    return data
+
+
+def _count_download(cache_group, chunks):
+    '''
+    Passes through an iterable of chunks, counting their size as downloaded.
+    '''
+    for chunk in chunks:
+        fetch_stats.count(cache_group, 'bytes_downloaded', len(chunk))
+        yield chunk
+
 
 class Fetcher:
     '''
     Cached, thread-safe HTTP fetcher.
+
+    If `revalidate` is set, cached responses are checked for changes using a
+    conditional GET, and only rewritten if they did change. Responses cached
+    without validators are fetched again in full.
+
+    Concurrent cache misses on the same URL, from any thread or process, are
+    coalesced: one of them fetches it, and the others wait and then read the
+    result from the cache.
+
+    If fetching a URL into the cache fails because it is gone (HTTP status
+    404 or 410), this is remembered for a while (see
+    set_negative_cache_ttl()), and fetching it from the cache fails right away
+    until then. Use `manage_cache.py list_failures` and `purge_failures` to
+    inspect and forget such failures.
+
+    Every request, including retries, waits for the rate_limiter, which adapts
+    the rate and concurrency of requests to each host to how well the server
+    is coping, across all processes.
+
+    Hits, misses, coalesced requests, retries, bytes transferred and latencies
+    are counted per cache group in the fetch_stats module.
     '''
 
-    def __init__(self, cache_group, pool_size, clear_cache=False):
+    def __init__(self, cache_group, pool_size, clear_cache=False, revalidate=False):
         self._cache_group = cache_group
-        self._cache = Cache(os.path.join(os.path.dirname(__file__), 'cache', cache_group))
+        self._cache = open_cache(cache_group)
         if clear_cache:
             self._cache.clear()
+        self._locks = _KeyLocks(os.path.join(CACHE_DIR, cache_group, 'locks'))
+        self._failures = NegativeCache(os.path.join(CACHE_DIR, cache_group))
+        self._revalidate = revalidate
         self._http = urllib3.PoolManager(num_pools=10,
                                          maxsize=pool_size,
                                          block=True,
                                          timeout=urllib3.util.Timeout(total=300))
+        self._headers = urllib3.make_headers(accept_encoding=_ACCEPT_ENCODING)
 
     def fetch_cached(self, url):
         '''
@@ -96,37 +589,473 @@ class Fetcher:
         storing it if needed.
         '''
         if url in self._cache:
+            if self._revalidate:
+                return self._fetch_revalidated(url)
             logging.debug(f'Returning {url} from {self._cache_group} cache')
-            return self._cache[url]
-        data = self.fetch_uncached(url)
-        self._cache[url] = data
-        return data
+            return _read_cache(self._cache_group, self._cache.__getitem__, url)
+        with self._locks.lock(url):
+            if url in self._cache:
+                logging.debug(f'{url} was fetched concurrently into {self._cache_group} cache')
+                fetch_stats.count(self._cache_group, 'coalesced')
+                return _read_cache(self._cache_group, self._cache.__getitem__, url)
+            with _remembering_failures(self._failures, self._cache_group, url):
+                fetch_stats.count(self._cache_group, 'misses')
+                response = self._request(url)
+            _store_response(self._cache, url, response.data, response.headers)
+        return response.data
+
+    def fetch_cached_buffer(self, url):
+        '''
+        Like fetch_cached, but returns a read-only buffer instead of bytes,
+        which is memory-mapped from the cache where possible. On a cache miss,
+        the response is streamed into the cache rather than held in memory.
+        '''
+        if self._revalidate:
+            self.fetch_cached(url)
+        elif url in self._cache:
+            return _read_cache(self._cache_group, self._cache.get_buffer, url)
+        else:
+            self._stream_into_cache(url)
+        return self._cache.get_buffer(url)
+
+    def fetch_cached_file(self, url):
+        '''
+        Like fetch_cached, but returns the name of the cache file containing
+        the response body, for consumers that can read files directly. On a
+        cache miss, the response is streamed into the cache rather than held
+        in memory. Only works for cache groups that store one uncompressed file
+        per entry.
+        '''
+        if not isinstance(self._cache, Cache):
+            raise ValueError(f'Cache group {self._cache_group} does not store plain files')
+        if self._revalidate:
+            self.fetch_cached(url)
+        elif url in self._cache:
+            fetch_stats.count(self._cache_group, 'hits')
+            fetch_stats.count(self._cache_group, 'bytes_read', os.path.getsize(self._cache.file_for_key(url)))
+        else:
+            self._stream_into_cache(url)
+        return self._cache.file_for_key(url)
+
+    def fetch_cached_prefix_file(self, url, num_bytes):
+        '''
+        Like fetch_cached_file, but if the response is not in the cache in
+        full, only makes sure that at least its first `num_bytes` bytes are,
+        using a Range request. A cached prefix that is too short is extended.
+        Returns a `(file_name, complete)` tuple, where `complete` indicates
+        whether the file contains the entire response body.
+        '''
+        if not isinstance(self._cache, Cache):
+            raise ValueError(f'Cache group {self._cache_group} does not store plain files')
+        if url in self._cache:
+            return self.fetch_cached_file(url), True
+        length = _prefix_length(self._cache, url)
+        if length >= num_bytes:
+            fetch_stats.count(self._cache_group, 'hits')
+            fetch_stats.count(self._cache_group, 'bytes_read', length)
+            return self._cache.file_for_key(prefix_key(url)), False
+        with self._locks.lock(url):
+            length = _prefix_length(self._cache, url)
+            if url in self._cache or length >= num_bytes:
+                fetch_stats.count(self._cache_group, 'coalesced')
+            else:
+                with _remembering_failures(self._failures, self._cache_group, url):
+                    fetch_stats.count(self._cache_group, 'misses')
+                    response = self._request(url, _range_headers(length, num_bytes))
+                _store_prefix(self._cache, url, length, response.status, response.headers, response.data)
+        if url in self._cache:
+            return self._cache.file_for_key(url), True
+        return self._cache.file_for_key(prefix_key(url)), False
 
     def fetch_uncached(self, url):
         '''
         Fetches the URL response through a HTTP(S) GET request.
         '''
-        # Save a redirect from http to https, which matters for performance,
-        # because the server does not support keepalive.
-        if url.startswith('//'):
-            url = 'https:' + url
-        logging.debug(f'Fetching {url}')
-        try:
-            response = self._http.request(
-                'GET', url,
-                timeout=urllib3.Timeout(
-                    connect=20.0,
-                    read=60.0),
-                retries=urllib3.Retry(
-                    total=7,
-                    # Retry 400 errors (Bad Request). These spuriously happen in
-                    # the xeno-canto API, perhaps due to a bug.
-                    status_forcelist=[400] + list(range(500, 600)),
-                    backoff_factor=0.1,
-                    raise_on_status=True))
-        except urllib3.exceptions.HTTPError as ex:
-            raise FetchError(url) from ex
+        return self._request(url).data
+
+    def _stream_into_cache(self, url):
+        with self._locks.lock(url):
+            if url in self._cache:
+                logging.debug(f'{url} was fetched concurrently into {self._cache_group} cache')
+                fetch_stats.count(self._cache_group, 'coalesced')
+                return
+            with _remembering_failures(self._failures, self._cache_group, url):
+                fetch_stats.count(self._cache_group, 'misses')
+                response = self._request(url, read_body=lambda response: self._cache.write_stream(
+                    url, _count_download(self._cache_group, response.stream(_STREAM_CHUNK_SIZE))))
+            _store_validators(self._cache, url, response.headers)
+
+    def _fetch_revalidated(self, url):
+        headers = _conditional_headers(self._cache, url)
+        response = self._request(url, headers)
+        if response.status == 304:
+            logging.debug(f'{url} is unchanged in {self._cache_group} cache')
+            return _read_cache(self._cache_group, self._cache.__getitem__, url)
+        fetch_stats.count(self._cache_group, 'misses')
+        if headers is None and response.data == self._cache[url]:
+            # No validators, so we had to fetch it in full, but at least we
+            # can avoid rewriting it.
+            _store_validators(self._cache, url, response.headers)
+            return response.data
+        logging.debug(f'{url} has changed; updating {self._cache_group} cache')
+        _store_response(self._cache, url, response.data, response.headers)
         return response.data
 
+    def _request(self, url, headers=None, read_body=None):
+        '''
+        Makes a GET request, retrying as needed, and returns the response. Its
+        body is read into memory, or if `read_body` is given, passed to it by
+        calling it with the unread response, for example to stream it into the
+        cache. Either way, the body is read while holding the rate limiter
+        slot, and the request is retried if reading it fails; `read_body` must
+        therefore not leave anything behind if it raises.
+        '''
+        # Limit by the original host, even when using a stand-in server.
+        limiter = rate_limiter.for_host(urllib.parse.urlsplit(_absolute_url(url)).hostname)
+        url = _request_url(self._cache_group, url)
+        last_exception = None
+        last_status = None
+        with fetch_stats.timed(self._cache_group, 'http'):
+            for attempt in range(_NUM_RETRIES + 1):
+                # Same backoff schedule as urllib3.Retry, on top of any waiting
+                # for the rate limiter.
+                if attempt >= 1:
+                    fetch_stats.count(self._cache_group, 'retries')
+                if attempt >= 2:
+                    time.sleep(_BACKOFF_FACTOR * 2**(attempt - 1))
+                logging.debug(f'Fetching {url}')
+                with limiter.slot() as outcome:
+                    fetch_stats.count(self._cache_group, 'rate_limit_wait_ms', 1000 * outcome.wait_time)
+                    request_time = time.time()
+                    try:
+                        response = self._http.request(
+                            'GET', url,
+                            headers={**self._headers, **(headers or {})},
+                            preload_content=False,
+                            # Otherwise a body cut off when streaming it
+                            # looks like a complete one.
+                            enforce_content_length=True,
+                            timeout=urllib3.Timeout(
+                                connect=20.0,
+                                read=60.0),
+                            retries=_NO_RETRIES)
+                    except urllib3.exceptions.HTTPError as ex:
+                        logging.debug(f'Error fetching {url}: {ex!r}')
+                        last_exception = ex
+                        last_status = None
+                        continue
+                    outcome.latency = time.time() - request_time
+                    outcome.status = response.status
+                    outcome.retry_after = rate_limiter.parse_retry_after(response.headers.get('Retry-After'))
+                    fetch_stats.count_status(self._cache_group, response.status)
+                    success = response.status not in _RETRY_STATUSES and response.status not in _FAILURE_STATUSES
+                    try:
+                        if success and read_body:
+                            read_body(response)
+                        else:
+                            # Error bodies are small; reading them lets the
+                            # connection be reused.
+                            fetch_stats.count(self._cache_group, 'bytes_downloaded', len(response.data))
+                    except urllib3.exceptions.HTTPError as ex:
+                        # The connection broke or stalled while reading the
+                        # body.
+                        logging.debug(f'Error reading body of {url}: {ex!r}')
+                        outcome.status = None
+                        last_exception = ex
+                        last_status = None
+                        continue
+                    finally:
+                        response.release_conn()
+                if success:
+                    return response
+                logging.debug(f'Got status {response.status} for {url}')
+                last_exception = None
+                last_status = response.status
+                if response.status in _FAILURE_STATUSES:
+                    break
+        fetch_stats.count(self._cache_group, 'errors')
+        raise FetchError(url, last_status) from last_exception
+
     def cache_file_name(self, url):
         return self._cache.file_for_key(url)
+
+
+class AsyncFetcher:
+    '''
+    Cached HTTP fetcher based on asyncio, which can keep thousands of requests
+    in flight from a single thread. Requests to each host wait for the
+    rate_limiter like those of Fetcher; in addition, a semaphore per host keeps
+    the requests beyond its concurrency limit from polling the limiter. That
+    limit can be lowered for this fetcher by passing a dict from host name to
+    number of requests as `max_requests_per_host`.
+
+    It uses the same cache layout as Fetcher, so both can be used on the same
+    cache group, even at the same time, and it supports the same `revalidate`
+    mode, coalescing of concurrent misses and negative caching. Must be used
+    as an async context manager:
+
+        async with AsyncFetcher('xc_sonograms_small') as f:
+            data = await f.fetch_cached(url)
+    '''
+
+    def __init__(self, cache_group, max_requests_per_host=None, clear_cache=False, revalidate=False):
+        self._cache_group = cache_group
+        self._cache = open_cache(cache_group)
+        if clear_cache:
+            self._cache.clear()
+        self._locks = _KeyLocks(os.path.join(CACHE_DIR, cache_group, 'locks'))
+        self._failures = NegativeCache(os.path.join(CACHE_DIR, cache_group))
+        self._revalidate = revalidate
+        self._in_flight = {}
+        self._max_requests_per_host = max_requests_per_host or {}
+        self._host_semaphores = {}
+        self._session = None
+
+    async def __aenter__(self):
+        # aiohttp asks for compressed responses and decodes them by default.
+        self._session = aiohttp.ClientSession(
+            # We do our own limiting per host; the connector should not limit
+            # the total.
+            connector=aiohttp.TCPConnector(limit=0),
+            timeout=aiohttp.ClientTimeout(total=300, connect=20.0, sock_read=60.0))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    async def fetch_cached(self, url):
+        '''
+        Returns the URL response body from cache if possible, fetching and
+        storing it if needed.
+        '''
+        loop = asyncio.get_running_loop()
+        if await self._in_cache(url):
+            if self._revalidate:
+                return await self._fetch_revalidated(url)
+            logging.debug(f'Returning {url} from {self._cache_group} cache')
+            return await loop.run_in_executor(None, _read_cache, self._cache_group, self._cache.__getitem__, url)
+        # Coalesce with a request for the same URL from this process...
+        in_flight = self._in_flight.get(url)
+        if in_flight:
+            fetch_stats.count(self._cache_group, 'coalesced')
+            return await asyncio.shield(in_flight)
+        in_flight = loop.create_task(self._fetch_locked(url))
+        self._in_flight[url] = in_flight
+        in_flight.add_done_callback(lambda _: self._in_flight.pop(url, None))
+        return await asyncio.shield(in_flight)
+
+    async def _fetch_locked(self, url):
+        # ... or from another process.
+        loop = asyncio.get_running_loop()
+        async with self._locks.lock_async(url):
+            if await self._in_cache(url):
+                logging.debug(f'{url} was fetched concurrently into {self._cache_group} cache')
+                fetch_stats.count(self._cache_group, 'coalesced')
+                return await loop.run_in_executor(None, _read_cache, self._cache_group, self._cache.__getitem__, url)
+            with _remembering_failures(self._failures, self._cache_group, url):
+                fetch_stats.count(self._cache_group, 'misses')
+                _status, headers, data = await self._request(url)
+            await loop.run_in_executor(None, _store_response, self._cache, url, data, headers)
+        return data
+
+    async def ensure_cached(self, url):
+        '''
+        Like fetch_cached, but does not read the response body from the cache
+        if it is already present (and does not need revalidation), and returns
+        nothing.
+        '''
+        if self._revalidate or not await self._in_cache(url):
+            await self.fetch_cached(url)
+
+    async def fetch_cached_prefix(self, url, num_bytes):
+        '''
+        Returns a `(data, complete)` tuple, where `data` is at least the first
+        `num_bytes` bytes of the response body (or all of it), fetched using a
+        Range request and cached if needed, and `complete` indicates whether
+        it is the entire body. See Fetcher.fetch_cached_prefix_file.
+        '''
+        loop = asyncio.get_running_loop()
+        if await self._in_cache(url):
+            return await self.fetch_cached(url), True
+        length = await loop.run_in_executor(None, _prefix_length, self._cache, url)
+        if length < num_bytes:
+            async with self._locks.lock_async(url):
+                length = await loop.run_in_executor(None, _prefix_length, self._cache, url)
+                if length >= num_bytes or await self._in_cache(url):
+                    fetch_stats.count(self._cache_group, 'coalesced')
+                else:
+                    with _remembering_failures(self._failures, self._cache_group, url):
+                        fetch_stats.count(self._cache_group, 'misses')
+                        status, headers, data = await self._request(url, _range_headers(length, num_bytes))
+                    await loop.run_in_executor(None, _store_prefix, self._cache, url, length, status, headers, data)
+            if await self._in_cache(url):
+                return await self.fetch_cached(url), True
+        data = await loop.run_in_executor(
+            None, _read_cache, self._cache_group, self._cache.__getitem__, prefix_key(url))
+        return data, False
+
+    async def fetch_uncached(self, url):
+        '''
+        Fetches the URL response through a HTTP(S) GET request, retrying in the
+        same way as Fetcher does.
+        '''
+        _status, _headers, data = await self._request(url)
+        return data
+
+    async def _in_cache(self, url):
+        # Checking for a file, or querying a packed cache index, can block.
+        return await asyncio.get_running_loop().run_in_executor(None, self._cache.__contains__, url)
+
+    async def _fetch_revalidated(self, url):
+        loop = asyncio.get_running_loop()
+        request_headers = await loop.run_in_executor(None, _conditional_headers, self._cache, url)
+        status, headers, data = await self._request(url, request_headers)
+        if status == 304:
+            logging.debug(f'{url} is unchanged in {self._cache_group} cache')
+            return await loop.run_in_executor(None, _read_cache, self._cache_group, self._cache.__getitem__, url)
+        fetch_stats.count(self._cache_group, 'misses')
+        if request_headers is None and data == await loop.run_in_executor(None, self._cache.__getitem__, url):
+            await loop.run_in_executor(None, _store_validators, self._cache, url, headers)
+            return data
+        logging.debug(f'{url} has changed; updating {self._cache_group} cache')
+        await loop.run_in_executor(None, _store_response, self._cache, url, data, headers)
+        return data
+
+    async def _request(self, url, headers=None):
+        '''
+        Returns a `(status, headers, body)` tuple.
+        '''
+        # Limit by the original host, even when using a stand-in server.
+        host = urllib.parse.urlsplit(_absolute_url(url)).hostname
+        url = _request_url(self._cache_group, url)
+        semaphore = self._host_semaphore(host)
+        limiter = rate_limiter.for_host(host)
+        last_exception = None
+        last_status = None
+        with fetch_stats.timed(self._cache_group, 'http'):
+            for attempt in range(_NUM_RETRIES + 1):
+                # Same backoff schedule as urllib3.Retry.
+                if attempt >= 1:
+                    fetch_stats.count(self._cache_group, 'retries')
+                if attempt >= 2:
+                    await asyncio.sleep(_BACKOFF_FACTOR * 2**(attempt - 1))
+                logging.debug(f'Fetching {url}')
+                status = None
+                async with semaphore:
+                    async with limiter.slot_async() as outcome:
+                        request_time = time.time()
+                        try:
+                            async with self._session.get(url, headers=headers) as response:
+                                outcome.latency = time.time() - request_time
+                                data = await response.read()
+                                status = response.status
+                                response_headers = response.headers
+                        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                            logging.debug(f'Error fetching {url}: {ex!r}')
+                            last_exception = ex
+                            last_status = None
+                        else:
+                            outcome.status = status
+                            outcome.retry_after = rate_limiter.parse_retry_after(response_headers.get('Retry-After'))
+                fetch_stats.count(self._cache_group, 'rate_limit_wait_ms', 1000 * outcome.wait_time)
+                if status is None:
+                    continue
+                fetch_stats.count_status(self._cache_group, status)
+                fetch_stats.count(self._cache_group, 'bytes_downloaded', len(data))
+                if status not in _RETRY_STATUSES and status not in _FAILURE_STATUSES:
+                    return status, response_headers, data
+                logging.debug(f'Got status {status} for {url}')
+                last_exception = None
+                last_status = status
+                if status in _FAILURE_STATUSES:
+                    break
+        fetch_stats.count(self._cache_group, 'errors')
+        raise FetchError(url, last_status) from last_exception
+
+    def _host_semaphore(self, host):
+        semaphore = self._host_semaphores.get(host)
+        if not semaphore:
+            semaphore = asyncio.Semaphore(
+                self._max_requests_per_host.get(host, rate_limiter.max_concurrency(host)))
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+
+def prefetch(cache_group, urls, max_requests_per_host=None, max_in_flight=1000, prefix_size=None):
+    '''
+    Makes sure that all the given URLs are in the cache, fetching the missing
+    ones concurrently using an AsyncFetcher on a background thread. Yields a
+    `(url, error)` tuple for every URL as soon as it is done, where `error` is
+    a FetchError or None, so callers can report progress.
+
+    This is meant for network-bound stages: prefetch everything from a single
+    process first, then let CPU-bound worker processes read from the cache.
+
+    If `prefix_size` is given, only a prefix of each response is fetched
+    (see Fetcher.fetch_cached_prefix_file). It is called with the first
+    bytes of the response, and should return how many bytes are needed.
+    '''
+    urls = list(urls)
+    results = queue.Queue()
+    done = object()
+
+    async def fetch_all():
+        pending = iter(urls)
+        async with AsyncFetcher(cache_group, max_requests_per_host) as f:
+            async def worker():
+                for url in pending:
+                    try:
+                        if prefix_size:
+                            head, complete = await f.fetch_cached_prefix(url, PREFIX_HEAD_SIZE)
+                            if not complete:
+                                await f.fetch_cached_prefix(url, prefix_size(head))
+                        else:
+                            await f.ensure_cached(url)
+                    except FetchError as ex:
+                        results.put((url, ex))
+                    else:
+                        results.put((url, None))
+            await asyncio.gather(*(worker() for _ in range(min(max_in_flight, len(urls)))))
+
+    def run():
+        try:
+            asyncio.run(fetch_all())
+        except BaseException as ex: # pylint: disable=broad-except
+            results.put((done, ex))
+        else:
+            results.put((done, None))
+
+    threading.Thread(target=run, name=f'prefetch-{cache_group}', daemon=True).start()
+    while True:
+        url, error = results.get()
+        if url is done:
+            if error:
+                raise error
+            return
+        yield url, error
+
+
+def _request_url(cache_group, url):
+    '''
+    Returns the URL to actually send the request for the given URL to. Raises
+    FetchError in offline mode.
+    '''
+    if _offline:
+        logging.debug(f'Not fetching {url} in offline mode')
+        fetch_stats.count(cache_group, 'errors')
+        raise FetchError(url)
+    url = _absolute_url(url)
+    if _standin_server_url:
+        split = urllib.parse.urlsplit(url)
+        url = _standin_server_url.rstrip('/') + '/' + split.netloc + urllib.parse.urlunsplit(
+            ('', '', split.path, split.query, ''))
+    return url
+
+
+def _absolute_url(url):
+    # Save a redirect from http to https, which matters for performance,
+    # because the server does not support keepalive.
+    if url.startswith('//'):
+        return 'https:' + url
+    return url
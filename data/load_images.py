@@ -11,8 +11,10 @@ import urllib.parse
 
 from bs4 import BeautifulSoup, NavigableString
 
-import fetcher
+import fetch_service
+import fetch_stats
 import progress
+import species_counts
 from images import Image
 from species import Species
 
@@ -166,7 +168,7 @@ def _process_image(species):
 
     global _fetcher # pylint: disable=global-statement
     if not _fetcher:
-        _fetcher = fetcher.Fetcher('wp_pages', pool_size=1)
+        _fetcher = fetch_service.worker_fetcher('wp_pages', revalidate=_args.revalidate_images_cache)
 
     scientific_name = species.scientific_name
 
@@ -231,8 +233,12 @@ _args = None
 def add_args(parser):
     parser.add_argument(
         '--image_load_jobs', type=int, default=8,
-        help='Parallelism for loading and resizing images; '
-        'too high may make the Wikipedia servers angry!')
+        help='Parallelism for loading and resizing images; fetches are '
+        'rate limited automatically to keep the Wikipedia servers happy')
+    parser.add_argument(
+        '--revalidate_images_cache', action='store_true',
+        help='Check cached Wikipedia pages and image metadata (including licenses) for changes '
+        'using conditional requests, and update only those that changed')
 
 
 def main(args, session):
@@ -251,7 +257,9 @@ def main(args, session):
     with multiprocessing.pool.Pool(args.image_load_jobs) as pool:
         signal.signal(signal.SIGINT, original_sigint_handler)
         for image in progress.percent(
-                pool.imap(_process_image, species_list),
+                fetch_stats.pool_imap(pool, _process_image, species_list),
                 len(species_list)):
             if image:
                 session.add(image)
+
+    species_counts.refresh(session)
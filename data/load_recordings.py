@@ -9,6 +9,17 @@ time), but does not order the results in any meaningful way, or offer anything
 like page tokens. So if recordings are added while the script is running, the
 pages might shuffle around. The result is that we may miss some recordings, or
 get duplicates (which we filter out).
+
+With `--incremental_recordings`, only recordings with ids above the highest one
+seen in a previous run are fetched, and added to the existing ones. This takes
+minutes rather than an hour, but does not pick up changes to older recordings.
+
+With `--recordings_crawl` set to something other than `all`, recordings are
+instead fetched with a separate query per species, in parallel. The results of
+these are much smaller, so they don't shuffle around, and the crawl can be
+limited to the species we might actually select. Each species is committed to
+the database as soon as it's done, so if the crawl is interrupted, restarting
+it picks up where it left off.
 '''
 
 import datetime
@@ -16,10 +27,47 @@ import itertools
 import json
 import logging
 import multiprocessing.pool
+import signal
+import threading
+import time
+
+import sqlalchemy
 
 import progress
+import species_counts
+import state
 from fetcher import Fetcher
 from recordings import Recording
+from species import Species, SelectedSpecies
+
+
+# Key in the state table of the highest xeno-canto id and upload date seen so
+# far, as a dict with keys `xc_id` and `upload_date`.
+_HIGH_WATER_MARK_KEY = 'load_recordings.high_water_mark'
+
+# Keys in the state table of the current crawl by species, and of the species
+# that it already completed.
+_CRAWL_KEY = 'load_recordings.crawl'
+_CRAWL_SHARD_KEY_PREFIX = 'load_recordings.crawl_shard:'
+
+# Maximum number of pages that have been fetched, or are being fetched, but
+# have not been written to the database yet. This keeps fetching from running
+# far ahead of parsing and writing.
+_MAX_PAGES_IN_FLIGHT = 64
+# Number of recordings to insert in a single statement.
+_INSERT_BATCH_SIZE = 10000
+# Number of recording ids to look up in a single query, well below SQLite's
+# limit on the number of variables.
+_LOOKUP_BATCH_SIZE = 500
+
+# Columns of the rows returned by _parse_recording, in order.
+_COLUMNS = [
+    'recording_id', 'source', 'scientific_name', 'genus', 'species', 'subspecies', 'common_name_en',
+    'recordist', 'country', 'location', 'latitude', 'longitude', 'altitude', 'type', 'url',
+    'audio_url', 'audio_file_name', 'sonogram_url_small', 'sonogram_url_medium', 'sonogram_url_large',
+    'sonogram_url_full', 'license_url', 'quality', 'length_seconds', 'date_time', 'upload_date',
+    'background_species', 'remarks', 'bird_seen', 'playback_used',
+]
 
 
 class XcQuery:
@@ -35,16 +83,24 @@ class XcQuery:
         '''
         Fetches the given page (1-based) and returns the parsed JSON.
         '''
+        return _load_page(self.fetch_page_data(page_number))
+
+    def fetch_page_data(self, page_number):
+        '''
+        Fetches the given page (1-based) and returns it unparsed, to be passed
+        to _load_page.
+        '''
         url = f'https://www.xeno-canto.org/api/2/recordings?query={self._query}&page={page_number}'
-        data = self._fetcher.fetch_cached(url)
-        # We previously stored parsed JSON in the cache, rather than raw
-        # response bytes. These two lines make it backwards compatible and
-        # avoid an hour-long fetch. It can be removed if we ever end up
-        # clearing the cache.
-        if isinstance(data, dict):
-            return data
-        parsed_response = json.loads(data)
-        return parsed_response
+        return self._fetcher.fetch_cached(url)
+
+
+def _load_page(data):
+    # We previously stored parsed JSON in the cache, rather than raw response
+    # bytes. These two lines make it backwards compatible and avoid an
+    # hour-long fetch. It can be removed if we ever end up clearing the cache.
+    if isinstance(data, dict):
+        return data
+    return json.loads(data)
 
 
 def _parse_float(f):
@@ -77,43 +133,57 @@ def _parse_date_time(date, time):
 
 def _parse_recording(r):
     '''
-    Creates a recording from the parsed JSON object as returned by the
-    xeno-canto API.
+    Creates a row for the recordings table, with the values in the order of
+    _COLUMNS, from the parsed JSON object as returned by the xeno-canto API.
     '''
-    return Recording(
-        recording_id='xc:' + r['id'],
-        source='xc',
-        scientific_name=r['gen'] + ' ' + r['sp'],
-        genus=r['gen'],
-        species=r['sp'],
-        subspecies=r['ssp'],
-        common_name_en=r['en'],
-        recordist=r['rec'],
-        country=r['cnt'],
-        location=r['loc'],
-        latitude=_parse_float(r['lat']),
-        longitude=_parse_float(r['lng']),
-        altitude=r['alt'],
-        type=r['type'],
-        url=r['url'],
-        audio_url=r['file'],
-        audio_file_name=r['file-name'],
-        sonogram_url_small=r['sono']['small'],
-        sonogram_url_medium=r['sono']['med'],
-        sonogram_url_large=r['sono']['large'],
-        sonogram_url_full=r['sono']['full'],
-        license_url=r['lic'],
-        quality=r['q'],
-        length_seconds=_parse_duration(r['length']),
-        date_time=_parse_date_time(r['date'], r['time']),
-        upload_date=datetime.date.fromisoformat(r['uploaded']),
-        background_species=list(filter(None, map(str.strip, r['also']))),
-        remarks=r['rmk'],
-        bird_seen=_parse_bool(r['bird-seen']),
-        playback_used=_parse_bool(r['playback-used']),
+    return (
+        'xc:' + r['id'],
+        'xc',
+        r['gen'] + ' ' + r['sp'],
+        r['gen'],
+        r['sp'],
+        r['ssp'],
+        r['en'],
+        r['rec'],
+        r['cnt'],
+        r['loc'],
+        _parse_float(r['lat']),
+        _parse_float(r['lng']),
+        r['alt'],
+        r['type'],
+        r['url'],
+        r['file'],
+        r['file-name'],
+        r['sono']['small'],
+        r['sono']['med'],
+        r['sono']['large'],
+        r['sono']['full'],
+        r['lic'],
+        r['q'],
+        _parse_duration(r['length']),
+        _parse_date_time(r['date'], r['time']),
+        datetime.date.fromisoformat(r['uploaded']),
+        list(filter(None, map(str.strip, r['also']))),
+        r['rmk'],
+        _parse_bool(r['bird-seen']),
+        _parse_bool(r['playback-used']),
     )
 
 
+def _parse_page(data):
+    '''
+    Entry point for parallel processing. Returns the rows for all recordings
+    on the page.
+    '''
+    page = _load_page(data)
+    try:
+        return [_parse_recording(r) for r in page['recordings']]
+    except Exception:
+        logging.error(f'Error parsing page:\n{json.dumps(page, indent="  ")}',
+                      exc_info=True)
+        raise
+
+
 def add_args(parser):
     parser.add_argument(
         '--start_xc_id', type=int, default=1,
@@ -125,34 +195,214 @@ def add_args(parser):
         '--clear_recordings_cache', action='store_true',
         help='Wipe the response cache and start from scratch')
     parser.add_argument(
-        '--recording_load_jobs', type=int, default=10,
-        help='Number of parallel fetches to run; do not set too high or else '
-        'the XenoCanto server might get upset!')
+        '--revalidate_recordings_cache', action='store_true',
+        help='Check cached responses for changes using conditional requests, '
+        'and update only those that changed')
+    parser.add_argument(
+        '--recording_load_jobs', type=int, default=16,
+        help='Maximum number of parallel fetches to run; the rate limiter '
+        'reduces this automatically if the xeno-canto server is struggling')
+    parser.add_argument(
+        '--recording_parse_jobs', type=int, default=4,
+        help='Number of parallel processes parsing the fetched pages')
+    parser.add_argument(
+        '--recordings_crawl', default='all',
+        choices=['all', 'species', 'candidate_species', 'selected_species'],
+        help='Fetch all recordings by id; or use a separate query for each species in the species table, '
+        'each candidate species (with at least --min_num_recordings recordings from a previous run), '
+        'or each species selected by a previous run. Crawls by species resume where they left off if '
+        'interrupted')
+    parser.add_argument(
+        '--incremental_recordings', action='store_true',
+        help='Keep existing recordings and only fetch those with an id above the highest one seen '
+        'in a previous run; does a full fetch if there was no previous run')
 
 
 def main(args, session):
-    logging.info('Deleting existing xeno-canto recordings')
-    session.query(Recording).filter(Recording.source == 'xc').delete()
+    if args.recordings_crawl != 'all':
+        if args.incremental_recordings:
+            raise ValueError('--incremental_recordings cannot be combined with a crawl by species')
+        _crawl_by_species(args, session)
+        return
+
+    high_water_mark = state.get_value(session, _HIGH_WATER_MARK_KEY)
+    incremental = args.incremental_recordings and high_water_mark is not None
+    start_xc_id = args.start_xc_id
+    if incremental:
+        start_xc_id = max(start_xc_id, high_water_mark['xc_id'] + 1)
+        logging.info(f'Fetching xeno-canto recordings from id {start_xc_id} '
+                     f'(last upload seen on {high_water_mark["upload_date"]})')
+    else:
+        if args.incremental_recordings:
+            logging.info('No previous run found, so doing a full fetch')
+        logging.info('Deleting existing xeno-canto recordings')
+        session.query(Recording).filter(Recording.source == 'xc').delete()
+        high_water_mark = {'xc_id': 0, 'upload_date': None}
 
     fetcher = Fetcher(cache_group='xc_api',
                       pool_size=args.recording_load_jobs,
-                      clear_cache=args.clear_recordings_cache)
-    query = XcQuery({'nr': f'{args.start_xc_id}-{args.end_xc_id}'}, fetcher)
-    first_page = query.fetch_page(1)
+                      clear_cache=args.clear_recordings_cache,
+                      # The same query was likely made by the previous
+                      # incremental run, so its cached response is stale.
+                      revalidate=args.revalidate_recordings_cache or incremental)
+    query = XcQuery({'nr': f'{start_xc_id}-{args.end_xc_id}'}, fetcher)
+    first_page_data = query.fetch_page_data(1)
+    first_page = _load_page(first_page_data)
     num_pages = first_page['numPages']
     num_recordings = int(first_page['numRecordings'])
     logging.info(f'Found {num_pages} pages, {num_recordings} recordings')
-    with multiprocessing.pool.ThreadPool(args.recording_load_jobs) as pool:
-        for page in progress.percent(
-                itertools.chain([first_page], pool.imap(query.fetch_page, range(2, num_pages + 1))),
-                num_pages):
-            try:
-                # Allow replacements in case the API shifts pages around
-                # (it seems to do that, probably when new recordings are
-                # added during the run).
-                recordings = [_parse_recording(r) for r in page['recordings']]
-                session.bulk_save_objects_with_replace(recordings)
-            except Exception:
-                logging.error(f'Error parsing page:\n{json.dumps(page, indent="  ")}',
-                              exc_info=True)
-                raise
+
+    # Pages are fetched on a thread pool, parsed on a process pool, and
+    # written in batches on this thread, all at the same time.
+    in_flight = threading.Semaphore(_MAX_PAGES_IN_FLIGHT)
+    def page_numbers():
+        for page_number in range(2, num_pages + 1):
+            in_flight.acquire() # pylint: disable=consider-using-with
+            yield page_number
+    in_flight.acquire() # pylint: disable=consider-using-with
+    start_time = time.monotonic()
+    num_written = 0
+    batch = []
+    scientific_names = set()
+    # https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python#35134329
+    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with multiprocessing.pool.Pool(args.recording_parse_jobs) as parse_pool, \
+            multiprocessing.pool.ThreadPool(args.recording_load_jobs) as fetch_pool:
+        signal.signal(signal.SIGINT, original_sigint_handler)
+        pages_data = itertools.chain([first_page_data], fetch_pool.imap(query.fetch_page_data, page_numbers()))
+        for rows in progress.percent(parse_pool.imap(_parse_page, pages_data), num_pages):
+            in_flight.release()
+            batch.extend(dict(zip(_COLUMNS, row)) for row in rows)
+            high_water_mark = _update_high_water_mark(high_water_mark, rows)
+            if len(batch) >= _INSERT_BATCH_SIZE:
+                scientific_names |= _write_batch(session, batch)
+                num_written += len(batch)
+                batch = []
+    scientific_names |= _write_batch(session, batch)
+    num_written += len(batch)
+    elapsed = time.monotonic() - start_time
+    logging.info(f'Loaded {num_written} recordings in {elapsed:.1f} seconds '
+                 f'({num_written / max(elapsed, 1e-3):.0f} recordings per second)')
+
+    # These are committed together with the recordings, so they never get
+    # ahead of them.
+    species_counts.refresh(session, scientific_names if incremental else None)
+    state.set_value(session, _HIGH_WATER_MARK_KEY, high_water_mark)
+
+
+def _write_batch(session, rows):
+    '''
+    Writes the rows, and returns the scientific names whose species counts
+    changed: those of the rows, and those of any recordings they replaced.
+    '''
+    scientific_names = {row['scientific_name'] for row in rows}
+    recording_ids = [row['recording_id'] for row in rows]
+    for start in range(0, len(recording_ids), _LOOKUP_BATCH_SIZE):
+        scientific_names.update(
+            scientific_name
+            for scientific_name, in session.query(Recording.scientific_name)
+            .filter(Recording.recording_id.in_(recording_ids[start:start + _LOOKUP_BATCH_SIZE])))
+    # Allow replacements in case the API shifts pages around (it seems to do
+    # that, probably when new recordings are added during the run), and to
+    # update recordings from a previous incremental run.
+    session.insert_or_replace(Recording.__table__, rows)
+    return scientific_names
+
+
+def _update_high_water_mark(high_water_mark, rows):
+    xc_id = high_water_mark['xc_id']
+    upload_date = high_water_mark['upload_date']
+    id_index = _COLUMNS.index('recording_id')
+    upload_date_index = _COLUMNS.index('upload_date')
+    for row in rows:
+        xc_id = max(xc_id, int(row[id_index][len('xc:'):]))
+        if not upload_date or row[upload_date_index].isoformat() > upload_date:
+            upload_date = row[upload_date_index].isoformat()
+    return {'xc_id': xc_id, 'upload_date': upload_date}
+
+
+def _crawl_by_species(args, session):
+    crawl = state.get_value(session, _CRAWL_KEY)
+    if crawl and not crawl['finished'] and crawl['mode'] == args.recordings_crawl:
+        logging.info(f'Resuming crawl by {args.recordings_crawl} started at {crawl["started_at"]}')
+    else:
+        crawl = {
+            'mode': args.recordings_crawl,
+            'started_at': datetime.datetime.now().isoformat(),
+            'finished': False,
+        }
+        state.set_value(session, _CRAWL_KEY, crawl)
+        session.commit()
+    completed_shards = set(
+        scientific_name
+        for scientific_name, shard in state.get_values_with_prefix(session, _CRAWL_SHARD_KEY_PREFIX).items()
+        if shard['crawl'] == crawl['started_at'])
+
+    shards = sorted(set(_crawl_species(args, session)) - completed_shards)
+    logging.info(f'Crawling {len(shards)} species ({len(completed_shards)} already done)')
+
+    # Each species is fetched in full on a thread of the pool, and then
+    # parsed on the process pool and written on this thread.
+    fetcher = Fetcher(cache_group='xc_api',
+                      pool_size=args.recording_load_jobs,
+                      clear_cache=args.clear_recordings_cache,
+                      # Responses cached by a previous crawl are stale.
+                      revalidate=True)
+    in_flight = threading.Semaphore(_MAX_PAGES_IN_FLIGHT)
+    def queries():
+        for scientific_name in shards:
+            in_flight.acquire() # pylint: disable=consider-using-with
+            genus, species = scientific_name.split(' ', 1)
+            yield scientific_name, XcQuery({'gen': genus, 'sp': species}, fetcher)
+    start_time = time.monotonic()
+    num_written = 0
+    # https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python#35134329
+    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with multiprocessing.pool.Pool(args.recording_parse_jobs) as parse_pool, \
+            multiprocessing.pool.ThreadPool(args.recording_load_jobs) as fetch_pool:
+        signal.signal(signal.SIGINT, original_sigint_handler)
+        for scientific_name, pages_data in progress.percent(
+                fetch_pool.imap_unordered(_fetch_shard, queries()), len(shards)):
+            in_flight.release()
+            rows = [row for page_rows in parse_pool.map(_parse_page, pages_data) for row in page_rows]
+            session.query(Recording)\
+                .filter(Recording.source == 'xc', Recording.scientific_name == scientific_name)\
+                .delete(synchronize_session=False)
+            species_counts.refresh(
+                session, {scientific_name, *_write_batch(session, [dict(zip(_COLUMNS, row)) for row in rows])})
+            num_written += len(rows)
+            state.set_value(session, _CRAWL_SHARD_KEY_PREFIX + scientific_name,
+                            {'crawl': crawl['started_at'], 'num_recordings': len(rows)})
+            session.commit()
+    elapsed = time.monotonic() - start_time
+    logging.info(f'Loaded {num_written} recordings in {elapsed:.1f} seconds '
+                 f'({num_written / max(elapsed, 1e-3):.0f} recordings per second)')
+
+    state.set_value(session, _CRAWL_KEY, {**crawl, 'finished': True})
+
+
+def _crawl_species(args, session):
+    '''
+    Returns the scientific names of the species to crawl.
+    '''
+    if args.recordings_crawl == 'species':
+        query = session.query(Species.scientific_name)
+    elif args.recordings_crawl == 'candidate_species':
+        query = session.query(Recording.scientific_name)\
+            .filter(Recording.source == 'xc')\
+            .group_by(Recording.scientific_name)\
+            .having(sqlalchemy.func.count() >= args.min_num_recordings)
+    elif args.recordings_crawl == 'selected_species':
+        query = session.query(Species.scientific_name).join(SelectedSpecies)
+    return [scientific_name for scientific_name, in query if ' ' in scientific_name]
+
+
+def _fetch_shard(scientific_name_and_query):
+    '''
+    Fetches all pages for a single species, and returns the scientific name
+    and the unparsed pages.
+    '''
+    scientific_name, query = scientific_name_and_query
+    first_page_data = query.fetch_page_data(1)
+    num_pages = _load_page(first_page_data)['numPages']
+    return scientific_name, [first_page_data] + [query.fetch_page_data(n) for n in range(2, num_pages + 1)]
@@ -14,19 +14,33 @@ here.
 '''
 
 import csv
+import hashlib
+import io
 import json
 import logging
+import multiprocessing.pool
+import os
 import os.path
 import math
+import signal
 
 import progress
+import state
 from species import Species
-from regions import Region
+from regions import Region, RegionSpeciesWeight
 
 
 _SIZE_LAT = 1.0
 _SIZE_LON = 1.0
 
+# Key in the state table of the hashes of the inputs of the last load, as a
+# dict with keys `csv_sha256` and `species_mapping_sha256`.
+_SOURCE_HASHES_KEY = 'load_regions.source_hashes'
+
+# Number of chunks to split the CSV file into per job, so that jobs that
+# finish early can pick up more work.
+_CHUNKS_PER_JOB = 4
+
 
 def _round_down(x, multiple_of):
     return math.floor(x / multiple_of) * multiple_of
@@ -37,55 +51,144 @@ def add_args(parser):
         '--ebd_regions_file',
         default=os.path.join(os.path.dirname(__file__), 'sources', 'ebd_regions.csv'),
         help='Path to CSV file containing eBird observation data by region')
+    parser.add_argument(
+        '--region_load_jobs', type=int, default=8,
+        help='Number of parallel processes parsing the regions file')
+    parser.add_argument(
+        '--reload_regions', action='store_true',
+        help='Load regions even if the regions file and the species have not changed since the last load')
 
 
-def main(args, session):
-    logging.info('Deleting existing regions')
-    session.query(Region).delete()
+def _hash_file(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _chunk_ranges(file_name, num_chunks):
+    '''
+    Splits the file, after the header line, into byte ranges of roughly equal
+    size that start and end on line boundaries. This assumes that no field
+    contains a newline, which is true for files written by ebd_aggregator.
+    Returns the header line and a list of `(start, end)` tuples.
+    '''
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        header = f.readline()
+        boundaries = [f.tell()]
+        for i in range(1, num_chunks):
+            f.seek(max(boundaries[-1], i * file_size // num_chunks))
+            f.readline()
+            boundaries.append(min(f.tell(), file_size))
+        boundaries.append(file_size)
+    ranges = [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+    return header, ranges
+
+
+_clements_to_species_id = None
+
+
+def _init_worker(clements_to_species_id):
+    global _clements_to_species_id # pylint: disable=global-statement
+    _clements_to_species_id = clements_to_species_id
 
+
+def _load_chunk(file_name_header_and_range):
+    '''
+    Entry point for parallel processing. Returns the rows for the regions and
+    region_species_weights tables for the regions in the given byte range of
+    the file, and the set of scientific names that could not be mapped.
+    '''
+    file_name, header, (start, end) = file_name_header_and_range
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    region_rows = []
+    weight_rows = []
+    unknown_scientific_names = set()
+    for row in csv.DictReader(io.StringIO((header + data).decode('utf-8'))):
+        region_id = int(row['region_id'])
+        centroid_lat = float(row['centroid_lat'])
+        centroid_lon = float(row['centroid_lon'])
+        observations_by_scientific_name = json.loads(row['observations_by_scientific_name'])
+        weight_by_species_id = {}
+        for scientific_name_clements, num_observations in observations_by_scientific_name.items():
+            species_id = _clements_to_species_id.get(scientific_name_clements)
+            if species_id is None:
+                unknown_scientific_names.add(scientific_name_clements)
+                continue
+            weight_by_species_id[species_id] = num_observations
+        region_rows.append({
+            'region_id': region_id,
+            'lat_start': centroid_lat - _SIZE_LAT / 2,
+            'lat_end': centroid_lat + _SIZE_LAT / 2,
+            'lon_start': centroid_lon - _SIZE_LON / 2,
+            'lon_end': centroid_lon + _SIZE_LON / 2,
+            'centroid_lat': centroid_lat,
+            'centroid_lon': centroid_lon,
+        })
+        weight_rows.extend(
+            {'region_id': region_id, 'species_id': species_id, 'weight': weight}
+            for species_id, weight in weight_by_species_id.items())
+    return region_rows, weight_rows, unknown_scientific_names
+
+
+def _should_warn(scientific_name_clements):
+    return ('/' not in scientific_name_clements # Uncertainties.
+            and 'sp.' not in scientific_name_clements.split(' ') # Only genus, not species.
+            and 'x' not in scientific_name_clements.split(' ') # Hybrids.
+            and 'undescribed' not in scientific_name_clements) # Undescribed forms.
+
+
+def main(args, session):
     logging.info('Loading species')
-    clements_to_ioc = {
-        species.scientific_name_clements: species.scientific_name
+    clements_to_species_id = {
+        species.scientific_name_clements: species.species_id
         for species in session.query(Species)
         if species.scientific_name_clements
     }
 
+    source_hashes = {
+        'csv_sha256': _hash_file(args.ebd_regions_file),
+        'species_mapping_sha256': hashlib.sha256(
+            json.dumps(sorted(clements_to_species_id.items())).encode('utf-8')).hexdigest(),
+    }
+    if (not args.reload_regions
+            and state.get_value(session, _SOURCE_HASHES_KEY) == source_hashes
+            and session.query(Region).count()):
+        logging.info('Regions file and species are unchanged since the last load, so not reloading')
+        return
+
+    logging.info('Deleting existing regions')
+    session.query(RegionSpeciesWeight).delete()
+    session.query(Region).delete()
+
     logging.info('Processing regions')
-    regions = []
+    header, ranges = _chunk_ranges(args.ebd_regions_file, args.region_load_jobs * _CHUNKS_PER_JOB)
+    num_regions = 0
     warned_scientific_names = set()
-    with open(args.ebd_regions_file, 'rt') as input_file:
-        # Hardcoding the CSV length here is awful but it's just for progress reporting anyway.
-        for row in progress.percent(csv.DictReader(input_file), 14835):
-            region_id = int(row['region_id'])
-            centroid_lat = float(row['centroid_lat'])
-            centroid_lon = float(row['centroid_lon'])
-            observations_by_scientific_name = json.loads(row['observations_by_scientific_name'])
-            species_weight_by_scientific_name = {}
-            for scientific_name_clements, num_observations in observations_by_scientific_name.items():
-                scientific_name = clements_to_ioc.get(scientific_name_clements)
-                if not scientific_name:
-                    if (scientific_name_clements not in warned_scientific_names
-                            and '/' not in scientific_name_clements # Uncertainties.
-                            and 'sp.' not in scientific_name_clements.split(' ') # Only genus, not species.
-                            and 'x' not in scientific_name_clements.split(' ') # Hybrids.
-                            and 'undescribed' not in scientific_name_clements # Undescribed forms.
-                       ):
-                        # This happens a fair bit; in the "IOC vs other lists"
-                        # these rows are typically reddish brown, indicating
-                        # "species not recognized by IOC".
-                        logging.warning(f'Scientific name {scientific_name_clements} not found '
-                                        '(probably recognized by Clements but not IOC)')
-                        warned_scientific_names.add(scientific_name_clements)
-                    continue
-                species_weight_by_scientific_name[scientific_name] = num_observations
-            regions.append(Region(
-                region_id=region_id,
-                lat_start=centroid_lat - _SIZE_LAT / 2,
-                lat_end=centroid_lat + _SIZE_LAT / 2,
-                lon_start=centroid_lon - _SIZE_LON / 2,
-                lon_end=centroid_lon + _SIZE_LON / 2,
-                centroid_lat=centroid_lat,
-                centroid_lon=centroid_lon,
-                species_weight_by_scientific_name=species_weight_by_scientific_name))
-
-    session.bulk_save_objects(regions)
+    # https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python#35134329
+    original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with multiprocessing.pool.Pool(args.region_load_jobs, _init_worker, (clements_to_species_id,)) as pool:
+        signal.signal(signal.SIGINT, original_sigint_handler)
+        for region_rows, weight_rows, unknown_scientific_names in progress.percent(
+                pool.imap_unordered(_load_chunk, [(args.ebd_regions_file, header, r) for r in ranges]),
+                len(ranges)):
+            if region_rows:
+                session.execute(Region.__table__.insert(), region_rows)
+            if weight_rows:
+                session.execute(RegionSpeciesWeight.__table__.insert(), weight_rows)
+            num_regions += len(region_rows)
+            for scientific_name_clements in sorted(unknown_scientific_names - warned_scientific_names):
+                if _should_warn(scientific_name_clements):
+                    # This happens a fair bit; in the "IOC vs other lists"
+                    # these rows are typically reddish brown, indicating
+                    # "species not recognized by IOC".
+                    logging.warning(f'Scientific name {scientific_name_clements} not found '
+                                    '(probably recognized by Clements but not IOC)')
+            warned_scientific_names |= unknown_scientific_names
+    logging.info(f'Loaded {num_regions} regions')
+
+    state.set_value(session, _SOURCE_HASHES_KEY, source_hashes)
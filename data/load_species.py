@@ -14,16 +14,31 @@ which version they last updated to. For best results, we should use the same
 version.
 '''
 
+import hashlib
 import logging
+import multiprocessing.pool
 import os
+import os.path
+import pickle
 import re
+import signal
 
 import openpyxl
-from sqlalchemy.orm import joinedload
+import sqlalchemy
+import zstandard
 
+import species_counts
 from species import Species, CommonName
 
 
+# Parsed spreadsheets are cached here, keyed by the SHA-256 hash of the
+# spreadsheet file, because parsing XLSX is slow.
+_SPREADSHEET_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache', 'spreadsheets')
+# Must be incremented whenever the parsing code changes, to invalidate the
+# cache.
+_SPREADSHEET_CACHE_VERSION = 1
+
+
 _LANGUAGE_MAPPING = {
     'English': 'en',
     'Afrikaans': 'af',
@@ -66,58 +81,141 @@ class Multiling:
 
     _NUM_HEADER_ROWS = 3
 
-    def __init__(self, file_name):
-        logging.info(f'Loading {file_name}')
-        workbook = openpyxl.load_workbook(file_name, read_only=True)
-        self._worksheet = workbook['List']
-        self.fields = []
-        for row in self._worksheet.iter_rows(
+    def __init__(self, fields, merged_rows):
+        self.fields = fields
+        self._merged_rows = merged_rows
+
+    @staticmethod
+    def parse(file_name):
+        logging.info(f'Parsing {file_name}')
+        worksheet = openpyxl.load_workbook(file_name, read_only=True)['List']
+        fields = []
+        for row in worksheet.iter_rows(
                 min_row=1, max_row=Multiling._NUM_HEADER_ROWS, values_only=True):
-            if not self.fields:
-                self.fields = [None] * len(row)
+            if not fields:
+                fields = [None] * len(row)
             for i, cell in enumerate(row):
-                if cell and not self.fields[i]:
-                    self.fields[i] = cell
+                if cell and not fields[i]:
+                    fields[i] = cell
+        return Multiling(fields, list(Multiling._merge_rows(worksheet, fields)))
 
-    def merged_rows(self):
-        '''
-        Merges staggered rows into one and yields each row as a dict, except
-        the header rows.
-        '''
-        restart_column = self.fields.index('Scientific Name')
+    @staticmethod
+    def _merge_rows(worksheet, fields):
+        restart_column = fields.index('Scientific Name')
         merged_row = None
-        for row in self._worksheet.iter_rows(
+        for row in worksheet.iter_rows(
                 min_row=Multiling._NUM_HEADER_ROWS + 1, values_only=True):
             if row[restart_column]:
                 if merged_row and merged_row['Scientific Name']: # pylint: disable=unsubscriptable-object
                     yield merged_row
-                merged_row = {field: None for field in self.fields}
+                merged_row = {field: None for field in fields}
             if merged_row:
-                for field, value in zip(self.fields, row):
+                for field, value in zip(fields, row):
                     if value:
                         merged_row[field] = value
         yield merged_row
 
+    def merged_rows(self):
+        '''
+        Returns the rows, except the header rows, as dicts, with staggered
+        rows merged into one.
+        '''
+        return self._merged_rows
+
 
 class Comparison:
     '''
     Wrapper around "IOC versus other lists" XLSX file.
     '''
 
-    def __init__(self, file_name):
-        logging.info(f'Loading {file_name}')
-        workbook = openpyxl.load_workbook(file_name, read_only=True)
-        self._worksheet = workbook.active
-        self.fields = [cell.value for cell in next(self._worksheet.rows)]
+    def __init__(self, fields, rows):
+        self.fields = fields
+        self._rows = rows
+
+    @staticmethod
+    def parse(file_name):
+        logging.info(f'Parsing {file_name}')
+        worksheet = openpyxl.load_workbook(file_name, read_only=True).active
+        fields = [cell.value for cell in next(worksheet.rows)]
+        rows = []
+        for number, row in enumerate(worksheet.iter_rows(min_row=2, values_only=True)):
+            d = dict(zip(fields, row))
+            d['_number'] = number + 2 # 1-based, and we skipped one at the top.
+            rows.append(d)
+        return Comparison(fields, rows)
 
     def rows(self):
         '''
-        Yields each row as a dict, except header rows.
+        Returns each row as a dict, except header rows.
         '''
-        for number, row in enumerate(self._worksheet.iter_rows(min_row=2, values_only=True)):
-            d = dict(zip(self.fields, row))
-            d['_number'] = number + 2 # 1-based, and we skipped one at the top.
-            yield d
+        return self._rows
+
+
+def _spreadsheet_cache_file_name(spreadsheet_class, file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return os.path.join(
+        _SPREADSHEET_CACHE_DIR,
+        f'{spreadsheet_class.__name__}.{_SPREADSHEET_CACHE_VERSION}.{sha256.hexdigest()}.pickle.zst')
+
+
+def _parse_and_cache(spreadsheet_class_and_file_names):
+    '''
+    Entry point for parallel processing.
+    '''
+    spreadsheet_class, file_name, cache_file_name = spreadsheet_class_and_file_names
+    spreadsheet = spreadsheet_class.parse(file_name)
+    data = zstandard.ZstdCompressor().compress(
+        pickle.dumps(spreadsheet, protocol=pickle.HIGHEST_PROTOCOL))
+    # Write to a temporary file first, so that an interrupted write never
+    # leaves a truncated cache file behind.
+    os.makedirs(_SPREADSHEET_CACHE_DIR, exist_ok=True)
+    temp_file_name = f'{cache_file_name}.{os.getpid()}.tmp'
+    try:
+        with open(temp_file_name, 'wb') as f:
+            f.write(data)
+        os.replace(temp_file_name, cache_file_name)
+    except: # pylint: disable=bare-except
+        # Try to clean up, but propagate the original exception.
+        try:
+            os.remove(temp_file_name)
+        except: # pylint: disable=bare-except
+            pass
+        raise
+    return spreadsheet
+
+
+def _load_spreadsheets(multiling_file_name, comparison_file_name):
+    '''
+    Returns the Multiling and Comparison objects for the given files, from
+    the cache if possible. Any that are not cached, or whose cache file cannot
+    be read, are parsed in parallel, replacing their cache files.
+    '''
+    spreadsheets = []
+    to_parse = []
+    for spreadsheet_class, file_name in [(Multiling, multiling_file_name), (Comparison, comparison_file_name)]:
+        cache_file_name = _spreadsheet_cache_file_name(spreadsheet_class, file_name)
+        try:
+            with open(cache_file_name, 'rb') as f:
+                spreadsheets.append(pickle.loads(zstandard.ZstdDecompressor().decompress(f.read())))
+            logging.info(f'Loaded parsed {file_name} from cache')
+        except FileNotFoundError:
+            spreadsheets.append(None)
+            to_parse.append((spreadsheet_class, file_name, cache_file_name))
+        except (zstandard.ZstdError, EOFError, pickle.UnpicklingError) as ex:
+            logging.warning(f'Ignoring corrupt cache file {cache_file_name}: {ex!r}')
+            spreadsheets.append(None)
+            to_parse.append((spreadsheet_class, file_name, cache_file_name))
+    if to_parse:
+        # https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python#35134329
+        original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        with multiprocessing.pool.Pool(len(to_parse)) as pool:
+            signal.signal(signal.SIGINT, original_sigint_handler)
+            parsed = iter(pool.map(_parse_and_cache, to_parse))
+        spreadsheets = [spreadsheet or next(parsed) for spreadsheet in spreadsheets]
+    return spreadsheets
 
 
 def add_args(parser):
@@ -132,11 +230,7 @@ def add_args(parser):
 
 
 def main(args, session):
-    logging.info('Deleting existing species and common names')
-    session.query(CommonName).delete()
-    session.query(Species).delete()
-
-    comparison = Comparison(args.ioc_comparison_file)
+    multiling, comparison = _load_spreadsheets(args.ioc_multiling_file, args.ioc_comparison_file)
     logging.info(f'Found column headings: {comparison.fields}')
 
     ioc_field = [f for f in comparison.fields if 'ioc world bird list' in f.lower()][0]
@@ -152,7 +246,6 @@ def main(args, session):
             if clements:
                 ioc_to_clements[ioc] = clements
 
-    multiling = Multiling(args.ioc_multiling_file)
     logging.info(f'Found column headings: {multiling.fields}')
 
     for field in multiling.fields:
@@ -163,38 +256,78 @@ def main(args, session):
                                  f'maybe it needs to be added as a language?')
             continue
 
+    # Rather than querying and updating the database for each row, we work
+    # out what the tables should contain, and then apply the differences in
+    # bulk.
+    species_rows = {}
+    common_name_rows = {}
+    species_ids = {}
     for row in multiling.merged_rows():
         scientific_name = row['Scientific Name']
-
-        species = session.query(Species)\
-            .options(joinedload(Species.common_names))\
-            .filter(Species.scientific_name == scientific_name)\
-            .one_or_none()
-        if species:
-            logging.info(f'Already have species {species.scientific_name} '
-                         f'(id {species.species_id})')
+        species_id = species_ids.get(scientific_name)
+        if species_id is None:
+            species_id = ioc_to_species_id[scientific_name]
+            species_ids[scientific_name] = species_id
+            species_rows[species_id] = {
+                'species_id': species_id,
+                'scientific_name': scientific_name,
+                'scientific_name_clements': ioc_to_clements.get(scientific_name, None),
+            }
         else:
-            scientific_name = row['Scientific Name']
-            species = Species(
-                species_id=ioc_to_species_id[scientific_name],
-                scientific_name=scientific_name,
-                scientific_name_clements=ioc_to_clements.get(scientific_name, None))
-            session.add(species)
-            session.flush()
-            logging.info(f'Added new species {species.scientific_name} (id {species.species_id})')
+            logging.info(f'Already have species {scientific_name} (id {species_id})')
 
         for field, value in row.items():
             language_code = _LANGUAGE_MAPPING.get(field)
             if language_code:
-                common_names = [
-                    common_name for common_name in species.common_names
-                    if common_name.language_code == language_code
-                ]
-                if common_names:
-                    common_name = common_names[0]
-                else:
-                    common_name = CommonName(species_id=species.species_id,
-                                             language_code=language_code)
-                    session.add(common_name)
-                if common_name.common_name != value:
-                    common_name.common_name = value
+                common_name_rows[(species_id, language_code)] = {
+                    'species_id': species_id,
+                    'language_code': language_code,
+                    'common_name': value,
+                }
+
+    species_table = Species.__table__
+    common_names_table = CommonName.__table__
+    logging.info('Loading existing species and common names')
+    existing_species_rows = {
+        row.species_id: dict(row)
+        for row in session.execute(sqlalchemy.select([species_table]))
+    }
+    existing_common_name_rows = {
+        (row.species_id, row.language_code): dict(row)
+        for row in session.execute(sqlalchemy.select([common_names_table]))
+    }
+
+    # Common names go first, so they are never left pointing at a species
+    # that no longer exists.
+    _apply_diff(session, common_names_table, existing_common_name_rows, common_name_rows,
+                [common_names_table.c.species_id, common_names_table.c.language_code])
+    _apply_diff(session, species_table, existing_species_rows, species_rows,
+                [species_table.c.species_id])
+
+    if species_rows != existing_species_rows:
+        species_counts.refresh(session)
+
+
+def _apply_diff(session, table, existing_rows, rows, key_columns):
+    '''
+    Makes the table, which currently contains `existing_rows`, contain `rows`
+    instead. Both are dicts of rows (as dicts) keyed by primary key.
+    '''
+    deleted_keys = [key for key in existing_rows if key not in rows]
+    inserted_rows = [row for key, row in rows.items() if key not in existing_rows]
+    updated_rows = [row for key, row in rows.items() if key in existing_rows and existing_rows[key] != row]
+    num_unchanged = len(rows) - len(inserted_rows) - len(updated_rows)
+    logging.info(f'{table.name}: inserting {len(inserted_rows)}, updating {len(updated_rows)}, '
+                 f'deleting {len(deleted_keys)}, leaving {num_unchanged} unchanged')
+
+    if deleted_keys:
+        where = sqlalchemy.and_(*(
+            column == sqlalchemy.bindparam(f'key_{i}') for i, column in enumerate(key_columns)))
+        session.execute(table.delete().where(where), [
+            {f'key_{i}': value for i, value in enumerate(key if isinstance(key, tuple) else (key,))}
+            for key in deleted_keys
+        ])
+    # Replacing rather than updating also takes care of any row that
+    # conflicts on a unique column, such as a scientific name that moved to a
+    # different species id; that row is either deleted or replaced as well.
+    session.insert_or_replace(table, inserted_rows + updated_rows)
@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+
+'''
+Maintenance commands for the fetcher's response cache in the `cache`
+directory. None of these should be run while pipeline stages are running.
+'''
+
+import argparse
+import datetime
+import functools
+import hashlib
+import logging
+import multiprocessing.pool
+import os
+import os.path
+import re
+import shutil
+import sys
+import time
+
+import db
+import fetcher
+import progress
+import store_map_tiles
+from cache_bundle import CacheBundle
+from compressed_cache import CompressedCache
+from images import Image
+from negative_cache import NegativeCache
+from packed_cache import PackedCache
+from recordings import Recording, SelectedRecording
+
+
+def _read_file(entry):
+    '''
+    Returns the key hash, contents and access time of a cache file. The access
+    time is taken before reading, which updates it.
+    '''
+    key_hash, file_name = entry
+    last_used = os.stat(file_name).st_atime
+    with open(file_name, 'rb') as f:
+        return key_hash, f.read(), last_used
+
+
+def _pack_batch(packed_cache, batch):
+    '''
+    Stores a batch of `(key_hash, data, last_used)` tuples in the packed cache,
+    keeping their last use times.
+    '''
+    packed_cache.set_hashes((key_hash, data) for key_hash, data, _ in batch)
+    packed_cache.set_last_used((key_hash, last_used) for key_hash, _, last_used in batch)
+
+
+def _migrate(args):
+    '''
+    Converts a cache group from one file per entry to a PackedCache.
+    '''
+    path = os.path.join(fetcher.CACHE_DIR, args.cache_group)
+    if PackedCache.exists(path):
+        logging.info(f'Cache group {args.cache_group} is already packed')
+        return
+    if not os.path.isdir(path):
+        raise ValueError(f'Cache group {args.cache_group} does not exist')
+
+    logging.info(f'Listing entries in {path}')
+    entries = list(fetcher.Cache(path).entries())
+
+    packing_path = path + '.packing'
+    shutil.rmtree(packing_path, ignore_errors=True)
+    packed_cache = PackedCache(packing_path)
+    logging.info(f'Packing {len(entries)} entries into {packing_path}')
+    batch = []
+    with multiprocessing.pool.ThreadPool(args.jobs) as pool:
+        for item in progress.percent(pool.imap_unordered(_read_file, entries, chunksize=64), len(entries)):
+            batch.append(item)
+            if len(batch) >= 1000:
+                _pack_batch(packed_cache, batch)
+                batch = []
+    _pack_batch(packed_cache, batch)
+
+    old_path = path + '.old'
+    logging.info(f'Swapping {packing_path} into place')
+    os.rename(path, old_path)
+    os.rename(packing_path, path)
+    if args.keep_old:
+        logging.info(f'Old cache files were kept in {old_path}')
+    else:
+        logging.info(f'Deleting {old_path}')
+        shutil.rmtree(old_path)
+
+
+def _train_dictionary(args):
+    '''
+    Trains a compression dictionary for a compressed cache group.
+    '''
+    cache = fetcher.open_cache(args.cache_group)
+    if not isinstance(cache, CompressedCache):
+        raise ValueError(f'Cache group {args.cache_group} is not compressed')
+    cache.train_dictionary(args.num_samples, args.dictionary_size)
+    if args.recompress:
+        logging.info('Recompressing all entries')
+        old_size, new_size = cache.recompress()
+        logging.info(f'Recompressed {old_size} bytes into {new_size} bytes')
+
+
+_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def _parse_budget(s):
+    '''
+    Parses a string like `recordings=20G` into a `(cache_group, num_bytes)`
+    tuple.
+    '''
+    m = re.match(r'^([^=]+)=(\d+(?:\.\d+)?)([KMGT]?)$', s.strip(), re.IGNORECASE)
+    if not m:
+        raise argparse.ArgumentTypeError(f'Expected a budget like recordings=20G, got {s}')
+    return m.group(1), round(float(m.group(2)) * _SIZE_SUFFIXES[m.group(3).upper()])
+
+
+# Cache groups whose URLs are stored in master.db, or can be derived from the
+# arguments, so _referenced_urls() knows which of their entries are needed.
+_REFERENCED_CACHE_GROUPS = frozenset(['recordings', 'xc_sonograms_small', 'wp_images', 'map_tiles'])
+
+
+def _referenced_urls(args, session, cache_group):
+    '''
+    Returns the set of URLs in the given cache group that are still needed
+    according to master.db (or for map tiles, the `store_map_tiles`
+    arguments), or None if this is not known for this group.
+    '''
+    if cache_group == 'recordings':
+        return set(
+            url
+            for row in session.query(Recording.audio_url, Recording.sonogram_url_full).join(SelectedRecording)
+            for url in row if url)
+    if cache_group == 'xc_sonograms_small':
+        return set(url for (url,) in session.query(Recording.sonogram_url_small) if url)
+    if cache_group == 'wp_images':
+        return set(url for (url,) in session.query(Image.image_file_url) if url)
+    if cache_group == 'map_tiles':
+        return set(url for _tile, url in store_map_tiles.tiles_and_urls(args.map_tiles_url_format, args.max_zoom_level))
+    return None
+
+
+def _scan_shard(cache_and_shard):
+    cache, shard = cache_and_shard
+    entries = []
+    for key_hash, file_name in cache.entries(shard):
+        try:
+            stat = os.stat(file_name)
+        except FileNotFoundError:
+            continue
+        entries.append((key_hash, file_name, stat.st_size, stat.st_atime))
+    return entries
+
+
+def _remove_files(file_names):
+    for file_name in file_names:
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+
+
+def _gc_group(args, session, pool, cache_group, budget):
+    '''
+    Evicts entries from a single cache group, and returns the number of bytes
+    reclaimed.
+    '''
+    storage = fetcher.open_storage(cache_group)
+    logging.info(f'Scanning cache group {cache_group}')
+    # List of (key_hash, file_name, size, last_used), where file_name is None
+    # for packed caches.
+    if isinstance(storage, PackedCache):
+        # A packed cache records access times itself, and lists its entries
+        # from least to most recently used.
+        entries = [(key_hash, None, size, index) for index, (key_hash, size) in enumerate(storage.entry_sizes())]
+    else:
+        entries = [
+            entry
+            for shard_entries in progress.percent(
+                pool.imap_unordered(_scan_shard, [(storage, shard) for shard in storage.shards()]),
+                len(storage.shards()))
+            for entry in shard_entries
+        ]
+        entries.sort(key=lambda entry: entry[3])
+    total_size = sum(size for _, _, size, _ in entries)
+    logging.info(f'Found {len(entries)} entries totalling {total_size} bytes')
+
+    evicted = []
+    if args.sweep_unreferenced:
+        referenced_urls = _referenced_urls(args, session, cache_group)
+        if referenced_urls is None:
+            logging.info(f'Not sweeping {cache_group} because it is not known which of its URLs are needed')
+        else:
+            referenced_hashes = set(
+                hashlib.sha1(key.encode('utf-8')).digest()
+                for url in referenced_urls
+                for key in fetcher.cache_keys(url))
+            evicted = [entry for entry in entries if entry[0] not in referenced_hashes]
+            entries = [entry for entry in entries if entry[0] in referenced_hashes]
+            logging.info(f'Sweeping {len(evicted)} entries that are no longer referenced')
+    if budget is not None:
+        remaining_size = sum(size for _, _, size, _ in entries)
+        num_over_budget = 0
+        while remaining_size > budget:
+            remaining_size -= entries[num_over_budget][2]
+            num_over_budget += 1
+        logging.info(f'Evicting {num_over_budget} entries to fit in {budget} bytes')
+        evicted += entries[:num_over_budget]
+
+    reclaimed_size = sum(size for _, _, size, _ in evicted)
+    if args.dry_run:
+        logging.info(f'Would reclaim {reclaimed_size} bytes from {cache_group}')
+        return reclaimed_size
+    if isinstance(storage, PackedCache):
+        storage.delete_hashes(key_hash for key_hash, _, _, _ in evicted)
+        logging.info('Compacting segments')
+        reclaimed_size = storage.compact()
+    else:
+        file_names = [file_name for _, file_name, _, _ in evicted]
+        chunks = [file_names[i:i + 1000] for i in range(0, len(file_names), 1000)]
+        for _ in progress.percent(pool.imap_unordered(_remove_files, chunks), len(chunks)):
+            pass
+    logging.info(f'Reclaimed {reclaimed_size} bytes from {cache_group}')
+    return reclaimed_size
+
+
+def _gc(args):
+    '''
+    Evicts cache entries to keep groups within their budgets, and optionally
+    removes entries that are no longer referenced from master.db.
+    '''
+    budgets = dict(args.budget)
+    cache_groups = set(budgets.keys())
+    session = None
+    if args.sweep_unreferenced:
+        cache_groups.update(
+            cache_group for cache_group in _REFERENCED_CACHE_GROUPS
+            if os.path.isdir(os.path.join(fetcher.CACHE_DIR, cache_group)))
+        session = db.create_session(os.path.join(os.path.dirname(__file__), 'master.db'))
+
+    total_reclaimed_size = 0
+    with multiprocessing.pool.Pool(args.jobs) as pool:
+        for cache_group in sorted(cache_groups):
+            total_reclaimed_size += _gc_group(args, session, pool, cache_group, budgets.get(cache_group))
+    logging.info(f'Reclaimed {total_reclaimed_size} bytes in total')
+
+
+def _read_and_hash(storage, key_hash):
+    try:
+        data = bytes(storage.get_by_hash(key_hash))
+    except KeyError:
+        # Removed in the meantime.
+        return None
+    return key_hash, hashlib.sha256(data).digest(), data
+
+
+def _export_bundle(args):
+    '''
+    Adds the entries of the given cache groups to a bundle file, skipping
+    entries that are already in it.
+    '''
+    bundle = CacheBundle(args.bundle_file)
+    with multiprocessing.pool.ThreadPool(args.jobs) as pool:
+        for cache_group in args.cache_group:
+            storage = fetcher.open_storage(cache_group)
+            in_bundle = set(key_hash for key_hash, _sha256 in bundle.entries(cache_group))
+            key_hashes = [key_hash for key_hash in storage.key_hashes() if key_hash not in in_bundle]
+            logging.info(f'Exporting {len(key_hashes)} entries from {cache_group}, '
+                         f'skipping {len(in_bundle)} that are already in the bundle')
+            num_bytes = 0
+            batch = []
+            for item in progress.percent(
+                    pool.imap_unordered(functools.partial(_read_and_hash, storage), key_hashes, chunksize=64),
+                    len(key_hashes)):
+                if item:
+                    batch.append(item)
+                if len(batch) >= 1000:
+                    num_bytes += bundle.add_entries(cache_group, batch)
+                    batch = []
+            num_bytes += bundle.add_entries(cache_group, batch)
+            logging.info(f'Added {num_bytes} bytes of new values to {args.bundle_file}')
+
+            dictionaries_path = os.path.join(fetcher.CACHE_DIR, cache_group, CompressedCache.DICTIONARIES_DIR_NAME)
+            if os.path.isdir(dictionaries_path):
+                for file_name in sorted(os.listdir(dictionaries_path)):
+                    if file_name.endswith('.dict'):
+                        with open(os.path.join(dictionaries_path, file_name), 'rb') as f:
+                            bundle.add_file(cache_group, os.path.join(CompressedCache.DICTIONARIES_DIR_NAME, file_name),
+                                            f.read())
+
+
+def _read_and_verify(bundle, entry):
+    key_hash, sha256 = entry
+    data = bundle.get_blob(sha256)
+    if hashlib.sha256(data).digest() != sha256:
+        logging.error(f'Value {sha256.hex()} in bundle is corrupt')
+        return None
+    return key_hash, data
+
+
+def _import_files(bundle, cache_group):
+    '''
+    Copies the extra files of a cache group from the bundle. Compression
+    dictionaries are looked up by their ID rather than their file name, so a
+    dictionary that is not present yet is stored under a new file name if its
+    name is already taken.
+    '''
+    for path, data in bundle.files(cache_group):
+        file_name = os.path.join(fetcher.CACHE_DIR, cache_group, path)
+        dir_name = os.path.dirname(file_name)
+        os.makedirs(dir_name, exist_ok=True)
+        existing_file_names = [os.path.join(dir_name, f) for f in sorted(os.listdir(dir_name))]
+        if any(_file_contents(f) == data for f in existing_file_names):
+            continue
+        if os.path.exists(file_name):
+            file_name = os.path.join(dir_name, f'{len(existing_file_names):04d}.dict')
+        logging.info(f'Importing {file_name}')
+        with open(file_name + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(file_name + '.tmp', file_name)
+
+
+def _file_contents(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def _import_bundle(args):
+    '''
+    Adds the entries from a bundle file to the cache, skipping entries that
+    are already present and values whose hash does not match.
+    '''
+    bundle = CacheBundle(args.bundle_file, create=False)
+    with multiprocessing.pool.ThreadPool(args.jobs) as pool:
+        for cache_group in args.cache_group or bundle.cache_groups():
+            # Open the storage first, so packed groups are created as such.
+            storage = fetcher.open_storage(cache_group)
+            _import_files(bundle, cache_group)
+            in_cache = set(storage.key_hashes())
+            entries = [entry for entry in bundle.entries(cache_group) if entry[0] not in in_cache]
+            logging.info(f'Importing {len(entries)} entries into {cache_group}, '
+                         f'skipping {len(in_cache)} that are already in the cache')
+            num_corrupt = 0
+            batch = []
+            for item in progress.percent(
+                    pool.imap_unordered(functools.partial(_read_and_verify, bundle), entries, chunksize=64),
+                    len(entries)):
+                if item:
+                    batch.append(item)
+                else:
+                    num_corrupt += 1
+                if len(batch) >= 1000:
+                    storage.set_hashes(batch)
+                    batch = []
+            storage.set_hashes(batch)
+            if num_corrupt:
+                logging.warning(f'Skipped {num_corrupt} corrupt entries in {cache_group}')
+
+
+def _failure_caches(cache_groups):
+    '''
+    Yields a `(cache_group, negative_cache)` tuple for each of the given cache
+    groups that has failure records, or for all of them if none are given.
+    '''
+    if not cache_groups:
+        cache_groups = sorted(os.listdir(fetcher.CACHE_DIR))
+    for cache_group in cache_groups:
+        path = os.path.join(fetcher.CACHE_DIR, cache_group)
+        if NegativeCache.exists(path):
+            yield cache_group, NegativeCache(path)
+
+
+def _list_failures(args):
+    '''
+    Prints the URLs that could not be fetched, oldest failure first.
+    '''
+    now = time.time()
+    for cache_group, negative_cache in _failure_caches(args.cache_group):
+        for url, status, failed_at in negative_cache.entries():
+            age = datetime.timedelta(seconds=round(now - failed_at))
+            print(f'{cache_group}\t{status}\t{age} ago\t{url}')
+
+
+def _purge_failures(args):
+    '''
+    Forgets failures to fetch URLs, so they are tried again on the next run.
+    '''
+    older_than = None
+    if args.older_than_days is not None:
+        older_than = time.time() - args.older_than_days * 24 * 60 * 60
+    for cache_group, negative_cache in _failure_caches(args.cache_group):
+        num_purged = negative_cache.purge(older_than=older_than, status=args.status)
+        logging.info(f'Purged {num_purged} failure records from {cache_group}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--log_level', default='info', choices=['debug', 'info', 'warning', 'error', 'critical'],
+        help='Verbosity of logging')
+    parser.add_argument(
+        '--no_progress', action='store_true',
+        help='Disable progress reporting even if stderr is connected to a tty')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='Convert a cache group from one file per entry to packed segment files')
+    migrate_parser.set_defaults(func=_migrate)
+    migrate_parser.add_argument(
+        'cache_group',
+        help='Name of the cache group, for example xc_sonograms_small')
+    migrate_parser.add_argument(
+        '--jobs', type=int, default=16,
+        help='Number of threads reading files in parallel')
+    migrate_parser.add_argument(
+        '--keep_old', action='store_true',
+        help='Keep the old cache files in a directory ending in .old instead of deleting them')
+
+    train_dictionary_parser = subparsers.add_parser(
+        'train_dictionary', help='Train a compression dictionary on the contents of a compressed cache group')
+    train_dictionary_parser.set_defaults(func=_train_dictionary)
+    train_dictionary_parser.add_argument(
+        'cache_group',
+        help='Name of the cache group, for example wp_pages')
+    train_dictionary_parser.add_argument(
+        '--num_samples', type=int, default=10000,
+        help='Number of randomly chosen entries to train on')
+    train_dictionary_parser.add_argument(
+        '--dictionary_size', type=int, default=112640,
+        help='Size of the dictionary in bytes')
+    train_dictionary_parser.add_argument(
+        '--recompress', action='store_true',
+        help='Compress all existing entries again using the new dictionary')
+
+    gc_parser = subparsers.add_parser(
+        'gc', help='Evict entries to fit within budgets, and remove entries no longer needed by master.db')
+    gc_parser.set_defaults(func=_gc)
+    gc_parser.add_argument(
+        '--budget', type=_parse_budget, action='append', default=[],
+        help='Maximum size of a cache group, for example recordings=20G; can be repeated. '
+        'Least recently used entries are evicted first. Packed groups record when entries are used in their '
+        'index; other groups rely on file access times, so the cache should not be on a file system mounted '
+        'with noatime')
+    gc_parser.add_argument(
+        '--sweep_unreferenced', action='store_true',
+        help='Remove entries whose URLs are no longer referenced by any recording, image or map tile. '
+        'Map tiles are those for the --map_tiles_url_format and --max_zoom_level given here, so these '
+        'should match the ones passed to store_map_tiles')
+    gc_parser.add_argument(
+        '--jobs', type=int, default=8,
+        help='Number of directory shards to process in parallel')
+    gc_parser.add_argument(
+        '--dry_run', action='store_true',
+        help='Only report how many bytes would be reclaimed')
+    store_map_tiles.add_args(gc_parser)
+
+    list_failures_parser = subparsers.add_parser(
+        'list_failures', help='List URLs that could not be fetched, and are not tried again until they expire')
+    list_failures_parser.set_defaults(func=_list_failures)
+    list_failures_parser.add_argument(
+        'cache_group', nargs='*',
+        help='Names of the cache groups to list; all groups if omitted')
+
+    purge_failures_parser = subparsers.add_parser(
+        'purge_failures', help='Forget that URLs could not be fetched, so they are tried again')
+    purge_failures_parser.set_defaults(func=_purge_failures)
+    purge_failures_parser.add_argument(
+        'cache_group', nargs='*',
+        help='Names of the cache groups to purge; all groups if omitted')
+    purge_failures_parser.add_argument(
+        '--older_than_days', type=float,
+        help='Only purge failures that happened more than this many days ago')
+    purge_failures_parser.add_argument(
+        '--status', type=int,
+        help='Only purge failures with this HTTP status code')
+
+    export_bundle_parser = subparsers.add_parser(
+        'export_bundle', help='Add the contents of cache groups to a bundle file, for importing elsewhere')
+    export_bundle_parser.set_defaults(func=_export_bundle)
+    export_bundle_parser.add_argument(
+        'bundle_file',
+        help='Name of the bundle file; if it exists, only entries that are not in it yet are added')
+    export_bundle_parser.add_argument(
+        'cache_group', nargs='+',
+        help='Names of the cache groups to export')
+    export_bundle_parser.add_argument(
+        '--jobs', type=int, default=16,
+        help='Number of threads reading and hashing entries in parallel')
+
+    import_bundle_parser = subparsers.add_parser(
+        'import_bundle', help='Add the contents of a bundle file to the cache')
+    import_bundle_parser.set_defaults(func=_import_bundle)
+    import_bundle_parser.add_argument(
+        'bundle_file',
+        help='Name of the bundle file')
+    import_bundle_parser.add_argument(
+        'cache_group', nargs='*',
+        help='Names of the cache groups to import; all groups in the bundle if omitted')
+    import_bundle_parser.add_argument(
+        '--jobs', type=int, default=16,
+        help='Number of threads reading and verifying entries in parallel')
+
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log_level.upper())
+    logging.basicConfig(level=log_level)
+
+    if args.no_progress:
+        progress.disable()
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
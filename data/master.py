@@ -11,17 +11,24 @@ order given on the command line.
 '''
 
 import argparse
+import contextlib
 import datetime
 import importlib
 import logging
 import os.path
 import sys
+import tempfile
 import time
 
 from sqlalchemy.exc import InvalidRequestError
 
 import db
+import fetch_service
+import fetch_stats
+import fetcher
+import packed_cache
 import progress
+import rate_limiter
 
 
 # To add a new stage `foo`:
@@ -32,6 +39,7 @@ import progress
 _STAGES = [
     'load_species',
     'load_regions',
+    'build_region_tree',
     'load_recordings',
     'load_images',
     'regions_to_gpkg',
@@ -48,6 +56,30 @@ _STAGES = [
 _STAGE_MODULES = {stage: importlib.import_module(stage) for stage in _STAGES}
 
 
+def _run_stages(args, session):
+    for stage, module in _STAGE_MODULES.items():
+        if getattr(args, stage):
+            logging.info(f'Starting stage {stage}')
+            start_time = time.monotonic()
+            fetch_stats.reset()
+
+            getattr(module, 'main')(args, session)
+            packed_cache.flush_last_used()
+            logging.info('Committing transaction')
+            try:
+                session and session.commit()
+            except InvalidRequestError:
+                logging.info('Transaction is empty, nothing to commit')
+
+            elapsed = datetime.timedelta(seconds=time.monotonic() - start_time)
+            logging.info(f'Finished stage {stage} in {elapsed}')
+
+            if fetch_stats.snapshot():
+                for line in fetch_stats.summary():
+                    logging.info(f'Fetch statistics for {line}')
+                fetch_stats.write_json(os.path.join(args.fetch_stats_dir, f'{stage}.json'))
+
+
 def _main():
     parser = argparse.ArgumentParser(description=__doc__)
 
@@ -58,6 +90,25 @@ def _main():
     common_args.add_argument(
         '--no_progress', action='store_true',
         help='Disable progress reporting even if stderr is connected to a tty')
+    common_args.add_argument(
+        '--fetch_stats_dir', default=os.path.join(os.path.dirname(__file__), 'cache', 'fetch_stats'),
+        help='Directory to write fetch and cache statistics to, as one JSON file per stage')
+    common_args.add_argument(
+        '--negative_cache_ttl_days', type=float, default=30,
+        help='Number of days to remember that a URL could not be fetched, rather than trying it again; '
+        '0 to always try again')
+    common_args.add_argument(
+        '--offline', action='store_true',
+        help='Do not access the network; anything that is not in the cache is treated as a fetch error. '
+        'Cannot be combined with revalidating the cache')
+    common_args.add_argument(
+        '--standin_server',
+        help='Send all HTTP requests to this server instead, for example http://localhost:8081 for '
+        'standin_server.py')
+    common_args.add_argument(
+        '--fetch_service', action='store_true',
+        help='Let the worker processes of each stage fetch through a single service in the main process, '
+        'which shares connections between them, instead of opening their own')
 
     stage_args = parser.add_argument_group('stage selection arguments')
     for stage, module in _STAGE_MODULES.items():
@@ -70,6 +121,10 @@ def _main():
             add_args(module_args)
 
     args = parser.parse_args()
+    if args.offline:
+        revalidate_args = sorted(name for name, value in vars(args).items() if name.startswith('revalidate_') and value)
+        if revalidate_args:
+            parser.error(f'--offline cannot be combined with --{", --".join(revalidate_args)}')
 
     log_level = getattr(logging, args.log_level.upper())
     logging.basicConfig(level=log_level)
@@ -81,24 +136,19 @@ def _main():
 
     if args.no_progress:
         progress.disable()
+    fetcher.set_negative_cache_ttl(args.negative_cache_ttl_days * 24 * 60 * 60)
+    fetcher.set_offline(args.offline)
+    fetcher.set_standin_server(args.standin_server)
 
     session = db.create_session(os.path.join(os.path.dirname(__file__), 'master.db'))
     db.create_master_schema(session)
 
-    for stage, module in _STAGE_MODULES.items():
-        if getattr(args, stage):
-            logging.info(f'Starting stage {stage}')
-            start_time = time.monotonic()
-
-            getattr(module, 'main')(args, session)
-            logging.info('Committing transaction')
-            try:
-                session and session.commit()
-            except InvalidRequestError:
-                logging.info('Transaction is empty, nothing to commit')
-
-            elapsed = datetime.timedelta(seconds=time.monotonic() - start_time)
-            logging.info(f'Finished stage {stage} in {elapsed}')
+    # Share rate limits between all processes of this run, but not with other
+    # runs, which might have crashed while holding on to a request slot.
+    with tempfile.TemporaryDirectory(prefix='rate_limiter.') as rate_limiter_dir, \
+            fetch_service.serve() if args.fetch_service else contextlib.nullcontext():
+        rate_limiter.set_state_dir(rate_limiter_dir)
+        _run_stages(args, session)
 
 
 if __name__ == '__main__':
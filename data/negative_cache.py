@@ -0,0 +1,96 @@
+'''
+Records of URLs that could not be fetched, so they are not retried on every
+run.
+'''
+
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+
+class NegativeCache:
+    '''
+    Stores a failure record for each URL whose fetch failed with an HTTP status
+    meaning that it is gone, in an SQLite database next to a cache group's
+    entries. Records are not removed when they expire; the fetcher decides
+    whether a record is still fresh enough to trust, and overwrites or removes
+    it after fetching again. Thread-safe and process-safe.
+    '''
+
+    FILE_NAME = 'failures.db'
+
+    def __init__(self, path):
+        self._file_name = os.path.join(path, NegativeCache.FILE_NAME)
+        self._local = threading.local()
+        os.makedirs(path, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('''
+                create table if not exists failures (
+                    url text primary key not null,
+                    status integer not null,
+                    failed_at real not null
+                )
+            ''')
+
+    @staticmethod
+    def exists(path):
+        '''
+        Returns whether the given cache group directory contains failure
+        records.
+        '''
+        return os.path.isfile(os.path.join(path, NegativeCache.FILE_NAME))
+
+    def get(self, url):
+        '''
+        Returns a `(status, failed_at)` tuple for the given URL, where
+        `failed_at` is a Unix timestamp, or None if it has not failed.
+        '''
+        return self._connection().execute(
+            'select status, failed_at from failures where url = ?', (url,)).fetchone()
+
+    def add(self, url, status):
+        '''
+        Records that fetching the URL just failed with the given HTTP status.
+        '''
+        with self._connection() as conn:
+            conn.execute('insert or replace into failures values (?, ?, ?)', (url, status, time.time()))
+
+    def remove(self, url):
+        with self._connection() as conn:
+            conn.execute('delete from failures where url = ?', (url,))
+
+    def entries(self):
+        '''
+        Returns a list of `(url, status, failed_at)` tuples, oldest first.
+        '''
+        return self._connection().execute(
+            'select url, status, failed_at from failures order by failed_at').fetchall()
+
+    def purge(self, older_than=None, status=None):
+        '''
+        Removes failure records, optionally only those older than the given
+        Unix timestamp and those with the given status. Returns the number of
+        records removed.
+        '''
+        conditions = []
+        params = []
+        if older_than is not None:
+            conditions.append('failed_at < ?')
+            params.append(older_than)
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status)
+        where = ' where ' + ' and '.join(conditions) if conditions else ''
+        with self._connection() as conn:
+            return conn.execute('delete from failures' + where, params).rowcount
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._file_name, timeout=60.0)
+            conn.execute('pragma journal_mode = wal')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -0,0 +1,363 @@
+'''
+A disk-based cache that packs many small entries into large segment files,
+rather than storing one file per entry like fetcher.Cache does.
+'''
+
+import hashlib
+import mmap
+import os
+import os.path
+import sqlite3
+import threading
+import time
+import weakref
+
+
+class PackedCache:
+    '''
+    Disk-based cache that appends values to large segment files, and keeps an
+    SQLite index from key hash to (segment, offset, length). Hits are served
+    from memory-mapped segments.
+
+    Each process appends to a segment of its own, so writers never contend
+    for a segment file, and the index is protected by SQLite's own locking. As
+    with fetcher.Cache, all operations apart from clearing are thread-safe and
+    process-safe.
+
+    Replaced and deleted values are not removed from their segment; that
+    space is only reclaimed by compact().
+
+    The index also records when each entry was last written or read through
+    get_buffer(), so that garbage collection can evict the least recently
+    used entries first. Reads are recorded in batches, which are only written
+    to the index once they are large or old enough, so processes should call
+    flush_last_used() on every open cache before they exit; pool workers exit
+    without running atexit handlers. fetch_stats.pool_imap() does this for
+    worker processes.
+    '''
+
+    INDEX_FILE_NAME = 'index.db'
+    SEGMENTS_DIR_NAME = 'segments'
+
+    # Start a new segment once the current one grows beyond this size.
+    _MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+
+    # Write recorded reads to the index once there are this many, or once the
+    # oldest is this many seconds old.
+    _LAST_USED_BATCH_SIZE = 1000
+    _LAST_USED_BATCH_SECONDS = 10
+
+    def __init__(self, path):
+        self._path = path
+        self._segments_path = os.path.join(path, PackedCache.SEGMENTS_DIR_NAME)
+        os.makedirs(self._segments_path, exist_ok=True)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._writer_pid = None
+        self._writer = None
+        self._writer_segment = None
+        self._mmaps_pid = None
+        self._mmaps = {}
+        self._last_used_lock = threading.Lock()
+        self._last_used_pid = None
+        self._last_used = {}
+        self._last_used_flushed_at = time.time()
+        _open_caches.add(self)
+        with self._connection() as conn:
+            conn.execute('''
+                create table if not exists entries (
+                    key_hash blob primary key not null,
+                    segment integer not null,
+                    offset integer not null,
+                    length integer not null,
+                    last_used real
+                ) without rowid
+            ''')
+            # Indexes created before access times were recorded.
+            if 'last_used' not in [column[1] for column in conn.execute('pragma table_info(entries)')]:
+                conn.execute('alter table entries add column last_used real')
+            conn.execute('''
+                create table if not exists segments (
+                    segment integer primary key autoincrement,
+                    pid integer
+                )
+            ''')
+
+    @staticmethod
+    def exists(path):
+        '''
+        Returns whether the given directory contains a packed cache.
+        '''
+        return os.path.isfile(os.path.join(path, PackedCache.INDEX_FILE_NAME))
+
+    def clear(self):
+        raise NotImplementedError(f'Just remove {self._path} yourself for now')
+
+    def __getitem__(self, key):
+        return bytes(self.get_buffer(key))
+
+    def __setitem__(self, key, value):
+        self.set_hashes([(_hash_key(key), value)])
+
+    def __contains__(self, key):
+        return self._lookup(_hash_key(key)) is not None
+
+    def get_buffer(self, key):
+        '''
+        Returns a read-only memoryview of the value, straight from the
+        memory-mapped segment, without copying it. Counts as a use of the
+        entry.
+        '''
+        key_hash = _hash_key(key)
+        location = self._lookup(key_hash)
+        if location is None:
+            raise KeyError(key)
+        self._record_use(key_hash)
+        segment, offset, length = location
+        return memoryview(self._mmap(segment, offset + length))[offset:offset + length]
+
+    def get_by_hash(self, key_hash):
+        '''
+        Returns the value for the key with the given SHA-1 digest. This is
+        meant for maintenance operations, so it does not count as a use of the
+        entry.
+        '''
+        location = self._lookup(key_hash)
+        if location is None:
+            raise KeyError(key_hash)
+        segment, offset, length = location
+        return self._mmap(segment, offset + length)[offset:offset + length]
+
+    def key_hashes(self):
+        '''
+        Yields the SHA-1 digests of all keys in the cache.
+        '''
+        for (key_hash,) in self._connection().execute('select key_hash from entries').fetchall():
+            yield key_hash
+
+    def entry_sizes(self):
+        '''
+        Yields a `(key_hash, size)` tuple for each entry, from least to most
+        recently used. Entries that have not been used since access times were
+        first recorded come first, oldest written first.
+        '''
+        self.flush_last_used()
+        yield from self._connection().execute(
+            'select key_hash, length from entries order by coalesce(last_used, 0), segment, offset').fetchall()
+
+    def flush_last_used(self):
+        '''
+        Writes the uses of entries that this process recorded, but did not
+        write to the index yet.
+        '''
+        with self._last_used_lock:
+            if self._last_used_pid != os.getpid():
+                # Forked; the parent writes its own uses.
+                self._last_used = {}
+                self._last_used_pid = os.getpid()
+            items = list(self._last_used.items())
+            self._last_used = {}
+            self._last_used_flushed_at = time.time()
+        self.set_last_used(items)
+
+    def set_last_used(self, items):
+        '''
+        Sets the last use times of entries, given as an iterable of
+        `(key_hash, last_used)` pairs where `last_used` is a Unix timestamp.
+        '''
+        rows = [(last_used, key_hash) for key_hash, last_used in items]
+        if rows:
+            with self._connection() as conn:
+                conn.executemany('update entries set last_used = ? where key_hash = ?', rows)
+
+    def delete_hashes(self, key_hashes):
+        '''
+        Removes the entries with the given key hashes from the index.
+        '''
+        with self._connection() as conn:
+            conn.executemany('delete from entries where key_hash = ?', ((h,) for h in key_hashes))
+
+    def compact(self):
+        '''
+        Rewrites all live entries into new segments and deletes the old ones,
+        reclaiming the space of deleted and replaced values. Entries keep
+        their last use time. Returns the number of bytes reclaimed. This is
+        not process-safe.
+        '''
+        self._close_writer()
+        old_segments = [
+            segment for (segment,) in
+            self._connection().execute('select segment from segments').fetchall()
+        ]
+        old_size = sum(os.path.getsize(self._segment_file(s)) for s in old_segments
+                       if os.path.exists(self._segment_file(s)))
+        batch = []
+        for (key_hash,) in self._connection().execute(
+                'select key_hash from entries order by segment, offset').fetchall():
+            batch.append((key_hash, self.get_by_hash(key_hash)))
+            if len(batch) >= 1000:
+                self.set_hashes(batch, keep_last_used=True)
+                batch = []
+        self.set_hashes(batch, keep_last_used=True)
+        self._close_writer()
+        self._mmaps = {}
+        with self._connection() as conn:
+            conn.executemany('delete from segments where segment = ?', ((s,) for s in old_segments))
+        for segment in old_segments:
+            try:
+                os.remove(self._segment_file(segment))
+            except FileNotFoundError:
+                pass
+        new_size = sum(os.path.getsize(os.path.join(self._segments_path, f))
+                       for f in os.listdir(self._segments_path))
+        return old_size - new_size
+
+    def set_hashes(self, items, keep_last_used=False):
+        '''
+        Stores an iterable of (key hash, value) pairs, where the key hash is
+        the SHA-1 digest of the key as bytes. Much faster than repeated
+        __setitem__ calls because it uses a single transaction. Writing an
+        entry counts as a use, unless `keep_last_used` is set and the entry
+        already exists, as when rewriting entries for maintenance.
+        '''
+        with self._write_lock:
+            rows = []
+            now = time.time()
+            for key_hash, value in items:
+                segment, offset = self._append(value)
+                rows.append((key_hash, segment, offset, len(value), key_hash if keep_last_used else None, now))
+            if not rows:
+                return
+            self._writer.flush()
+            with self._connection() as conn:
+                conn.executemany(_INSERT_ENTRY, rows)
+
+    def write_stream(self, key, chunks):
+        '''
+        Stores the value given as an iterable of bytes-like chunks, without
+        holding it in memory in full.
+        '''
+        with self._write_lock:
+            segment = offset = None
+            length = 0
+            for chunk in chunks:
+                # Only the first chunk may start a new segment.
+                chunk_segment, chunk_offset = self._append(chunk, reserve=segment is None)
+                if segment is None:
+                    segment, offset = chunk_segment, chunk_offset
+                length += len(chunk)
+            if segment is None:
+                segment, offset = self._append(b'')
+            self._writer.flush()
+            with self._connection() as conn:
+                conn.execute(_INSERT_ENTRY, (_hash_key(key), segment, offset, length, None, time.time()))
+
+    def _record_use(self, key_hash):
+        with self._last_used_lock:
+            if self._last_used_pid != os.getpid():
+                self._last_used = {}
+                self._last_used_pid = os.getpid()
+            now = time.time()
+            self._last_used[key_hash] = now
+            flush = (len(self._last_used) >= PackedCache._LAST_USED_BATCH_SIZE
+                     or now - self._last_used_flushed_at >= PackedCache._LAST_USED_BATCH_SECONDS)
+        if flush:
+            self.flush_last_used()
+
+    def _lookup(self, key_hash):
+        return self._connection().execute(
+            'select segment, offset, length from entries where key_hash = ?',
+            (key_hash,)).fetchone()
+
+    def _append(self, value, reserve=True):
+        '''
+        Appends the value to this process's current segment and returns
+        (segment, offset). Must be called with _write_lock held. If `reserve`
+        is False, never starts a new segment if there is a current one, to keep
+        the chunks of a single value together.
+        '''
+        if self._writer_pid != os.getpid():
+            # Forked; the parent still owns the file object we inherited.
+            self._writer = None
+            self._writer_pid = os.getpid()
+        if reserve and self._writer and self._writer.tell() + len(value) > PackedCache._MAX_SEGMENT_SIZE:
+            self._writer.close()
+            self._writer = None
+        if not self._writer:
+            with self._connection() as conn:
+                self._writer_segment = conn.execute(
+                    'insert into segments (pid) values (?)', (os.getpid(),)).lastrowid
+            self._writer = open(self._segment_file(self._writer_segment), 'ab')
+        offset = self._writer.tell()
+        self._writer.write(value)
+        return self._writer_segment, offset
+
+    def _close_writer(self):
+        with self._write_lock:
+            if self._writer and self._writer_pid == os.getpid():
+                self._writer.close()
+            self._writer = None
+
+    def _mmap(self, segment, min_size):
+        '''
+        Returns a read-only memory map of the segment that covers at least
+        `min_size` bytes, remapping it if it has grown since it was mapped.
+        '''
+        if self._mmaps_pid != os.getpid():
+            self._mmaps = {}
+            self._mmaps_pid = os.getpid()
+        mapped = self._mmaps.get(segment)
+        if mapped is None or len(mapped) < min_size:
+            with open(self._segment_file(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # The old map (if any) is closed when the last buffer into it is
+            # garbage collected.
+            self._mmaps[segment] = mapped
+        return mapped
+
+    def _segment_file(self, segment):
+        return os.path.join(self._segments_path, f'{segment:08d}.seg')
+
+    def _connection(self):
+        '''
+        Returns an SQLite connection to the index for use by the current
+        thread. Connections cannot be shared across threads or forks.
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(os.path.join(self._path, PackedCache.INDEX_FILE_NAME), timeout=60.0)
+            conn.execute('pragma journal_mode = wal')
+            conn.execute('pragma synchronous = normal')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+# All PackedCache instances that have not been garbage collected, for
+# flush_last_used().
+_open_caches = weakref.WeakSet()
+
+
+def flush_last_used():
+    '''
+    Writes the uses of entries that this process recorded in any PackedCache,
+    but did not write to the index yet.
+    '''
+    for cache in list(_open_caches):
+        cache.flush_last_used()
+
+
+# Inserts or replaces an entry given as `(key_hash, segment, offset, length,
+# keep_key_hash, last_used)`. If `keep_key_hash` is the key hash, an existing
+# entry keeps its last use time.
+_INSERT_ENTRY = '''
+    insert or replace into entries (key_hash, segment, offset, length, last_used)
+    values (?, ?, ?, ?, coalesce((select last_used from entries where key_hash = ?), ?))
+'''
+
+
+def _hash_key(key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    assert isinstance(key, bytes)
+    return hashlib.sha1(key).digest()
@@ -0,0 +1,320 @@
+'''
+Rate limiting and concurrency control per host, shared between all threads and
+processes of a pipeline run.
+'''
+
+import asyncio
+import atexit
+import contextlib
+import fcntl
+import json
+import logging
+import math
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+
+# Upper bounds on the number of concurrent requests to a host, summed over all
+# processes. This is the only such table; see max_concurrency(). The
+# OpenStreetMap tile usage policy asks for at most 2 connections.
+_MAX_CONCURRENCY = {
+    'www.xeno-canto.org': 16,
+    'en.wikipedia.org': 32,
+    'commons.wikimedia.org': 32,
+    'upload.wikimedia.org': 32,
+    'a.tile.openstreetmap.org': 2,
+    'b.tile.openstreetmap.org': 2,
+    'c.tile.openstreetmap.org': 2,
+}
+_DEFAULT_MAX_CONCURRENCY = 16
+
+# Request rates in requests per second. Each host starts at the initial rate,
+# and then adapts between the minimum and maximum.
+_INITIAL_RATE = 10.0
+_MIN_RATE = 0.5
+_MAX_RATE = 1000.0
+
+_INITIAL_CONCURRENCY = 4.0
+
+# On trouble, both rate and concurrency are multiplied by this factor. To
+# avoid a single burst of failures collapsing them, this happens at most once
+# per _DECREASE_INTERVAL seconds (or the typical latency, if longer).
+_DECREASE_FACTOR = 0.5
+_DECREASE_INTERVAL = 1.0
+
+# If the moving average of the latency (time to first byte) rises above this
+# many times its lowest value seen, that counts as trouble. The lowest value
+# slowly creeps up towards the average, so a single lucky streak is eventually
+# forgotten.
+_LATENCY_FACTOR = 4.0
+_LATENCY_SMOOTHING = 0.1
+_LATENCY_BASELINE_SMOOTHING = 0.01
+
+# Statuses that mean the server is overloaded.
+_OVERLOAD_STATUSES = frozenset([429] + list(range(500, 600)))
+
+# How long to wait before trying again if all concurrency slots are taken.
+_POLL_INTERVAL = 0.05
+
+_state_dir = None
+_state_dir_owner_pid = None
+
+
+def set_state_dir(path):
+    '''
+    Sets the directory containing the shared limiter state. All processes
+    that should share limits must use the same directory, so this must be
+    called before forking worker processes. If never called, a temporary
+    directory is created on first use.
+    '''
+    global _state_dir # pylint: disable=global-statement
+    _state_dir = path
+
+
+def _get_state_dir():
+    global _state_dir, _state_dir_owner_pid # pylint: disable=global-statement
+    if _state_dir is None:
+        _state_dir = tempfile.mkdtemp(prefix='rate_limiter.')
+        _state_dir_owner_pid = os.getpid()
+        atexit.register(_remove_state_dir)
+    return _state_dir
+
+
+def _remove_state_dir():
+    # Forked children inherit atexit handlers, but should leave the directory
+    # alone.
+    if os.getpid() == _state_dir_owner_pid:
+        shutil.rmtree(_state_dir, ignore_errors=True)
+
+
+class Outcome:
+    '''
+    The result of a request made while holding a HostLimiter slot, to be
+    filled in by the caller. Leaving `status` as None means the request failed
+    without a response. `latency` should be the time until the response
+    headers arrived, so that it does not depend on the size of the response
+    body; if left as None, the time the slot was held is used instead.
+    '''
+
+    def __init__(self):
+        self.status = None
+        self.retry_after = None
+        self.latency = None
+        self.wait_time = 0.0
+
+
+class HostLimiter:
+    '''
+    Token bucket rate limiter combined with a limit on concurrent requests,
+    for a single host. The state lives in a file that is locked on every
+    access, so all threads and processes using the same state directory share
+    the same limits.
+
+    Both the rate and the concurrency limit adapt using additive increase,
+    multiplicative decrease (AIMD): they grow slowly while responses are
+    healthy, and are halved on 429 or 5xx responses, connection errors, or
+    time to first byte far above normal. Like TCP, they start out growing
+    exponentially until the first such trouble. A Retry-After header pauses
+    all requests to the host.
+
+    A slot should be held until the response body has been read, so that
+    the concurrency limit also covers the transfer of large bodies.
+    '''
+
+    def __init__(self, host):
+        self._host = host
+        self._max_concurrency = max_concurrency(host)
+
+    @contextlib.contextmanager
+    def slot(self):
+        '''
+        Context manager that waits until a request to the host is allowed, and
+        yields an Outcome to be filled in with the result of the request.
+        '''
+        outcome = Outcome()
+        start_time = time.time()
+        while True:
+            wait_time = self._try_acquire()
+            if not wait_time:
+                break
+            time.sleep(wait_time)
+        with self._held(outcome, start_time):
+            yield outcome
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self):
+        '''
+        Like slot(), but waits without blocking the event loop.
+        '''
+        outcome = Outcome()
+        start_time = time.time()
+        while True:
+            wait_time = self._try_acquire()
+            if not wait_time:
+                break
+            await asyncio.sleep(wait_time)
+        with self._held(outcome, start_time):
+            yield outcome
+
+    @contextlib.contextmanager
+    def _held(self, outcome, start_time):
+        acquired_time = time.time()
+        outcome.wait_time = acquired_time - start_time
+        try:
+            yield
+        finally:
+            self._release(outcome, outcome.latency if outcome.latency is not None else time.time() - acquired_time)
+
+    def _try_acquire(self):
+        '''
+        Takes a slot and a token if possible and returns 0; otherwise returns
+        the number of seconds to wait before trying again.
+        '''
+        with self._state() as state:
+            now = time.time()
+            _refill(state, now)
+            if now < state['blocked_until']:
+                return state['blocked_until'] - now
+            if sum(state['in_flight'].values()) >= math.floor(state['concurrency']):
+                _forget_dead_processes(state)
+                return _POLL_INTERVAL
+            if state['tokens'] < 1:
+                return (1 - state['tokens']) / state['rate']
+            state['tokens'] -= 1
+            pid = str(os.getpid())
+            state['in_flight'][pid] = state['in_flight'].get(pid, 0) + 1
+            return 0
+
+    def _release(self, outcome, latency):
+        with self._state() as state:
+            now = time.time()
+            pid = str(os.getpid())
+            state['in_flight'][pid] = state['in_flight'].get(pid, 1) - 1
+            if not state['in_flight'][pid]:
+                del state['in_flight'][pid]
+
+            trouble = None
+            if outcome.status is None:
+                trouble = 'connection error'
+            elif outcome.status in _OVERLOAD_STATUSES:
+                trouble = f'status {outcome.status}'
+            else:
+                latency_average = state['latency_average']
+                if latency_average is None:
+                    latency_average = latency
+                latency_average += _LATENCY_SMOOTHING * (latency - latency_average)
+                state['latency_average'] = latency_average
+                latency_baseline = state['latency_baseline']
+                if latency_baseline is None or latency_average < latency_baseline:
+                    latency_baseline = latency_average
+                latency_baseline += _LATENCY_BASELINE_SMOOTHING * (latency_average - latency_baseline)
+                state['latency_baseline'] = latency_baseline
+                if latency_average > _LATENCY_FACTOR * latency_baseline > 0:
+                    trouble = f'average latency of {latency_average:.2f} s'
+
+            if outcome.retry_after:
+                state['blocked_until'] = max(state['blocked_until'], now + outcome.retry_after)
+            if trouble:
+                decrease_interval = max(_DECREASE_INTERVAL, state['latency_average'] or 0)
+                if now - state['decreased_at'] >= decrease_interval:
+                    state['rate'] = max(_MIN_RATE, state['rate'] * _DECREASE_FACTOR)
+                    state['concurrency'] = max(1.0, state['concurrency'] * _DECREASE_FACTOR)
+                    state['tokens'] = min(state['tokens'], 1.0)
+                    state['decreased_at'] = now
+                    logging.debug(f'Slowing down {self._host} to {state["rate"]:.1f} requests per second and '
+                                  f'{math.floor(state["concurrency"])} concurrent requests because of {trouble}')
+            elif not state['decreased_at']:
+                # Slow start: until the first sign of trouble, grow
+                # exponentially, doubling about every n successes.
+                state['rate'] = min(_MAX_RATE, state['rate'] + 1)
+                state['concurrency'] = min(self._max_concurrency, state['concurrency'] + 1)
+            else:
+                # Each success adds 1/n, so this adds about 1 per n successes.
+                state['rate'] = min(_MAX_RATE, state['rate'] + 1 / state['rate'])
+                state['concurrency'] = min(self._max_concurrency, state['concurrency'] + 1 / state['concurrency'])
+
+    @contextlib.contextmanager
+    def _state(self):
+        '''
+        Context manager that locks the state file, and yields the state as a
+        dict, which is written back afterwards.
+        '''
+        file_name = os.path.join(_get_state_dir(), f'{self._host}.json')
+        fd = os.open(file_name, os.O_RDWR | os.O_CREAT, 0o644)
+        with open(fd, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+            if data:
+                state = json.loads(data)
+            else:
+                state = {
+                    'rate': _INITIAL_RATE,
+                    'tokens': 1.0,
+                    'updated_at': time.time(),
+                    'concurrency': min(_INITIAL_CONCURRENCY, self._max_concurrency),
+                    'in_flight': {},
+                    'latency_average': None,
+                    'latency_baseline': None,
+                    'decreased_at': 0.0,
+                    'blocked_until': 0.0,
+                }
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state).encode('utf-8'))
+            # Closing the file releases the lock.
+
+
+def _refill(state, now):
+    # Allow bursts of up to one second's worth of requests.
+    burst = max(1.0, state['rate'])
+    state['tokens'] = min(burst, state['tokens'] + (now - state['updated_at']) * state['rate'])
+    state['updated_at'] = now
+
+
+def _forget_dead_processes(state):
+    '''
+    Releases the slots held by processes that no longer exist, for example
+    because they crashed in the middle of a request.
+    '''
+    for pid in list(state['in_flight']):
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            del state['in_flight'][pid]
+
+
+def max_concurrency(host):
+    '''
+    Returns the upper bound on the number of concurrent requests to the given
+    host, summed over all processes.
+    '''
+    return _MAX_CONCURRENCY.get(host, _DEFAULT_MAX_CONCURRENCY)
+
+
+_limiters = {}
+
+
+def for_host(host):
+    '''
+    Returns the HostLimiter for the given host name.
+    '''
+    limiter = _limiters.get(host)
+    if limiter is None:
+        limiter = HostLimiter(host)
+        _limiters[host] = limiter
+    return limiter
+
+
+def parse_retry_after(value):
+    '''
+    Returns the number of seconds in a Retry-After header, or None if it is
+    missing or not a number of seconds.
+    '''
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
@@ -7,8 +7,9 @@ import csv
 import logging
 import os.path
 
-from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, Date, Enum, JSON, ForeignKey
+from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, Date, Enum, JSON, ForeignKey, Index
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import text
 
 from base import Base
 
@@ -53,6 +54,16 @@ class Recording(Base):
     selected_recording = relationship('SelectedRecording', back_populates='recording', uselist=False)
     sonogram_analysis = relationship('SonogramAnalysis', back_populates='recording', uselist=False)
 
+    __table_args__ = (
+        # For joining a species' recordings to other tables by recording id
+        # without reading the recordings themselves.
+        Index('ix_recordings_scientific_name_recording_id', 'scientific_name', 'recording_id'),
+        # For counting a species' usable recordings; queries must spell out
+        # the same conditions for SQLite to use it.
+        Index('ix_recordings_scientific_name_usable', 'scientific_name',
+              sqlite_where=text("url <> '' and audio_url <> '' and sonogram_url_small <> ''")),
+    )
+
     @property
     def types(self):
         return list(filter(None, map(str.strip, self.type.lower().split(','))))
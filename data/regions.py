@@ -2,7 +2,8 @@
 Classes related to geography.
 '''
 
-from sqlalchemy import Column, Integer, Float, JSON
+import numpy as np
+from sqlalchemy import Column, Integer, Float, Boolean, ForeignKey
 
 from base import Base
 
@@ -10,8 +11,9 @@ from base import Base
 class Region(Base):
     '''
     A region on the globe representing a "square" of a particular size, aligned
-    along the latitude and longitude axes. Contains a weight by species, based
-    on the number of observations of this species in this region.
+    along the latitude and longitude axes. The weight of each species in it,
+    based on the number of observations of this species in this region, is
+    stored in RegionSpeciesWeight.
     '''
     __tablename__ = 'regions'
 
@@ -22,31 +24,6 @@ class Region(Base):
     lon_end = Column(Float, nullable=False, index=True)
     centroid_lat = Column(Float, nullable=False)
     centroid_lon = Column(Float, nullable=False)
-    species_weight_by_scientific_name = Column(JSON)
-
-    def total_weight(self):
-        '''
-        Returns the total number of recordings counted in this region.
-        '''
-        if not self.species_weight_by_scientific_name:
-            return 0
-        return sum(self.species_weight_by_scientific_name.values())
-
-    def num_species(self):
-        '''
-        Returns the total number of distinct species counted in this region.
-        '''
-        if not self.species_weight_by_scientific_name:
-            return 0
-        return len(self.species_weight_by_scientific_name)
-
-    @property
-    def scientific_names(self):
-        '''
-        Returns a list of scientific names of all species occurring in this
-        region.
-        '''
-        return list(self.species_weight_by_scientific_name.keys())
 
     def to_wkt(self):
         '''
@@ -62,17 +39,183 @@ class Region(Base):
         ]
         return f'POLYGON(({",".join(" ".join(map(str, corner)) for corner in corners)}))'
 
-    def ranked_scientific_names(self):
+
+class RegionSpeciesWeight(Base):
+    '''
+    The weight of a species in a region, based on the number of observations
+    of this species in this region. Species that were not observed in a
+    region have no row.
+    '''
+    __tablename__ = 'region_species_weights'
+
+    region_id = Column(Integer, ForeignKey('regions.region_id'), primary_key=True, nullable=False)
+    species_id = Column(Integer, ForeignKey('species.species_id'), primary_key=True, nullable=False,
+                        index=True)
+    weight = Column(Integer, nullable=False)
+
+
+class RegionTreeNode(Base):
+    '''
+    A cell of the region tree, a quadtree over the regions built by the
+    build_region_tree stage. A cell at level 0 is a single region; each level
+    up, a cell covers 2×2 cells of the level below. Only cells that contain
+    observations are stored. The leaves cover all observed regions without
+    overlap.
+    '''
+    __tablename__ = 'region_tree_nodes'
+
+    node_id = Column(Integer, primary_key=True, nullable=False)
+    parent_id = Column(Integer, ForeignKey('region_tree_nodes.node_id'), index=True)
+    level = Column(Integer, nullable=False)
+    is_leaf = Column(Boolean, nullable=False, index=True)
+    lat_start = Column(Float, nullable=False)
+    lat_end = Column(Float, nullable=False)
+    lon_start = Column(Float, nullable=False)
+    lon_end = Column(Float, nullable=False)
+    # Centroid of the observations, rather than of the cell.
+    centroid_lat = Column(Float, nullable=False)
+    centroid_lon = Column(Float, nullable=False)
+    num_regions = Column(Integer, nullable=False)
+    num_species = Column(Integer, nullable=False)
+    total_weight = Column(Integer, nullable=False)
+
+
+class RegionTreeNodeSpeciesWeight(Base):
+    '''
+    The weight of a species in a region tree node, which is the sum of its
+    weights in the regions covered by the node.
+    '''
+    __tablename__ = 'region_tree_node_species_weights'
+
+    node_id = Column(Integer, ForeignKey('region_tree_nodes.node_id'), primary_key=True, nullable=False)
+    species_id = Column(Integer, ForeignKey('species.species_id'), primary_key=True, nullable=False)
+    weight = Column(Integer, nullable=False)
+
+
+class WeightMatrix:
+    '''
+    All region species weights as a sparse matrix in compressed sparse row
+    (CSR) format, with a row for each region and a column for each species.
+    For region row `i`, the species columns are in
+    `indices[indptr[i]:indptr[i + 1]]`, and their weights in the same range of
+    `weights`. The region and species ids of the rows and columns are in
+    `region_ids` and `species_ids`.
+    '''
+
+    def __init__(self, region_ids, species_ids, indptr, indices, weights):
+        self.region_ids = region_ids
+        self.species_ids = species_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.region_index = {region_id: i for i, region_id in enumerate(region_ids.tolist())}
+        self.species_index = {species_id: i for i, species_id in enumerate(species_ids.tolist())}
+
+    @staticmethod
+    def load(session):
         '''
-        Returns the list of scientific names of species recorded in this
-        region, ordered from most to least recorded.
+        Loads the matrix, including empty rows for regions without any
+        observations.
         '''
-        if not self.species_weight_by_scientific_name:
-            return []
-        return [
-            scientific_name
-            for (weight, scientific_name)
-            in sorted(
-                ((v, k) for k, v in self.species_weight_by_scientific_name.items()),
-                reverse=True)
-        ]
+        return WeightMatrix._load(
+            session.query(Region.region_id),
+            session.query(RegionSpeciesWeight.region_id, RegionSpeciesWeight.species_id,
+                          RegionSpeciesWeight.weight))
+
+    @staticmethod
+    def load_region_tree_leaves(session):
+        '''
+        Loads the matrix of the leaves of the region tree, with node ids in
+        place of region ids.
+        '''
+        return WeightMatrix._load(
+            session.query(RegionTreeNode.node_id).filter(RegionTreeNode.is_leaf),
+            session.query(RegionTreeNodeSpeciesWeight.node_id, RegionTreeNodeSpeciesWeight.species_id,
+                          RegionTreeNodeSpeciesWeight.weight)
+            .join(RegionTreeNode)
+            .filter(RegionTreeNode.is_leaf))
+
+    @staticmethod
+    def _load(region_id_query, weight_query):
+        region_ids = np.array(
+            sorted(region_id for region_id, in region_id_query),
+            dtype=np.int64)
+        rows = np.array(weight_query.all(), dtype=np.int64).reshape(-1, 3)
+        rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+        species_ids, indices = np.unique(rows[:, 1], return_inverse=True)
+        row_indices = np.searchsorted(region_ids, rows[:, 0])
+        indptr = np.zeros(len(region_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_indices, minlength=len(region_ids)), out=indptr[1:])
+        return WeightMatrix(region_ids, species_ids, indptr, indices.astype(np.int64), rows[:, 2])
+
+    @property
+    def shape(self):
+        return len(self.region_ids), len(self.species_ids)
+
+    def num_species_by_region(self):
+        '''
+        Returns the number of species observed in each region.
+        '''
+        return np.diff(self.indptr)
+
+    def total_weight_by_region(self):
+        '''
+        Returns the total weight of all species in each region.
+        '''
+        cumulative = np.concatenate([[0], np.cumsum(self.weights)])
+        return cumulative[self.indptr[1:]] - cumulative[self.indptr[:-1]]
+
+    def row(self, region_index):
+        '''
+        Returns the species ids and weights in the given region row, ordered
+        from highest to lowest weight.
+        '''
+        start, end = self.indptr[region_index], self.indptr[region_index + 1]
+        order = np.argsort(-self.weights[start:end], kind='stable')
+        return self.species_ids[self.indices[start:end][order]], self.weights[start:end][order]
+
+
+_EARTH_RADIUS_KM = 6371.0
+
+
+class SpeciesRanges:
+    '''
+    Summary statistics of where each species occurs, computed in one pass over
+    a WeightMatrix, for ranking species. All attributes are arrays in the
+    order of the matrix's `species_ids`:
+
+    - `num_regions`: the number of regions in which the species was observed.
+    - `total_weight`: the total number of observations.
+    - `spread_km`: the typical great-circle distance of observations from
+      their mean location; 0 for a species seen in only one region, and
+      about 10000 km for one seen evenly all over the globe.
+    - `population_coverage`: the total population of the regions in which the
+      species was observed, if region populations were given.
+    '''
+
+    def __init__(self, weight_matrix, centroid_lats, centroid_lons, region_populations=None):
+        num_species = len(weight_matrix.species_ids)
+        indices = weight_matrix.indices
+        weights = weight_matrix.weights
+        rows = np.repeat(np.arange(len(weight_matrix.region_ids)), np.diff(weight_matrix.indptr))
+
+        self.species_ids = weight_matrix.species_ids
+        self.num_regions = np.bincount(indices, minlength=num_species)
+        self.total_weight = np.bincount(indices, weights=weights, minlength=num_species).astype(np.int64)
+
+        # The length of the weighted mean of unit vectors pointing to the
+        # region centroids is the cosine of the typical angle between them
+        # and their mean direction.
+        lats = np.radians(centroid_lats)
+        lons = np.radians(centroid_lons)
+        unit_vectors = np.stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)], axis=1)
+        mean_vectors = np.stack([
+            np.bincount(indices, weights=weights * unit_vectors[rows, i], minlength=num_species)
+            for i in range(3)
+        ], axis=1) / np.maximum(self.total_weight, 1)[:, np.newaxis]
+        self.spread_km = _EARTH_RADIUS_KM * np.arccos(np.clip(np.linalg.norm(mean_vectors, axis=1), 0, 1))
+
+        self.population_coverage = None
+        if region_populations is not None:
+            self.population_coverage = np.bincount(
+                indices, weights=region_populations[rows], minlength=num_species).astype(np.int64)
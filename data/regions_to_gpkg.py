@@ -9,7 +9,7 @@ import os.path
 from osgeo import gdal, ogr, osr
 from sqlalchemy.orm import joinedload
 
-from regions import Region
+from regions import Region, WeightMatrix
 from species import Species, SelectedSpecies
 
 
@@ -24,7 +24,7 @@ def main(args, session):
 
     logging.info(f'Loading common names')
     common_names = {
-        species.scientific_name: {
+        species.species_id: {
             common_name.language_code: common_name.common_name
             for common_name in species.common_names
         }
@@ -33,12 +33,17 @@ def main(args, session):
     }
 
     logging.info(f'Loading selected species')
-    selected_scientific_names = set(
-        species.scientific_name
+    selected_species_ids = set(
+        species.species_id
         for species in session.query(Species)\
             .join(SelectedSpecies)
     )
 
+    logging.info(f'Loading region species weights')
+    weight_matrix = WeightMatrix.load(session)
+    num_species_by_region = weight_matrix.num_species_by_region()
+    total_weight_by_region = weight_matrix.total_weight_by_region()
+
     try:
         os.remove(args.gpkg_file)
         logging.info(f'Deleted previous file {args.gpkg_file}')
@@ -59,26 +64,27 @@ def main(args, session):
     layer.CreateField(ogr.FieldDefn('ranked_selected_species_nl', ogr.OFTString))
 
     for region in session.query(Region):
-        if region.num_species() > 0:
+        region_index = weight_matrix.region_index[region.region_id]
+        if num_species_by_region[region_index] > 0:
+            ranked_species_ids = weight_matrix.row(region_index)[0].tolist()
+            ranked_selected_species_ids = [
+                species_id for species_id in ranked_species_ids if species_id in selected_species_ids]
             feature = ogr.Feature(layer.GetLayerDefn())
             feature.SetGeometry(ogr.CreateGeometryFromWkt(region.to_wkt()))
             feature['region_id'] = region.region_id
-            feature['num_observed_species'] = region.num_species()
-            feature['num_selected_species'] = len(
-                set(region.scientific_names).intersection(selected_scientific_names))
-            feature['total_weight'] = region.total_weight()
+            feature['num_observed_species'] = int(num_species_by_region[region_index])
+            feature['num_selected_species'] = len(ranked_selected_species_ids)
+            feature['total_weight'] = int(total_weight_by_region[region_index])
             feature['ranked_observed_species_en'] = ', '.join(
-                common_names.get(scientific_name, {}).get('en') or '?'
-                for scientific_name in region.ranked_scientific_names())
+                common_names.get(species_id, {}).get('en') or '?'
+                for species_id in ranked_species_ids)
             feature['ranked_observed_species_nl'] = ', '.join(
-                common_names.get(scientific_name, {}).get('nl') or '?'
-                for scientific_name in region.ranked_scientific_names())
+                common_names.get(species_id, {}).get('nl') or '?'
+                for species_id in ranked_species_ids)
             feature['ranked_selected_species_en'] = ', '.join(
-                common_names.get(scientific_name, {}).get('en') or '?'
-                for scientific_name in region.ranked_scientific_names()
-                if scientific_name in selected_scientific_names)
+                common_names.get(species_id, {}).get('en') or '?'
+                for species_id in ranked_selected_species_ids)
             feature['ranked_selected_species_nl'] = ', '.join(
-                common_names.get(scientific_name, {}).get('nl') or '?'
-                for scientific_name in region.ranked_scientific_names()
-                if scientific_name in selected_scientific_names)
+                common_names.get(species_id, {}).get('nl') or '?'
+                for species_id in ranked_selected_species_ids)
             layer.CreateFeature(feature)
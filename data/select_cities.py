@@ -6,15 +6,13 @@ is defined as having greater population. "Nearby" is defined as within a fixed
 distance (in km) as the crow flies.
 '''
 
-import io
 import logging
 import math
 import os
-import zipfile
 
 import rtree
 
-from cities import City
+from cities import City, read_cities_file
 import progress
 
 
@@ -89,25 +87,11 @@ def main(args, session):
     cities = []
     cities_by_id = {}
     points = {}
-    with zipfile.ZipFile(args.cities_file, 'r') as zip_file:
-        file_name = zip_file.namelist()[0]
-        logging.info(f'Loading {file_name} from {args.cities_file}')
-        with zip_file.open(file_name, 'r') as tsv_file:
-            for line in io.TextIOWrapper(tsv_file):
-                row = line.rstrip('\n').split('\t')
-                city = City(
-                    city_id=int(row[0]),
-                    name=row[1],
-                    lat=float(row[4]),
-                    lon=float(row[5]),
-                    population=int(row[14]))
-                if city.population <= 0:
-                    continue
-                cities.append(city)
-                cities_by_id[city.city_id] = city
-                points[city.city_id] = _lat_lon_to_point(city.lat, city.lon)
-                #if len(cities) >= 10000:
-                #   break
+    logging.info(f'Loading {args.cities_file}')
+    for city in read_cities_file(args.cities_file):
+        cities.append(city)
+        cities_by_id[city.city_id] = city
+        points[city.city_id] = _lat_lon_to_point(city.lat, city.lon)
     max_population = max(city.population for city in cities)
     logging.info(f'Loaded {len(cities)} cities; maximum population is {max_population}')
 
@@ -3,14 +3,21 @@ Selects which species to include in the app, and writes them to the
 `selected_species` table.
 '''
 
-import collections
 import logging
 
-from sqlalchemy.sql.expression import text
+import numpy as np
 
 import progress
-from regions import Region
+import species_counts
+from cities import read_cities_file
+from regions import Region, SpeciesRanges, WeightMatrix
 from species import Species, SelectedSpecies
+from species_counts import SpeciesCounts
+
+
+# Attributes of SpeciesRanges that species can be ranked by.
+_RANKINGS = ['num_regions', 'total_weight', 'spread_km', 'population_coverage']
+_DEFAULT_RANKING = 'num_regions'
 
 
 def add_args(parser):
@@ -24,6 +31,50 @@ def add_args(parser):
         '--min_image_size', type=int, default=512,
         help='Minimum image size for images (and thus species) '
         'to be selected for inclusion in the app')
+    parser.add_argument(
+        '--species_ranking', default=_DEFAULT_RANKING, choices=_RANKINGS,
+        help='How to rank candidate species for selection: by the number of regions they occur in, '
+        'their total number of observations, how far apart their observations are, or the total '
+        'population (according to --cities_file) of the regions they occur in')
+
+
+def _ranking_key(species_ranges, ranking):
+    value_by_species_id = dict(zip(
+        species_ranges.species_ids.tolist(), getattr(species_ranges, ranking).tolist()))
+    return lambda species: value_by_species_id.get(species.species_id, 0)
+
+
+def _region_populations(cities_file, region_bounds):
+    '''
+    Returns the total population of the cities in each region, given as rows
+    of `(lat_start, lat_end, lon_start, lon_end)`, or None if there are no
+    regions or none of them contains a city.
+    '''
+    if region_bounds.shape[0] == 0:
+        logging.warning('There are no regions to find cities in')
+        return None
+    logging.info(f'Loading city populations from {cities_file}')
+    cities = np.array(
+        [(city.lat, city.lon, city.population) for city in read_cities_file(cities_file)]).reshape(-1, 3)
+    # Regions form a grid, so regions and cities can be matched by grid cell.
+    size_lat = region_bounds[0, 1] - region_bounds[0, 0]
+    size_lon = region_bounds[0, 3] - region_bounds[0, 2]
+    region_index_by_cell = {
+        cell: i
+        for i, cell in enumerate(zip(np.round(region_bounds[:, 0] / size_lat).astype(np.int64).tolist(),
+                                     np.round(region_bounds[:, 2] / size_lon).astype(np.int64).tolist()))
+    }
+    region_indices = np.array([
+        region_index_by_cell.get(cell, -1)
+        for cell in zip(np.floor(cities[:, 0] / size_lat).astype(np.int64).tolist(),
+                        np.floor(cities[:, 1] / size_lon).astype(np.int64).tolist())
+    ], dtype=np.int64)
+    in_region = region_indices >= 0
+    logging.info(f'Found {in_region.sum()} of {len(cities)} cities in regions')
+    if not in_region.any():
+        logging.warning('No region contains any city')
+        return None
+    return np.bincount(region_indices[in_region], weights=cities[in_region, 2], minlength=len(region_bounds))
 
 
 def main(args, session):
@@ -31,51 +82,42 @@ def main(args, session):
     session.query(SelectedSpecies).delete()
 
     logging.info('Filtering species by sufficient available recordings and images')
+    species_counts.ensure_populated(session)
     candidate_species = session.query(Species)\
-        .filter(text(
-            '''
-            (
-                select count(*)
-                from recordings
-                where
-                    recordings.scientific_name = species.scientific_name
-                    and recordings.url is not null
-                    and recordings.url <> ''
-                    and recordings.audio_url is not null
-                    and recordings.audio_url <> ''
-                    and recordings.sonogram_url_small is not null
-                    and recordings.sonogram_url_small <> ''
-            ) >= :min_num_recordings
-            and
-            exists (
-                select *
-                from images
-                where
-                    images.species_id = species.species_id
-                    and output_file_name is not null
-                    and output_file_name <> ''
-                    and license_name is not null
-                    and license_name <> ''
-                    and image_width >= :min_image_size
-                    and image_height >= :min_image_size
-            )
-            '''))\
-        .params(
-            num_selected_species=args.num_selected_species,
-            min_image_size=args.min_image_size,
-            min_num_recordings=args.min_num_recordings)\
+        .join(SpeciesCounts)\
+        .filter(SpeciesCounts.num_usable_recordings >= args.min_num_recordings,
+                SpeciesCounts.best_image_size >= args.min_image_size)\
+        .order_by(Species.species_id)\
         .all()
 
-    logging.info('Counting number of regions in which species occur')
-    num_regions_by_species = collections.defaultdict(int)
-    for region in progress.percent(session.query(Region).all()):
-        for scientific_name in region.scientific_names:
-            num_regions_by_species[scientific_name] += 1
+    logging.info('Computing species ranges')
+    weight_matrix = WeightMatrix.load(session)
+    regions = np.array(
+        session.query(Region.centroid_lat, Region.centroid_lon, Region.lat_start, Region.lat_end,
+                      Region.lon_start, Region.lon_end)
+        .order_by(Region.region_id)
+        .all()).reshape(-1, 6)
+    species_ranking = args.species_ranking
+    region_populations = None
+    if species_ranking == 'population_coverage':
+        region_populations = _region_populations(args.cities_file, regions[:, 2:])
+        if region_populations is None:
+            logging.warning(f'Cannot rank by population coverage; ranking by {_DEFAULT_RANKING} instead')
+            species_ranking = _DEFAULT_RANKING
+    species_ranges = SpeciesRanges(weight_matrix, regions[:, 0], regions[:, 1], region_populations)
+
+    logging.info(f'Sorting candidate species by {species_ranking}')
+    candidate_species.sort(key=_ranking_key(species_ranges, species_ranking), reverse=True)
 
-    logging.info('Sorting candidate species by number of regions')
-    candidate_species.sort(
-        key=lambda s: num_regions_by_species.get(s.scientific_name, 0),
-        reverse=True)
+    # Other rankings are cheap to evaluate, so show how they compare.
+    selected_species_ids = {s.species_id for s in candidate_species[:args.num_selected_species]}
+    for ranking in _RANKINGS:
+        if ranking == species_ranking or getattr(species_ranges, ranking) is None:
+            continue
+        alternative = sorted(candidate_species, key=_ranking_key(species_ranges, ranking), reverse=True)
+        num_shared = len(selected_species_ids.intersection(
+            s.species_id for s in alternative[:args.num_selected_species]))
+        logging.info(f'Ranking by {ranking} would select {num_shared} of the same species')
 
     logging.info('Selecting top species')
     selected_species = candidate_species[:args.num_selected_species]
@@ -0,0 +1,101 @@
+'''
+Per-species counts of recordings and images, which are needed to decide which
+species are candidates for selection. They are kept up to date by the stages
+that change the underlying tables, so that readers do not need to count
+recordings themselves.
+'''
+
+import logging
+
+from sqlalchemy import Column, Integer, ForeignKey, Index
+from sqlalchemy.sql.expression import bindparam, text
+
+from base import Base
+
+
+class SpeciesCounts(Base):
+    '''
+    Counts for a single species. A recording is usable if it has a page URL,
+    an audio URL and a small sonogram. The best image size is the smaller
+    dimension of the species' image, if it has one with an output file name
+    and a license.
+    '''
+    __tablename__ = 'species_counts'
+
+    species_id = Column(Integer, ForeignKey('species.species_id'), primary_key=True, nullable=False)
+    num_recordings = Column(Integer, nullable=False)
+    num_usable_recordings = Column(Integer, nullable=False)
+    num_analyzed_recordings = Column(Integer, nullable=False)
+    best_image_size = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_species_counts_num_usable_recordings_best_image_size',
+              'num_usable_recordings', 'best_image_size'),
+    )
+
+
+_REFRESH_QUERY = '''
+    insert or replace into species_counts
+        (species_id, num_recordings, num_usable_recordings, num_analyzed_recordings, best_image_size)
+    select
+        species.species_id,
+        (
+            select count(*)
+            from recordings
+            where recordings.scientific_name = species.scientific_name
+        ),
+        (
+            select count(*)
+            from recordings
+            where
+                recordings.scientific_name = species.scientific_name
+                and recordings.url <> ''
+                and recordings.audio_url <> ''
+                and recordings.sonogram_url_small <> ''
+        ),
+        (
+            select count(*)
+            from recordings
+            join sonogram_analyses on sonogram_analyses.recording_id = recordings.recording_id
+            where recordings.scientific_name = species.scientific_name
+        ),
+        (
+            select max(min(image_width, image_height))
+            from images
+            where
+                images.species_id = species.species_id
+                and images.output_file_name <> ''
+                and images.license_name <> ''
+        )
+    from species
+'''
+
+# Keeps the number of SQL variables per statement well below SQLite's limit.
+_REFRESH_BATCH_SIZE = 500
+
+
+def refresh(session, scientific_names=None):
+    '''
+    Recomputes the counts of the species with the given scientific names, or
+    of all species if none are given. Like any other change, the result is
+    committed along with the session.
+    '''
+    if scientific_names is None:
+        logging.info('Counting recordings and images of all species')
+        session.execute(text('delete from species_counts where species_id not in (select species_id from species)'))
+        session.execute(text(_REFRESH_QUERY))
+        return
+    scientific_names = sorted(set(scientific_names))
+    query = text(_REFRESH_QUERY + ' where species.scientific_name in :scientific_names')\
+        .bindparams(bindparam('scientific_names', expanding=True))
+    for start in range(0, len(scientific_names), _REFRESH_BATCH_SIZE):
+        session.execute(query, {'scientific_names': scientific_names[start:start + _REFRESH_BATCH_SIZE]})
+
+
+def ensure_populated(session):
+    '''
+    Counts all species if this has never been done, for example because the
+    master database predates the species_counts table.
+    '''
+    if not session.query(SpeciesCounts).first():
+        refresh(session)
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+'''
+Launches a local HTTP server that stands in for xeno-canto, Wikipedia,
+Wikimedia Commons and the OpenStreetMap tile servers, so that pipeline stages
+can be run and benchmarked without network access.
+
+Run master.py with `--standin_server http://localhost:8081` to send all
+requests here. The original URL is passed in the path, for example
+`http://localhost:8081/www.xeno-canto.org/api/2/recordings?query=...`.
+
+Responses are served from the cache if the URL was fetched before (including
+remembered failures), and otherwise made up to look like what the real server
+would return, so that the stages can process them.
+'''
+
+import argparse
+import functools
+import hashlib
+import http.server
+import io
+import json
+import logging
+import os
+import os.path
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+import PIL.Image
+import PIL.ImageDraw
+
+import fetcher
+from negative_cache import NegativeCache
+
+
+# Used for synthetic recordings if the query does not ask for a species.
+_SYNTHETIC_SPECIES = [
+    ('Turdus', 'merula', 'Common Blackbird'),
+    ('Erithacus', 'rubecula', 'European Robin'),
+    ('Parus', 'major', 'Great Tit'),
+    ('Cyanistes', 'caeruleus', 'Eurasian Blue Tit'),
+    ('Fringilla', 'coelebs', 'Common Chaffinch'),
+    ('Troglodytes', 'troglodytes', 'Eurasian Wren'),
+    ('Phylloscopus', 'collybita', 'Common Chiffchaff'),
+    ('Sylvia', 'atricapilla', 'Eurasian Blackcap'),
+    ('Columba', 'palumbus', 'Common Wood Pigeon'),
+    ('Sturnus', 'vulgaris', 'Common Starling'),
+]
+
+_RECORDINGS_PER_PAGE = 500
+
+_SYNTHETIC_AUDIO_DURATION_MS = 30000
+
+
+class _Responder:
+    '''
+    Decides on the response to a request for an original URL.
+    '''
+
+    def __init__(self, args):
+        self._args = args
+        self._caches = []
+        self._negative_caches = []
+        if args.mode != 'synthetic' and os.path.isdir(fetcher.CACHE_DIR):
+            for cache_group in sorted(os.listdir(fetcher.CACHE_DIR)):
+                path = os.path.join(fetcher.CACHE_DIR, cache_group)
+                if os.path.isdir(path):
+                    self._caches.append(fetcher.open_cache(cache_group))
+                    if NegativeCache.exists(path):
+                        self._negative_caches.append(NegativeCache(path))
+        self._random = random.Random(args.seed)
+        self._random_lock = threading.Lock()
+
+    def respond(self, url):
+        '''
+        Returns a `(status, content_type, body)` tuple.
+        '''
+        with self._random_lock:
+            delay = max(0.0, self._random.gauss(self._args.latency_ms, self._args.latency_jitter_ms)) / 1000
+            fail = self._random.random() < self._args.error_rate
+        time.sleep(delay)
+        if fail:
+            return 503, 'text/plain', b'Injected error'
+
+        if self._args.mode != 'synthetic':
+            recorded = self._recorded(url)
+            if recorded:
+                return recorded
+        if self._args.mode != 'recorded':
+            synthetic = _synthetic(url, self._args.synthetic_recordings)
+            if synthetic:
+                return synthetic
+        return 404, 'text/plain', b'Not found'
+
+    def _recorded(self, url):
+        rest = url.split('//', 1)[1]
+        # The cache key is the URL as the pipeline saw it, which could have
+        # any of these forms.
+        for key in (f'https://{rest}', f'http://{rest}', f'//{rest}'):
+            for cache in self._caches:
+                if key in cache:
+                    body = cache[key]
+                    return 200, _content_type(body), body
+            for negative_cache in self._negative_caches:
+                failure = negative_cache.get(key)
+                if failure:
+                    return failure[0], 'text/plain', b'Recorded failure'
+        return None
+
+
+def _content_type(body):
+    if body.startswith(b'\x89PNG'):
+        return 'image/png'
+    if body.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if body.startswith(b'{') or body.startswith(b'['):
+        return 'application/json'
+    return 'application/octet-stream'
+
+
+def _synthetic(url, num_recordings):
+    '''
+    Returns a made-up `(status, content_type, body)` tuple for the URL, or None
+    if it has an unknown form.
+    '''
+    split = urllib.parse.urlsplit(url)
+    params = dict(urllib.parse.parse_qsl(split.query))
+    seed = int.from_bytes(hashlib.sha1(url.encode('utf-8')).digest()[:8], 'big')
+
+    if split.netloc == 'www.xeno-canto.org':
+        if split.path == '/api/2/recordings':
+            return 200, 'application/json', _xc_page(params['query'], int(params.get('page', 1)), num_recordings)
+        if re.match(r'^/\d+/download$', split.path):
+            return 200, 'audio/mpeg', _audio()
+        m = re.match(r'^/sounds/uploaded/[^/]+/ffts/XC\d+-(small|med|large|full)\.png$', split.path)
+        if m:
+            size = {'small': (240, 160), 'med': (480, 320), 'large': (960, 640), 'full': (1920, 640)}[m.group(1)]
+            return 200, 'image/png', _sonogram(size, seed)
+    if split.path == '/w/api.php':
+        if params.get('action') == 'parse':
+            return 200, 'application/json', _wiki_parse(params['page'], params['prop'])
+        if params.get('action') == 'query' and params.get('prop') == 'imageinfo':
+            return 200, 'application/json', _wiki_image_info(params['titles'])
+    if split.netloc == 'upload.wikimedia.org':
+        return 200, 'image/jpeg', _image((1024, 768), seed, 'JPEG')
+    if split.netloc.endswith('tile.openstreetmap.org') and re.match(r'^/\d+/\d+/\d+\.png$', split.path):
+        return 200, 'image/png', _image((256, 256), seed, 'PNG')
+    return None
+
+
+def _xc_page(query, page, num_recordings):
+    '''
+    Returns a page of xeno-canto API results for the query. Only the `nr:`,
+    `gen:` and `sp:` search terms are taken into account.
+    '''
+    terms = dict(term.split(':', 1) for term in query.split() if ':' in term)
+    start_id, end_id = 1, num_recordings
+    if 'nr' in terms:
+        start_id, end_id = map(int, terms['nr'].split('-'))
+        end_id = min(end_id, start_id + num_recordings - 1)
+    ids = range(start_id, end_id + 1)
+    num_pages = max(1, (len(ids) + _RECORDINGS_PER_PAGE - 1) // _RECORDINGS_PER_PAGE)
+    page_ids = ids[(page - 1) * _RECORDINGS_PER_PAGE:page * _RECORDINGS_PER_PAGE]
+
+    recordings = []
+    for xc_id in page_ids:
+        if 'gen' in terms and 'sp' in terms:
+            genus, species, common_name = terms['gen'], terms['sp'], ''
+        else:
+            genus, species, common_name = _SYNTHETIC_SPECIES[xc_id % len(_SYNTHETIC_SPECIES)]
+        sonogram_url = f'//www.xeno-canto.org/sounds/uploaded/STANDIN/ffts/XC{xc_id}'
+        recordings.append({
+            'id': str(xc_id),
+            'gen': genus,
+            'sp': species,
+            'ssp': '',
+            'en': common_name,
+            'rec': 'Stand-in Recordist',
+            'cnt': 'Netherlands',
+            'loc': 'Utrecht',
+            'lat': f'{52 + (xc_id % 100) / 100:.4f}',
+            'lng': f'{5 + (xc_id % 100) / 100:.4f}',
+            'alt': '0',
+            'type': 'song',
+            'url': f'//www.xeno-canto.org/{xc_id}',
+            'file': f'https://www.xeno-canto.org/{xc_id}/download',
+            'file-name': f'XC{xc_id}-standin.mp3',
+            'sono': {
+                'small': f'{sonogram_url}-small.png',
+                'med': f'{sonogram_url}-med.png',
+                'large': f'{sonogram_url}-large.png',
+                'full': f'{sonogram_url}-full.png',
+            },
+            'lic': '//creativecommons.org/licenses/by-nc-sa/4.0/',
+            'q': 'ABCDE'[xc_id % 5],
+            'length': f'0:{_SYNTHETIC_AUDIO_DURATION_MS // 1000:02d}',
+            'time': '08:00',
+            'date': '2020-05-01',
+            'uploaded': '2020-05-02',
+            'also': [''],
+            'rmk': '',
+            'bird-seen': 'yes',
+            'playback-used': 'no',
+        })
+    return json.dumps({
+        'numRecordings': str(len(ids)),
+        'numSpecies': str(len(set((r['gen'], r['sp']) for r in recordings))),
+        'page': page,
+        'numPages': num_pages,
+        'recordings': recordings,
+    }).encode('utf-8')
+
+
+def _wiki_parse(page_name, prop):
+    '''
+    Returns a MediaWiki parse API response for a page about the species with
+    the given scientific name, with a species box containing an image.
+    '''
+    parts = page_name.replace('_', ' ').split()
+    genus, species = (parts + ['', ''])[:2]
+    image = f'{genus}_{species}_standin.jpg'
+    if prop == 'parsetree':
+        content = (
+            '<root><template><title>Speciesbox</title>'
+            f'<part><name>genus</name>=<value>{genus}</value></part>'
+            f'<part><name>species</name>=<value>{species}</value></part>'
+            f'<part><name>image</name>=<value>{image}</value></part>'
+            '</template></root>')
+    elif prop == 'wikitext':
+        content = f'{{{{Speciesbox|genus={genus}|species={species}|image={image}}}}}'
+    else:
+        content = f'<div class="mw-parser-output"><p>{genus} {species}</p></div>'
+    return json.dumps({
+        'parse': {'title': page_name, 'pageid': 1, prop: content},
+    }).encode('utf-8')
+
+
+def _wiki_image_info(title):
+    file_name = title.split(':', 1)[-1].replace(' ', '_')
+    digest = hashlib.md5(file_name.encode('utf-8')).hexdigest()
+    return json.dumps({
+        'query': {
+            'pages': [{
+                'title': title,
+                'imageinfo': [{
+                    'url': f'https://upload.wikimedia.org/wikipedia/commons/{digest[0]}/{digest[:2]}/{file_name}',
+                    'width': 1024,
+                    'height': 768,
+                    'mime': 'image/jpeg',
+                    'extmetadata': {
+                        'LicenseShortName': {'value': 'CC BY-SA 4.0'},
+                        'LicenseUrl': {'value': 'https://creativecommons.org/licenses/by-sa/4.0'},
+                        'Artist': {'value': 'Stand-in Photographer'},
+                        'AttributionRequired': {'value': 'true'},
+                    },
+                }],
+            }],
+        },
+    }).encode('utf-8')
+
+
+def _image(size, seed, image_format):
+    rng = random.Random(seed)
+    image = PIL.Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = PIL.ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        r = rng.randrange(5, max(6, size[0] // 4))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    output = io.BytesIO()
+    image.save(output, image_format)
+    return output.getvalue()
+
+
+def _sonogram(size, seed):
+    '''
+    Returns a PNG image that looks roughly like a xeno-canto sonogram: light
+    background noise with some darker calls.
+    '''
+    rng = random.Random(seed)
+    width, height = size
+    image = PIL.Image.frombytes('L', size, bytes(rng.randrange(215, 256) for _ in range(width * height)))
+    draw = PIL.ImageDraw.Draw(image)
+    for _ in range(rng.randrange(3, 12)):
+        x = rng.randrange(width)
+        y = rng.randrange(height // 2)
+        draw.rectangle((x, y, x + rng.randrange(2, width // 20 + 3), y + rng.randrange(2, height // 4)),
+                       fill=rng.randrange(0, 120))
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+@functools.lru_cache(maxsize=None)
+def _audio():
+    '''
+    Returns an MP3 file with some tones over background noise. Encoding needs
+    ffmpeg with MP3 support; without it, silence is returned instead.
+    '''
+    try:
+        import pydub # pylint: disable=import-outside-toplevel
+        import pydub.generators # pylint: disable=import-outside-toplevel
+        sound = pydub.generators.WhiteNoise().to_audio_segment(_SYNTHETIC_AUDIO_DURATION_MS, volume=-40)
+        for i, start_ms in enumerate(range(1000, _SYNTHETIC_AUDIO_DURATION_MS - 1000, 2500)):
+            tone = pydub.generators.Sine(2000 + 300 * (i % 5)).to_audio_segment(400 + 100 * (i % 4), volume=-10)
+            sound = sound.overlay(tone.fade_in(50).fade_out(50), position=start_ms)
+        output = io.BytesIO()
+        sound.export(output, format='mp3')
+        return output.getvalue()
+    except Exception as ex: # pylint: disable=broad-except
+        logging.warning(f'Could not encode synthetic audio, serving silence instead: {ex}')
+        return _silent_mp3(_SYNTHETIC_AUDIO_DURATION_MS)
+
+
+def _silent_mp3(duration_ms):
+    # MPEG-1 layer III, 128 kbit/s, 44.1 kHz, mono. With all-zero side
+    # information, each frame decodes to 1152 samples of silence.
+    header = bytes([0xff, 0xfb, 0x90, 0xc0])
+    frame = header + bytes(144 * 128000 // 44100 - len(header))
+    num_frames = duration_ms * 44100 // (1152 * 1000)
+    return frame * num_frames
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing their connections is business as usual.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _make_handler(responder):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self): # pylint: disable=invalid-name
+            original_url = 'https:/' + self.path
+            status, content_type, body = responder.respond(original_url)
+            # Support single byte ranges, as used for fetching recording
+            # prefixes.
+            m = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+            content_range = None
+            if status == 200 and m:
+                start = int(m.group(1))
+                end = min(int(m.group(2)) if m.group(2) else len(body) - 1, len(body) - 1)
+                if start >= len(body):
+                    status, content_range, body = 416, f'bytes */{len(body)}', b''
+                else:
+                    status, content_range, body = 206, f'bytes {start}-{end}/{len(body)}', body[start:end + 1]
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            if content_range:
+                self.send_header('Content-Range', content_range)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            logging.debug(format % args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--log_level', default='info', choices=['debug', 'info', 'warning', 'error', 'critical'],
+        help='Verbosity of logging')
+    parser.add_argument(
+        '--host', default='localhost',
+        help='Host name or address to listen on')
+    parser.add_argument(
+        '--port', type=int, default=8081,
+        help='Port to listen on')
+    parser.add_argument(
+        '--mode', default='both', choices=['recorded', 'synthetic', 'both'],
+        help='Serve only responses recorded in the cache, only synthetic responses, '
+        'or recorded responses where available and synthetic ones otherwise')
+    parser.add_argument(
+        '--synthetic_recordings', type=int, default=5000,
+        help='Number of recordings that the synthetic xeno-canto API returns for a query')
+    parser.add_argument(
+        '--latency_ms', type=float, default=0,
+        help='Average delay before responding to each request, in milliseconds')
+    parser.add_argument(
+        '--latency_jitter_ms', type=float, default=0,
+        help='Standard deviation of the delay, in milliseconds')
+    parser.add_argument(
+        '--error_rate', type=float, default=0,
+        help='Fraction of requests to answer with 503 Service Unavailable')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed for the random latencies and errors')
+    args = parser.parse_args()
+
+    log_level = getattr(logging, args.log_level.upper())
+    logging.basicConfig(level=log_level)
+
+    server = _Server((args.host, args.port), _make_handler(_Responder(args)))
+    logging.info(f'Stand-in server listening on http://{args.host}:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
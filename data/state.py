@@ -0,0 +1,49 @@
+'''
+Small pieces of state that stages keep between runs, such as how far an
+incremental fetch got.
+'''
+
+from sqlalchemy import Column, String, JSON
+
+from base import Base
+
+
+class StateValue(Base):
+    '''
+    A single JSON-serializable value, identified by a key that is namespaced
+    by the stage that owns it, for example `load_recordings.high_water_mark`.
+    '''
+    __tablename__ = 'state'
+
+    key = Column(String, primary_key=True, nullable=False)
+    value = Column(JSON)
+
+
+def get_value(session, key, default=None):
+    '''
+    Returns the value stored under the given key, or `default` if there is
+    none.
+    '''
+    state_value = session.query(StateValue).get(key)
+    if state_value is None:
+        return default
+    return state_value.value
+
+
+def set_value(session, key, value):
+    '''
+    Stores the value under the given key, replacing any previous value. Like
+    any other change, it is committed along with the session.
+    '''
+    session.merge(StateValue(key=key, value=value))
+
+
+def get_values_with_prefix(session, prefix):
+    '''
+    Returns a dict of all keys starting with the given prefix, with the prefix
+    removed, and their values.
+    '''
+    return {
+        state_value.key[len(prefix):]: state_value.value
+        for state_value in session.query(StateValue).filter(StateValue.key.startswith(prefix))
+    }
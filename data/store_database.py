@@ -7,13 +7,14 @@ import os
 import os.path
 import re
 
+import numpy as np
 from sqlalchemy import Table, Column, Integer, Float, String, LargeBinary, MetaData
 
 import db
 from images import Image
 from recordings import Recording, SelectedRecording
 from species import Species, SelectedSpecies, LANGUAGE_CODES
-from regions import Region
+from regions import RegionTreeNode, WeightMatrix
 from cities import City
 
 
@@ -32,24 +33,19 @@ def _make_absolute(url):
     return url
 
 
-def _encode_weights(weights_by_species_id):
+def _encode_weights(species_ids, weights):
     '''
-    Encodes the map as a raw byte array of `key,value,key,value,...`, both keys
-    and values being encoded as unsigned 16-bits integers in big-endian format.
+    Encodes the map from species ids to weights, given as two arrays, as a
+    raw byte array of `key,value,key,value,...`, both keys and values being
+    encoded as unsigned 16-bits integers in big-endian format.
 
-    >>> _weights_to_bytes({5: 18, 2: 16}).hex()
+    >>> _encode_weights(np.array([5, 2]), np.array([18, 16])).hex()
     '0005001200020010'
-    >>> _weights_to_bytes({1: 100000, 2: 10000}).hex()
+    >>> _encode_weights(np.array([1, 2]), np.array([100000, 10000])).hex()
     '0001ffff0002199a'
     '''
-    max_weight = max(weights_by_species_id.values())
-    scale = min(1, 65535 / max_weight)
-    def encode(i):
-        return i.to_bytes(2, byteorder='big', signed=False)
-    return b''.join(
-        encode(species_id) + encode(round(scale * weight))
-        for species_id, weight in weights_by_species_id.items()
-    )
+    scale = min(1, 65535 / weights.max())
+    return np.stack([species_ids, np.round(scale * weights)], axis=1).astype('>u2').tobytes()
 
 
 def main(_args, session):
@@ -150,25 +146,29 @@ def main(_args, session):
             .join(SelectedSpecies)
     ])
 
-    logging.info('Inserting nonempty regions')
-    out.execute(out_regions.insert(), [ # pylint: disable=no-value-for-parameter
-        {
-            'region_id': r.region_id,
-            'centroid_lat': r.centroid_lat,
-            'centroid_lon': r.centroid_lon,
-            'weight_by_species_id': _encode_weights({
-                selected_species_ids_by_scientific_name[scientific_name]: num_recordings
-                for scientific_name, num_recordings in r.species_weight_by_scientific_name.items()
-                if scientific_name in selected_species_ids_by_scientific_name
-            }),
-        }
-        for r in session.query(Region)\
-        .filter(Region.species_weight_by_scientific_name != None, # pylint: disable=singleton-comparison
-                Region.species_weight_by_scientific_name != [])
-        if any(
-            scientific_name in selected_species_ids_by_scientific_name
-            for scientific_name in r.species_weight_by_scientific_name)
-    ])
+    logging.info('Inserting nonempty leaves of the region tree')
+    weight_matrix = WeightMatrix.load_region_tree_leaves(session)
+    if weight_matrix.region_ids.size == 0:
+        raise ValueError('Region tree is empty; run the build_region_tree stage first')
+    # Keep only the entries for selected species, and the rows that have any.
+    selected = np.isin(weight_matrix.species_ids[weight_matrix.indices],
+                       list(selected_species_ids_by_scientific_name.values()))
+    selected_indptr = np.concatenate([[0], np.cumsum(selected)])[weight_matrix.indptr]
+    selected_species_ids = weight_matrix.species_ids[weight_matrix.indices[selected]]
+    selected_weights = weight_matrix.weights[selected]
+    region_rows = []
+    for r in session.query(RegionTreeNode).filter(RegionTreeNode.is_leaf):
+        region_index = weight_matrix.region_index[r.node_id]
+        start, end = selected_indptr[region_index], selected_indptr[region_index + 1]
+        if end > start:
+            region_rows.append({
+                'region_id': r.node_id,
+                'centroid_lat': r.centroid_lat,
+                'centroid_lon': r.centroid_lon,
+                'weight_by_species_id': _encode_weights(selected_species_ids[start:end],
+                                                        selected_weights[start:end]),
+            })
+    out.execute(out_regions.insert(), region_rows) # pylint: disable=no-value-for-parameter
 
     logging.info('Inserting cities')
     out.execute(out_cities.insert(), [ # pylint: disable=no-value-for-parameter
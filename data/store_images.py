@@ -3,7 +3,6 @@ Fetches images from Wikipedia (WikiMedia Commons), then resizes and compresses
 them for use in the app.
 '''
 
-import io
 import logging
 import multiprocessing
 import os.path
@@ -11,6 +10,8 @@ import signal
 
 import PIL
 
+import fetch_service
+import fetch_stats
 import fetcher
 import progress
 from images import Image
@@ -27,15 +28,15 @@ def _process_image(image):
 
     global _fetcher # pylint: disable=global-statement
     if not _fetcher:
-        _fetcher = fetcher.Fetcher('wp_images', pool_size=1)
+        _fetcher = fetch_service.worker_fetcher('wp_images')
 
     full_output_file_name = os.path.join(_args.image_output_dir, image.output_file_name)
     if os.path.exists(full_output_file_name) and not _args.recreate_images:
         return image.output_file_name
 
-    image_data = _fetcher.fetch_cached(image.image_file_url)
-
-    pil_image = PIL.Image.open(io.BytesIO(image_data))
+    # Let Pillow read straight from the cache file, rather than loading the
+    # entire original into memory first.
+    pil_image = PIL.Image.open(_fetcher.fetch_cached_file(image.image_file_url))
 
     if pil_image.width > _args.image_size or pil_image.height > _args.image_size:
         if pil_image.width >= pil_image.height:
@@ -87,13 +88,25 @@ def main(args, session):
     logging.info('Listing existing images')
     old_images = set(os.listdir(args.image_output_dir))
 
+    logging.info('Prefetching images')
+    missing_images = [
+        image for image in images
+        if args.recreate_images or
+        not os.path.exists(os.path.join(args.image_output_dir, image.output_file_name))
+    ]
+    for _url, error in progress.percent(
+            fetcher.prefetch('wp_images', (image.image_file_url for image in missing_images)),
+            len(missing_images)):
+        if error:
+            logging.error(f'Error prefetching {error.url}')
+
     logging.info('Resizing images')
     # https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python#35134329
     original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
     with multiprocessing.pool.Pool(args.image_process_jobs) as pool:
         signal.signal(signal.SIGINT, original_sigint_handler)
         for image_file_name in progress.percent(
-                pool.imap(_process_image, images),
+                fetch_stats.pool_imap(pool, _process_image, images),
                 len(images)):
             if image_file_name:
                 old_images.discard(image_file_name)
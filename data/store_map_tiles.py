@@ -12,10 +12,29 @@ import os.path
 import shutil
 import subprocess
 
-from fetcher import Fetcher
+import fetcher
 import progress
 
 
+DEFAULT_URL_FORMAT = 'https://b.tile.openstreetmap.org/{z}/{x}/{y}.png' # Subdomains: a, b, c
+DEFAULT_MAX_ZOOM_LEVEL = 4
+
+
+def tiles_and_urls(url_format, max_zoom_level):
+    '''
+    Returns a list of `(tile, url)` tuples for all tiles up to and including
+    the given zoom level, where `tile` is a dict with keys `z`, `x` and `y`.
+    '''
+    tiles = []
+    for z in range(0, max_zoom_level + 1):
+        n = 2**z
+        for x in range(n):
+            for y in range(n):
+                tile = {'z': z, 'x': x, 'y': y}
+                tiles.append((tile, url_format.format(**tile)))
+    return tiles
+
+
 def add_args(parser):
     parser.add_argument(
         '--map_tiles_output_dir', 
@@ -23,10 +42,10 @@ def add_args(parser):
         help='Target directory for offline map tiles')
     parser.add_argument(
         '--map_tiles_url_format',
-        default='https://b.tile.openstreetmap.org/{z}/{x}/{y}.png', # Subdomains: a, b, c
+        default=DEFAULT_URL_FORMAT,
         help='URL format for OpenStreetMap tile server')
     parser.add_argument(
-        '--max_zoom_level', type=int, default=4,
+        '--max_zoom_level', type=int, default=DEFAULT_MAX_ZOOM_LEVEL,
         help='Maximum zoom level to fetch; level 0 is 256×256'
         ' and each subsequent level is twice the scale')
 
@@ -38,23 +57,24 @@ def main(args, _session):
     if os.path.isdir(output_dir):
         shutil.rmtree(output_dir)
 
-    tiles = []
-    for z in range(0, args.max_zoom_level + 1):
-        n = 2**z
-        for x in range(n):
-            for y in range(n):
-                tiles.append({'z': z, 'x': x, 'y': y})
+    tiles = tiles_and_urls(args.map_tiles_url_format, args.max_zoom_level)
+    tile_urls = [url for _tile, url in tiles]
 
     logging.info(f'Largest zoom level: {args.max_zoom_level} ({256 * 2**args.max_zoom_level} pixels)')
-    logging.info(f'Fetching and optimizing {len(tiles)} map tiles')
-    fetcher = Fetcher('map_tiles', pool_size=1)
+    logging.info(f'Fetching {len(tiles)} map tiles')
+    for _url, error in progress.percent(fetcher.prefetch('map_tiles', tile_urls), len(tile_urls)):
+        if error:
+            raise error
+
+    logging.info(f'Optimizing {len(tiles)} map tiles')
+    tile_fetcher = fetcher.Fetcher('map_tiles', pool_size=1)
 
     tile_format = '{z}_{x}_{y}.png'
     orig_data_size = 0
     opt_data_size = 0
     os.makedirs(output_dir, exist_ok=True)
-    for tile in progress.percent(tiles):
-        data = fetcher.fetch_cached(args.map_tiles_url_format.format(**tile))
+    for tile, tile_url in progress.percent(tiles):
+        data = tile_fetcher.fetch_cached(tile_url)
         output_file = os.path.join(output_dir, tile_format.format(**tile))
         with open(output_file, 'wb') as f:
             f.write(data)
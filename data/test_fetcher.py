@@ -0,0 +1,124 @@
+'''
+Tests for the fetcher module. Run with `python -m unittest` from this
+directory.
+'''
+
+import http.server
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import fetcher
+import rate_limiter
+from negative_cache import NegativeCache
+
+
+class RememberingFailuresTest(unittest.TestCase):
+
+    _URL = 'https://www.xeno-canto.org/123/download'
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._failures = NegativeCache(self._dir.name)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _fail_with(self, status):
+        with self.assertRaises(fetcher.FetchError):
+            with fetcher._remembering_failures(self._failures, 'test', self._URL): # pylint: disable=protected-access
+                raise fetcher.FetchError(self._URL, status)
+
+    def test_gone_is_remembered(self):
+        self._fail_with(404)
+        self.assertEqual(self._failures.get(self._URL)[0], 404)
+        # The next attempt fails without running the body.
+        with self.assertRaises(fetcher.FetchError):
+            with fetcher._remembering_failures(self._failures, 'test', self._URL): # pylint: disable=protected-access
+                self.fail('Fetched a URL that is known to be gone')
+
+    def test_service_unavailable_is_not_remembered(self):
+        self._fail_with(503)
+        self.assertIsNone(self._failures.get(self._URL))
+        # The next attempt runs the body again.
+        with fetcher._remembering_failures(self._failures, 'test', self._URL): # pylint: disable=protected-access
+            pass
+
+    def test_temporary_failure_recorded_earlier_is_ignored(self):
+        self._failures.add(self._URL, 503)
+        with fetcher._remembering_failures(self._failures, 'test', self._URL): # pylint: disable=protected-access
+            pass
+
+
+class TruncatedBodyTest(unittest.TestCase):
+    '''
+    Runs a local server that cuts the connection off halfway through the body
+    of the first `truncations` responses.
+    '''
+
+    _BODY = b'0123456789' * 1000
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        rate_limiter.set_state_dir(self._dir.name)
+        patches = [
+            unittest.mock.patch.object(fetcher, 'CACHE_DIR', self._dir.name),
+            unittest.mock.patch.object(fetcher, '_BACKOFF_FACTOR', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.truncations = 0
+        self.requests = 0
+        test = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self): # pylint: disable=invalid-name
+                test.requests += 1
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(test._BODY)))
+                self.end_headers()
+                if test.requests <= test.truncations:
+                    self.wfile.write(test._BODY[:len(test._BODY) // 2])
+                    self.close_connection = True
+                else:
+                    self.wfile.write(test._BODY)
+
+            def log_message(self, *args): # pylint: disable=arguments-differ
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._url = f'http://127.0.0.1:{self._server.server_address[1]}/body'
+        self._fetcher = fetcher.Fetcher('test', pool_size=1)
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        rate_limiter.set_state_dir(None)
+        self._dir.cleanup()
+
+    def test_truncated_body_is_retried(self):
+        self.truncations = 2
+        self.assertEqual(self._fetcher.fetch_cached(self._url), self._BODY)
+        self.assertEqual(self.requests, 3)
+
+    def test_truncated_stream_is_retried(self):
+        self.truncations = 2
+        with open(self._fetcher.fetch_cached_file(self._url), 'rb') as f:
+            self.assertEqual(f.read(), self._BODY)
+        self.assertEqual(self.requests, 3)
+
+    def test_always_truncated_body_raises_fetch_error(self):
+        # Enough for both fetches to run out of retries.
+        self.truncations = 2 * (fetcher._NUM_RETRIES + 1) # pylint: disable=protected-access
+        with self.assertRaises(fetcher.FetchError):
+            self._fetcher.fetch_uncached(self._url)
+        with self.assertRaises(fetcher.FetchError):
+            self._fetcher.fetch_cached_file(self._url)
+        self.assertNotIn(self._url, fetcher.open_cache('test'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,8 @@ import numpy as np
 import pydub
 import pydub.effects
 
+import fetch_service
+import fetch_stats
 import fetcher
 import progress
 from recordings import Recording, SelectedRecording
@@ -40,6 +42,24 @@ _AUDIO_SAMPLE_RATE = 44100
 # OGG/Vorbis quality level of output audio between 0.0 and 10.0
 # (should go down to -2.0, but negative values seem to end up as 3.0)
 _AUDIO_QUALITY = 1.0
+# Extra fraction of bytes to fetch on top of the estimated audio prefix size,
+# to allow for variable bitrates and metadata
+_AUDIO_PREFIX_MARGIN = 0.1
+# Bitrate in bits per second to assume if it cannot be determined; the
+# highest that MP3 supports
+_MAX_MP3_BITRATE = 320000
+
+# MP3 bitrates in kbps for MPEG 1 and MPEG 2/2.5 Layer III, by bitrate index
+_MP3_BITRATES = {
+    1: [None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# MP3 sample rates in Hz by version bits and sample rate index
+_MP3_SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000],
+    0b10: [22050, 24000, 16000],
+    0b00: [11025, 12000, 8000],
+}
 
 
 _fetcher = None
@@ -49,8 +69,78 @@ def trimmed_recording_file_name(recording):
     return os.path.join(TRIMMED_RECORDINGS_DIR, f'{recording.recording_id}.ogg')
 
 
+def _audio_prefix_size(head):
+    '''
+    Given the first bytes of an MP3 file, estimates how many bytes are needed
+    to decode the first _AUDIO_SCAN_DURATION seconds of it.
+    '''
+    offset = 0
+    if head[:3] == b'ID3' and len(head) >= 10:
+        # The tag size is stored as a "syncsafe" integer, 7 bits per byte.
+        offset = 10 + (head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9])
+        if head[5] & 0x10:
+            offset += 10
+
+    bitrate = _MAX_MP3_BITRATE
+    i = head.find(b'\xff', offset)
+    while 0 <= i < len(head) - 4:
+        header = int.from_bytes(head[i:i + 4], 'big')
+        version_bits = (header >> 19) & 0b11
+        layer_bits = (header >> 17) & 0b11
+        bitrate_index = (header >> 12) & 0b1111
+        sample_rate_index = (header >> 10) & 0b11
+        if (header >> 21 == 0x7ff and version_bits != 0b01 and layer_bits == 0b01 and
+                0 < bitrate_index < 15 and sample_rate_index < 3):
+            mpeg1 = version_bits == 0b11
+            bitrate = 1000 * _MP3_BITRATES[1 if mpeg1 else 2][bitrate_index]
+            sample_rate = _MP3_SAMPLE_RATES[version_bits][sample_rate_index]
+            # A Xing or Info tag in the first frame of a variable bitrate file
+            # tells us the average bitrate.
+            for tag in (b'Xing', b'Info'):
+                tag_index = head.find(tag, i + 4, i + 48)
+                if tag_index >= 0 and len(head) >= tag_index + 16:
+                    flags = int.from_bytes(head[tag_index + 4:tag_index + 8], 'big')
+                    if flags & 0b11 == 0b11:
+                        num_frames = int.from_bytes(head[tag_index + 8:tag_index + 12], 'big')
+                        num_bytes = int.from_bytes(head[tag_index + 12:tag_index + 16], 'big')
+                        duration = num_frames * (1152 if mpeg1 else 576) / sample_rate
+                        if duration > 0 and num_bytes > 0:
+                            bitrate = min(_MAX_MP3_BITRATE, 8 * num_bytes / duration)
+            break
+        i = head.find(b'\xff', i + 1)
+
+    return offset + round(bitrate / 8 * _AUDIO_SCAN_DURATION * (1 + _AUDIO_PREFIX_MARGIN))
+
+
+def _decode_audio_prefix(audio_url, fetch_full):
+    '''
+    Decodes at least the first _AUDIO_SCAN_DURATION seconds of the given
+    recording, fetching only as much of it as needed unless `fetch_full` is
+    set.
+    '''
+    if fetch_full:
+        # Let ffmpeg read straight from the cache file, rather than loading
+        # the entire MP3 into memory first.
+        audio_file_name = _fetcher.fetch_cached_file(audio_url)
+        return pydub.AudioSegment.from_file(audio_file_name, 'mp3')
+
+    audio_file_name, complete = _fetcher.fetch_cached_prefix_file(audio_url, fetcher.PREFIX_HEAD_SIZE)
+    if not complete:
+        with open(audio_file_name, 'rb') as f:
+            num_bytes = _audio_prefix_size(f.read())
+        audio_file_name, complete = _fetcher.fetch_cached_prefix_file(audio_url, num_bytes)
+    while True:
+        sound = pydub.AudioSegment.from_file(audio_file_name, 'mp3')
+        if complete or sound.duration_seconds >= _AUDIO_SCAN_DURATION:
+            return sound
+        # The estimate was too low, for example because of a variable bitrate.
+        num_bytes = 2 * os.path.getsize(audio_file_name)
+        logging.debug(f'Extending prefix of {audio_url} to {num_bytes} bytes')
+        audio_file_name, complete = _fetcher.fetch_cached_prefix_file(audio_url, num_bytes)
+
+
 def trim_recording(recording,
-                   skip_if_exists=True, skip_write=False,
+                   skip_if_exists=True, skip_write=False, fetch_full=False,
                    debug_otsu_threshold=False, debug_utterances=False):
     '''
     Trims the given recording and stores it to a file.
@@ -59,24 +149,20 @@ def trim_recording(recording,
 
     global _fetcher # pylint: disable=global-statement
     if not _fetcher:
-        _fetcher = fetcher.Fetcher('recordings', pool_size=1)
+        _fetcher = fetch_service.worker_fetcher('recordings')
 
     output_file_name = trimmed_recording_file_name(recording)
     if skip_if_exists and os.path.exists(output_file_name):
         return output_file_name
 
     try:
-        data = _fetcher.fetch_cached(recording.audio_url)
+        sound = _decode_audio_prefix(recording.audio_url, fetch_full)
     except fetcher.FetchError as ex:
         logging.error(f'Error fetching {recording.recording_id}: {ex}')
         return None
-
-    try:
-        sound = pydub.AudioSegment.from_file(io.BytesIO(data), 'mp3')
     except Exception as ex: # pylint: disable=broad-except
         # These errors can get extremely long.
-        logging.error(f'Failed to decode audio file for {recording.url} '
-                      f'(cache file {_fetcher.cache_file_name(recording.audio_url)}): {str(ex)[:5000]}')
+        logging.error(f'Failed to decode audio file for {recording.url}: {str(ex)[:5000]}')
         return None
 
     # pydub does everything in milliseconds, and so do we, unless otherwise
@@ -274,8 +360,11 @@ def add_args(parser):
         help='Overwrite files instead of assuming they are up to date')
     parser.add_argument(
         '--trim_recordings_process_jobs', type=int, default=8,
-        help='Number of parallel fetches to run; do not set too high or else '
-        'the XenoCanto server might get upset!')
+        help='Number of parallel fetch and trim jobs to run; fetches are '
+        'rate limited automatically to keep the xeno-canto server happy')
+    parser.add_argument(
+        '--fetch_full_recordings', action='store_true',
+        help='Fetch entire audio files, instead of only the part at the start that is scanned for a sample')
     parser.add_argument(
         '--debug_recording_ids', type=str, default=None,
         help='Process only the given recording IDs (comma separated), do not store results, and show debug windows')
@@ -299,6 +388,7 @@ def main(args, session):
             trim_recording(recording,
                            skip_if_exists=False,
                            skip_write=True,
+                           fetch_full=args.fetch_full_recordings,
                            debug_otsu_threshold=args.debug_otsu_threshold,
                            debug_utterances=args.debug_utterances)
         return
@@ -306,15 +396,28 @@ def main(args, session):
     logging.info('Loading selected recordings')
     selected_recordings = session.query(Recording).join(SelectedRecording).all()
 
+    logging.info('Prefetching recordings')
+    untrimmed_recordings = [
+        r for r in selected_recordings
+        if args.retrim_recordings or not os.path.exists(trimmed_recording_file_name(r))
+    ]
+    for _url, error in progress.percent(
+            fetcher.prefetch('recordings', (r.audio_url for r in untrimmed_recordings),
+                             prefix_size=None if args.fetch_full_recordings else _audio_prefix_size),
+            len(untrimmed_recordings)):
+        if error:
+            logging.error(f'Error prefetching {error.url}')
+
     logging.info('Fetching and trimming recordings')
     # https://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python#35134329
     original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
     with multiprocessing.pool.Pool(args.trim_recordings_process_jobs) as pool:
         signal.signal(signal.SIGINT, original_sigint_handler)
         for _output_file_name in progress.percent(
-                pool.imap(
-                    _process_recording, [
-                        ([selected_recording], {'skip_if_exists': not args.retrim_recordings})
+                fetch_stats.pool_imap(
+                    pool, _process_recording, [
+                        ([selected_recording], {'skip_if_exists': not args.retrim_recordings,
+                                                'fetch_full': args.fetch_full_recordings})
                         for selected_recording in selected_recordings
                     ]),
                 len(selected_recordings)):
@@ -16,8 +16,10 @@ from sqlalchemy.orm import joinedload
 
 import analysis
 import db
+import species_counts
 from recordings import Recording, SelectedRecording, RecordingOverrides
 from species import Species, SelectedSpecies
+from species_counts import SpeciesCounts
 from select_recordings import select_recordings
 from trim_recordings import trim_recording
 
@@ -34,24 +36,19 @@ def _root_route():
 
 @app.route('/species')
 def _species_list_route():
-    recording_counts_subquery = session\
-        .query(Species.species_id, func.count('*').label('num_recordings'))\
-        .join(Recording, Species.scientific_name == Recording.scientific_name)\
-        .group_by(Species.species_id)\
-        .subquery()
-    species_with_selection = session.query(Species, SelectedSpecies)\
+    species_with_selection = session.query(Species, SelectedSpecies, SpeciesCounts)\
         .outerjoin(SelectedSpecies, Species.species_id == SelectedSpecies.species_id)\
-        .join(recording_counts_subquery, recording_counts_subquery.c.species_id == Species.species_id)\
+        .join(SpeciesCounts)\
+        .filter(SpeciesCounts.num_recordings > 0)\
         .options(joinedload(Species.common_names))\
-        .order_by(SelectedSpecies.ranking, recording_counts_subquery.c.num_recordings.desc())\
+        .order_by(SelectedSpecies.ranking, SpeciesCounts.num_recordings.desc())\
         .all()
-    selected_species = [species for (species, selected) in species_with_selection if selected]
-    unselected_species = [species for (species, selected) in species_with_selection if not selected]
-    recording_counts = dict(session\
-        .query(Species.species_id, func.count('*').label('num_recordings'))\
-        .join(Recording, Species.scientific_name == Recording.scientific_name)\
-        .group_by(Species.species_id)\
-        .all())
+    selected_species = [species for (species, selected, _counts) in species_with_selection if selected]
+    unselected_species = [species for (species, selected, _counts) in species_with_selection if not selected]
+    recording_counts = {
+        species.species_id: counts.num_recordings
+        for (species, _selected, counts) in species_with_selection
+    }
     selected_recording_counts = dict(session\
         .query(Species.species_id, func.count('*').label('num_recordings'))\
         .join(Recording, Species.scientific_name == Recording.scientific_name)\
@@ -177,6 +174,9 @@ def main():
     global session # pylint: disable=global-statement
     global recording_overrides # pylint: disable=global-statement
     session = db.create_session(os.path.join(os.path.dirname(__file__), 'master.db'))
+    db.create_master_schema(session)
+    species_counts.ensure_populated(session)
+    session.commit()
     recording_overrides = RecordingOverrides()
 
     host = 'localhost'